@@ -1,20 +1,138 @@
 import json
 import re
-
-from mongodb_component.intentHandler import classify_intent
-from openai import OpenAI
+import os
+import threading
+import time
+
+import admission
+import deadline
+import prompt_sessions
+import rollups
+import singleflight
+import workload
+
+from mongodb_component.intentHandler import classify_intent, mentions_write
 from mongodb_component.schema_tool import get_structured_schema, extract_schema_for_collection
+from query_templates import template_store
+from schema_resolver import resolve_schema_request
+from schema_prompt import encode_mongo_schema
+from startup import lazy_import
 # from bson import ObjectId
-from bson.objectid import ObjectId
+
+# imported on first use to keep app start-up fast
+openai = lazy_import("openai")
+objectid = lazy_import("bson.objectid")
+
+# any OpenAI-compatible endpoint, e.g. the stand-in of benchmarks/replay_workload.py
+DEEPSEEK_BASE_URL = os.environ.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+
+DEFAULT_SYSTEM_PROMPT = "You are a MongoDB expert. For each task, the user will give you database name, collection, the schema (with example field types), and a natural language instruction. Your job is to return a **strict MongoDB query** in **JSON format**. Do not include explanations, comments, or any extra text. Only return the JSON object."
+
+# Stable per-database prompt prefix: rules for both tasks + the schema. The user message only
+# carries the task line and the question, so DeepSeek's context cache covers everything above it.
+MONGO_PREFIX = """You are a MongoDB expert working on the database "{db_name}".
+Each request starts with a task line: "query" or "modify". Return ONLY a strict JSON object.
+No explanations, no comments, no Markdown, no Mongo shell syntax, no extra text.
+A request may follow up on earlier requests in this conversation; resolve references against them.
+
+# Task: query
+- The structure must be directly usable in a MongoDB driver like PyMongo.
+- If projecting a nested field like "a.b", do NOT mix "a: 0" and "a.b: 1". Instead, use an alias like "b": "$a.b" and exclude the full "a" by setting "a": 0 or "_id": 0.
+Output:
+{{
+  "collection": "collection_name",
+  "command": {{
+    "find": {{
+      "filter": {{query_conditions}},
+      "projection": {{field_selection}},  // optional
+      "sort"/"limit"/"skip": ...         // optional
+    }}
+    OR
+    "aggregate": [
+      {{"$match": ...}},
+      {{"$lookup": {{                    // cross-collection query
+        "from": "related_collection",
+        "localField": "local_field",
+        "foreignField": "foreign_field",
+        "as": "output_field"
+      }}}},
+      {{"$group"/"$sort"/"$limit": ...}}
+    ]
+  }}
+}}
+
+# Task: modify
+Convert the data modification request into strict MongoDB JSON syntax.
+- Use insertMany / updateMany / deleteMany for batch operations.
+- All fields must exist in the schema.
+- DELETE must include a non-empty filter.
+Output:
+{{
+  "collection": "<name>",
+  "action": "insertOne" | "insertMany" | "updateOne" | "updateMany" | "deleteOne" | "deleteMany",
+  // For insertOne / insertMany:
+  "data": {{...}} | [{{...}}],
+  // For updateOne / updateMany:
+  "filter": {{...}},
+  "update": {{"$set": {{...}}, "$inc": {{...}}, "$unset": {{...}}}},  // each optional
+  // For deleteOne / deleteMany:
+  "filter": {{...}}
+}}
+
+# Available collections and fields
+{schema}
+"""
 
 
 
 class DeepSeekHandler:
-    def __init__(self, db_mapping: dict, api_key: str, model: str = "deepseek-chat"):
+    def __init__(self, db_mapping: dict, api_key: str, model: str = "deepseek-chat", read_mapping: dict = None):
         self.db_mapping = db_mapping
-        self.client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
+        # same databases with a secondary-preferred read preference; used for schema sampling
+        self.read_mapping = read_mapping or db_mapping
+        self.client = openai.OpenAI(api_key=api_key, base_url=DEEPSEEK_BASE_URL)
         self.model = model
-
+        # cached catalog (collection names and sampled fields) per database
+        self.catalog_ttl = 300
+        self._catalog = {}
+        self._catalog_lock = threading.Lock()
+
+    def _cached(self, key, loader):
+        now = time.monotonic()
+        with self._catalog_lock:
+            entry = self._catalog.get(key)
+            if entry and now - entry[0] < self.catalog_ttl:
+                return entry[1]
+        # concurrent misses for the same entry share one load
+        value = singleflight.group("mongo_schema").do(key, loader)
+        with self._catalog_lock:
+            self._catalog[key] = (now, value)
+        return value
+
+    def list_collections(self, db_name: str) -> list:
+        db = self.read_mapping[db_name]
+        return self._cached((db_name,), lambda: [c for c in db.list_collection_names() if not rollups.is_internal(c)])
+
+    def get_collection_fields(self, db_name: str, collection: str):
+        db = self.read_mapping[db_name]
+        return self._cached((db_name, collection), lambda: extract_schema_for_collection(db, collection))
+
+    def get_structured_schema(self, db_name: str, collections: list) -> dict:
+        db = self.read_mapping[db_name]
+        return self._cached((db_name, "structured", tuple(collections)),
+                            lambda: get_structured_schema(db, collections))
+
+    def warm_up_catalog(self):
+        """Prefetch collection names and sampled fields for every database."""
+        for db_name in self.db_mapping:
+            self.invalidate_catalog(db_name)
+            for collection in self.list_collections(db_name):
+                self.get_collection_fields(db_name, collection)
+
+    def invalidate_catalog(self, db_name: str):
+        with self._catalog_lock:
+            for key in [k for k in self._catalog if k[0] == db_name]:
+                del self._catalog[key]
 
     def extract_target_db_and_collection(self, user_input: str, collection_name: str = None, db_name: str = None):
         if db_name and collection_name:
@@ -30,7 +148,8 @@ class DeepSeekHandler:
                     return db, collection
         return None, None
 
-    def handle_user_input(self, user_input: str, db_name: str = None, collection_name: str = None, join_collection: str = None) -> dict:
+    def handle_user_input(self, user_input: str, db_name: str = None, collection_name: str = None, join_collection: str = None,
+                          session_id: str = None) -> dict:
         intent = classify_intent(user_input)
         if intent == "schema":
             if collection_name:
@@ -40,12 +159,42 @@ class DeepSeekHandler:
                 # if collection is not given then let llm handle
                 return self.handle_schema(user_input, db_name)
         elif intent == "query":
-            return self.handle_query(user_input, db_name, collection_name, join_collection)
+            # fast path for reads: bind the constants into a learned query template, no LLM call
+            parsed = self.template_hit(user_input, db_name, collection_name, join_collection)
+            if parsed:
+                return parsed
+            return self.handle_query(user_input, db_name, collection_name, join_collection, session_id)
         elif intent == "modify":
-            return self.handle_modify(user_input, db_name, collection_name)
+            return self.handle_modify(user_input, db_name, collection_name, session_id)
         else:
             return {"error": "Sorry, I couldn't understand your request."}
 
+    def template_hit(self, user_input: str, db_name: str, collection_name: str = None, join_collection: str = None):
+        if mentions_write(user_input):
+            return None  # "fire ..." is not a read, whatever classify_intent made of it
+        hit = template_store.lookup(self.template_namespace(db_name, collection_name, join_collection), user_input)
+        if hit:
+            try:
+                parsed = json.loads(hit["query"])
+                parsed["template"] = hit["template"]
+                print("Template hit:", hit["template"])
+                return parsed
+            except ValueError:
+                pass
+        return None
+
+    def template_namespace(self, db_name: str, collection_name: str = None, join_collection: str = None) -> tuple:
+        return ("mongodb", db_name, collection_name or "", join_collection or "")
+
+    def learn_template(self, user_input: str, response: dict, db_name: str, collection_name: str = None,
+                       join_collection: str = None, generation_seconds: float = 0.0) -> bool:
+        """Record a generated query that executed successfully so similar inputs can skip the LLM."""
+        if "template" in response or response.get("follow_up") or "collection" not in response or "command" not in response:
+            return False
+        query_text = json.dumps({"collection": response["collection"], "command": response["command"]})
+        return template_store.learn(self.template_namespace(db_name, collection_name, join_collection),
+                                    user_input, query_text, "json", generation_seconds)
+
     def handle_schema_old(self, user_input: str, db_name: str = None, collection_name: str = None) -> dict:
         text = user_input.lower()
         if (("collection" in text or "collections" in text or "table" in text or
@@ -112,30 +261,6 @@ class DeepSeekHandler:
         }
 
     def get_collection_schema(self, db, collection_name) -> str:
-        def flatten_fields(doc, prefix="", out=None):
-            if out is None:
-                out = {}
-            type_map = {
-                str: "string",
-                int: "number",
-                float: "number",
-                bool: "boolean",
-                list: "array",
-                dict: "object"
-            }
-            for key, value in doc.items():
-                full_key = f"{prefix}.{key}" if prefix else key
-                if isinstance(value, dict):
-                    flatten_fields(value, full_key, out)
-                elif isinstance(value, list):
-                    if value and isinstance(value[0], dict):
-                        out[full_key] = "array<object>"
-                        flatten_fields(value[0], full_key, out)
-                    else:
-                        out[full_key] = type_map.get(type(value), "unknown")
-                else:
-                    out[full_key] = type_map.get(type(value), "unknown")
-            return out
         field_types = {}
         for doc in db[collection_name].find().limit(20):
             flatten_fields(doc, out=field_types)
@@ -148,6 +273,11 @@ class DeepSeekHandler:
         Uses LLM to classify user's schema-related natural language question
         into intent types like: list_collections, get_fields, get_samples, etc.
         """
+        # callers may modify the result, so coalesced callers each get their own copy
+        return dict(singleflight.group("deepseek").do(("schema_intent", user_input),
+                                                      lambda: self._classify_schema_intent(user_input)))
+
+    def _classify_schema_intent(self, user_input: str) -> dict:
         prompt = f"""
             You are a MongoDB schema assistant. Strictly classify the request into ONE primary intent:
         
@@ -177,8 +307,7 @@ class DeepSeekHandler:
         """
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
+            response = self.chat_completion(
                 messages=[
                     {"role": "system",
                      "content": "You are a helpful JSON-only assistant that classifies schema-related questions."},
@@ -188,6 +317,8 @@ class DeepSeekHandler:
             )
             return json.loads(response.choices[0].message.content)
 
+        except (admission.Overloaded, deadline.DeadlineExceeded):
+            raise
         except Exception as e:
             return {"schema intent": "unknown", "error": str(e)}
 
@@ -196,16 +327,21 @@ class DeepSeekHandler:
         if not db:
             return {"type": "error", "message": f"Invalid database name: {db_name}"}
 
-        try:
-            if collection_name:
-                # ✅ 如果用户传了 collection_name，我们仍调用 LLM 判断 intent，但强制覆盖 collection 字段
-                intent_result = self.classify_schema_intent(user_input)
-                intent_result["collection"] = collection_name
-            else:
-                # ❓用户没传 collection_name，LLM 来判断 intent 和 collection
-                intent_result = self.classify_schema_intent(user_input)
-        except Exception as e:
-            return {"type": "error", "message": f"Intent classification failed: {str(e)}"}
+        # resolve from the cached catalog first; only ambiguous requests go to the LLM
+        intent_result = resolve_schema_request(user_input, self.list_collections(db_name), collection_name)
+        if intent_result is None:
+            try:
+                if collection_name:
+                    # ✅ 如果用户传了 collection_name，我们仍调用 LLM 判断 intent，但强制覆盖 collection 字段
+                    intent_result = self.classify_schema_intent(user_input)
+                    intent_result["collection"] = collection_name
+                else:
+                    # ❓用户没传 collection_name，LLM 来判断 intent 和 collection
+                    intent_result = self.classify_schema_intent(user_input)
+            except Exception as e:
+                return {"type": "error", "message": f"Intent classification failed: {str(e)}"}
+        else:
+            print("Schema intent resolved locally:", intent_result)
 
         intent = intent_result.get("intent")
         collection = intent_result.get("collection")
@@ -214,11 +350,11 @@ class DeepSeekHandler:
             return {
                 "type": "schema",
                 "db": db_name,
-                "collections": db.list_collection_names()
+                "collections": self.list_collections(db_name)
             }
 
         elif intent == "get_fields" and collection:
-            schema = extract_schema_for_collection(db, collection)
+            schema = self.get_collection_fields(db_name, collection)
             if not schema:
                 return {"type": "error", "message": f"Collection '{collection}' not found or empty"}
             return {
@@ -230,7 +366,7 @@ class DeepSeekHandler:
 
         elif intent == "get_samples" and collection:
             limit = intent_result.get("limit", 3)  # 默认 3 条样例
-            sample_docs = list(db[collection].find().limit(limit))
+            sample_docs = list(self.read_mapping[db_name][collection].find().limit(limit))
             from bson import ObjectId
             sample_docs = [
                 {k: str(v) if isinstance(v, ObjectId) else v for k, v in doc.items()}
@@ -256,8 +392,8 @@ class DeepSeekHandler:
                 "type": "schema",
                 "db": db_name,
                 "fields_by_collection": {
-                    name: extract_schema_for_collection(db, name)["fields"]
-                    for name in db.list_collection_names()
+                    name: (self.get_collection_fields(db_name, name) or {}).get("fields", {})
+                    for name in self.list_collections(db_name)
                 }
             }
         return {
@@ -265,133 +401,36 @@ class DeepSeekHandler:
             "message": f"Unrecognized or unsupported schema request (intent: {intent})"
         }
 
-    def handle_query(self, user_input: str, db_name: str = None, collection_name: str = None, join_collection: str = None) -> dict:
+    def handle_query(self, user_input: str, db_name: str = None, collection_name: str = None, join_collection: str = None,
+                     session_id: str = None) -> dict:
         db = self.db_mapping.get(db_name)
         if not db:
             return {"error": f"Invalid db_name: {db_name}. Available: {list(self.db_mapping.keys())}"}
 
-        if collection_name:
-            collections = [collection_name]
-            if join_collection:
-                collections.append(join_collection)
-        else:
-            collections = db.list_collection_names()
-
-        # get schema_info
-        schema_info = get_structured_schema(db, collections)
-        print("type of schema_info:", type(schema_info))
-
-        schema_info_str = format_schema_info(schema_info)
-        print("Schema Info Preview:\n", schema_info_str[:1000])
-
-        prompt = f"""
-            # MongoDB Query Translator
-            - Only return valid JSON.
-            - Do NOT include any explanations or comments.
-            - Do NOT include Mongo shell syntax.
-            - The structure must be directly usable in a MongoDB driver like PyMongo.
-            - If projecting a nested field like "a.b", do NOT mix "a: 0" and "a.b: 1". Instead, use an alias like "b": "$a.b" and exclude the full "a" by setting "a": 0 or "_id": 0.
-
-
-            Input natural language, output strictly formatted executable JSON:
-            {{
-              "collection": "collection_name",
-              "command": {{
-                "find": {{
-                  "filter": {{query_conditions}},
-                  "projection": {{field_selection}},  // optional
-                  "sort"/"limit"/"skip": ...         // optional
-                }}
-                OR
-                "aggregate": [
-                  {{"$match": ...}},
-                  {{"$lookup": {{                    // cross-collection query
-                    "from": "related_collection",
-                    "localField": "local_field",
-                    "foreignField": "foreign_field",
-                    "as": "output_field"
-                  }}}},
-                  {{"$group"/"$sort"/"$limit": ...}}
-                ]
-              }}
-            }}
-            
-            Available collections and fields: {schema_info_str}
-            User query: \"\"\"{user_input}\"\"\"
-            """
-        response = self.query_deepseek(prompt)
+        prefix = self.prompt_prefix(db_name, self.prompt_collections(db_name, collection_name, join_collection))
+        conversation = prompt_sessions.sessions.get(session_id, ("mongodb", db_name))
+        # a follow-up only makes sense with the earlier turns; it must not become a template
+        follow_up = bool(conversation.turns)
+        response = self.generate_json(prefix, query_task(user_input), conversation)
         print("Raw LLM response:", response)
+        return parse_query_response(response, follow_up)
 
-        try:
-            parsed = json.loads(response)
-
-            # check return from llm contains "collection" and "command" fields
-            if "collection" in parsed and "command" in parsed:
-                return parsed
-            else:
-                return {"error": "Response does not contain a valid command-based query structure."}
-        except Exception as e:
-            return {"error": f"LLM did not return valid JSON: {str(e)}"}
-
-
-
-
-    def handle_modify(self, user_input: str, db_name: str = None, collection_name: str = None) -> dict:
+    def handle_modify(self, user_input: str, db_name: str = None, collection_name: str = None, session_id: str = None) -> dict:
         db = self.db_mapping.get(db_name)
         if not db:
             return {"error": f"Invalid db_name: {db_name}. Available: {list(self.db_mapping.keys())}"}
 
-        # get collection if needed
-        if collection_name:
-            collections = [collection_name]
-        else:
-            collections = db.list_collection_names()
-
-        # get formatted schema
-        schema_info = get_structured_schema(db, collections)
-        schema_info_str = format_schema_info(schema_info)
-        print("📊 Schema Info Preview (for Modify):\n", schema_info_str[:1000])
-
-        # LLM prompt for modify
+        # same prefix as queries on this database, so both share the cached prompt
+        prefix = self.prompt_prefix(db_name, self.prompt_collections(db_name, collection_name))
+        conversation = prompt_sessions.sessions.get(session_id, ("mongodb", db_name))
         prompt = f"""
-        # MongoDB Modification Translator
-        Your job is to convert natural language data modification requests into strict MongoDB JSON syntax.
-        
-        Output format:
-        {{
-          "collection": "<name>",
-          "action": "insertOne" | "insertMany" | "updateOne" | "updateMany" | "deleteOne" | "deleteMany",
-          
-          // For insertOne / insertMany:
-          "data": {{...}} | [{{...}}],
-          
-          // For updateOne / updateMany:
-          "filter": {{...}},
-          "update": {{
-            "$set": {{...}},       // Optional: to update fields
-            "$inc": {{...}},       // Optional: to increment numbers
-            "$unset": {{...}}      // Optional: to remove fields
-          }},
-          
-         // For deleteOne / deleteMany:
-          "filter": {{...}}
-        }}
-        
-        Schema info:
-        {schema_info_str}
-        
-        Rules:
-        - Use insertMany / updateMany / deleteMany for batch operations.
-        - All fields must exist in the schema.
-        - DELETE must include a non-empty filter.
-        - Return ONLY a strict JSON object. No explanations, no Markdown, no extra text.
-        
+        Task: modify. Output the "collection"/"action" JSON described above.
         User input:
         \"\"\"{user_input}\"\"\"
         """
 
         # call LLM
-        response = self.query_deepseek(prompt)
+        response = self.generate_json(prefix, prompt, conversation)
         print("🔎 Raw Modify LLM Response:", response)
         try:
             parsed = json.loads(response)
@@ -404,6 +443,12 @@ class DeepSeekHandler:
             return {"error": "LLM response missing 'collection'"}
         collection = db[target_collection]
         action = parsed.get("action")
+        # last chance to stop before a write; once sent it runs to completion
+        deadline.check("mongodb")
+        workload.record_query("mongodb", parsed)
+        # rollups over this collection are marked stale before the write and refreshed after it
+        pending = rollups.mongo.before_write(db, target_collection)
+        started = time.perf_counter()
         try:
             # if action == "insertOne":
             #     result = collection.insert_one(parsed.get("data"))
@@ -489,35 +534,129 @@ class DeepSeekHandler:
                 return {"error": f"Unrecognized action: {action}"}
         except Exception as e:
             return {"error": f"MongoDB operation failed: {str(e)}"}
+        finally:
+            workload.record_db("mongodb", time.perf_counter() - started, None)
+            # writes can add collections or fields
+            self.invalidate_catalog(db_name)
+            inserted = parsed.get("data") if action in ("insertOne", "insertMany") else None
+            rollups.mongo.after_write(db, target_collection, pending, action, inserted)
 
 
 
 
 
 
+    def prompt_collections(self, db_name: str, collection_name: str = None, join_collection: str = None) -> list:
+        if collection_name:
+            return [collection_name] + ([join_collection] if join_collection else [])
+        return self.list_collections(db_name)
+
+    def prompt_prefix(self, db_name: str, collections: list) -> str:
+        return format_prompt_prefix(db_name, self.get_structured_schema(db_name, collections))
+
+    def generate_json(self, prefix: str, prompt: str, conversation) -> str:
+        messages = conversation.messages(prefix, prompt)
+        response = singleflight.group("deepseek").do(json.dumps(messages), lambda: self._complete_json(messages))
+        if not response.startswith("Error calling DeepSeek"):
+            conversation.record(prompt, response)
+        return response
+
     def query_deepseek(self, prompt: str) -> str:
+        # identical prompts in flight at the same time share one generation
+        return singleflight.group("deepseek").do(prompt, lambda: self._query_deepseek(prompt))
+
+    def chat_completion(self, messages: list, **kwargs):
+        # bounded concurrency towards the API; sheds load when the queue budget would be exceeded
+        with deadline.stage("deepseek"), admission.admit("deepseek"):
+            left = deadline.remaining()
+            if left is not None:
+                kwargs.setdefault("timeout", left)
+            started = time.perf_counter()
+            response = self.client.chat.completions.create(model=self.model, messages=messages, **kwargs)
+            usage = getattr(response, "usage", None)
+            workload.record_llm("deepseek", messages, response.choices[0].message.content,
+                                time.perf_counter() - started, getattr(usage, "prompt_tokens", None),
+                                getattr(usage, "completion_tokens", None))
+            return response
+
+    def _query_deepseek(self, prompt: str) -> str:
+        return self._complete_json([
+            {"role": "system", "content": DEFAULT_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ])
+
+    def _complete_json(self, messages: list) -> str:
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are a MongoDB expert. For each task, the user will give you database name, collection, the schema (with example field types), and a natural language instruction. Your job is to return a **strict MongoDB query** in **JSON format**. Do not include explanations, comments, or any extra text. Only return the JSON object."
-},
-                    {"role": "user", "content": prompt}
-                ],
-                response_format={"type": "json_object"}
-            )
-            raw = response.choices[0].message.content
-            # clean markdown （```json\n...```）
-            clean = re.sub(r"```(?:json)?\n?", "", raw).strip("`\n ")
-
-            return clean
+            response = self.chat_completion(messages=messages, response_format={"type": "json_object"})
+            prompt_sessions.record_deepseek_usage(response)
+            return strip_markdown(response.choices[0].message.content)
+        except (admission.Overloaded, deadline.DeadlineExceeded):
+            raise
         except Exception as e:
             return f"Error calling DeepSeek: {str(e)}"
 
 
 # tool function
 
+def format_prompt_prefix(db_name: str, schema_info: dict) -> str:
+    # no question-specific pinning: the prefix must stay byte-identical across requests
+    encoded = encode_mongo_schema(schema_info)
+    print(f"Schema prefix: {encoded['tokens']} tokens, {encoded['dropped']} fields dropped")
+    return MONGO_PREFIX.format(db_name=db_name, schema=encoded["text"])
+
 
+def query_task(user_input: str) -> str:
+    return f"""
+            Task: query. Output the "collection"/"command" JSON described above.
+            User query: \"\"\"{user_input}\"\"\"
+            """
+
+
+def parse_query_response(response: str, follow_up: bool = False) -> dict:
+    try:
+        parsed = json.loads(response)
+
+        # check return from llm contains "collection" and "command" fields
+        if "collection" in parsed and "command" in parsed:
+            if follow_up:
+                parsed["follow_up"] = True
+            return parsed
+        else:
+            return {"error": "Response does not contain a valid command-based query structure."}
+    except Exception as e:
+        return {"error": f"LLM did not return valid JSON: {str(e)}"}
+
+
+def strip_markdown(raw: str) -> str:
+    # clean markdown （```json\n...```）
+    return re.sub(r"```(?:json)?\n?", "", raw).strip("`\n ")
+
+
+FIELD_TYPE_NAMES = {
+    str: "string",
+    int: "number",
+    float: "number",
+    bool: "boolean",
+    list: "array",
+    dict: "object"
+}
+
+def flatten_fields(doc, prefix="", out=None):
+    if out is None:
+        out = {}
+    for key, value in doc.items():
+        full_key = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flatten_fields(value, full_key, out)
+        elif isinstance(value, list):
+            if value and isinstance(value[0], dict):
+                out[full_key] = "array<object>"
+                flatten_fields(value[0], full_key, out)
+            else:
+                out[full_key] = FIELD_TYPE_NAMES.get(type(value), "unknown")
+        else:
+            out[full_key] = FIELD_TYPE_NAMES.get(type(value), "unknown")
+    return out
 
 def format_schema_info(schema_info: dict) -> str:
     text = "Collections and Fields:\n"
@@ -531,21 +670,29 @@ def format_schema_info(schema_info: dict) -> str:
             text += f"  - from: {rel['from']} → to: {rel['to']}\n"
     return text
 
+# ObjectId is resolved once per call: each attribute access on the lazy bson proxy is a lookup,
+# which showed up as half the cost on large results when it happened per value
 def convert_object_ids(doc):
+    return _convert_object_ids(doc, objectid.ObjectId)
+
+def _convert_object_ids(doc, object_id):
     if isinstance(doc, dict):
         if "$oid" in doc and len(doc) == 1:
-            return ObjectId(doc["$oid"])
-        return {k: convert_object_ids(v) for k, v in doc.items()}
+            return object_id(doc["$oid"])
+        return {k: _convert_object_ids(v, object_id) for k, v in doc.items()}
     elif isinstance(doc, list):
-        return [convert_object_ids(i) for i in doc]
+        return [_convert_object_ids(i, object_id) for i in doc]
     return doc
 
 def stringify_object_ids(doc):
+    return _stringify_object_ids(doc, objectid.ObjectId)
+
+def _stringify_object_ids(doc, object_id):
     if isinstance(doc, dict):
-        return {k: stringify_object_ids(v) for k, v in doc.items()}
+        return {k: _stringify_object_ids(v, object_id) for k, v in doc.items()}
     elif isinstance(doc, list):
-        return [stringify_object_ids(i) for i in doc]
-    elif isinstance(doc, ObjectId):
+        return [_stringify_object_ids(i, object_id) for i in doc]
+    elif isinstance(doc, object_id):
         return str(doc)
     else:
         return doc
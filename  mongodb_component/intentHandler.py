@@ -1,4 +1,27 @@
 
+import re
+
+# Verbs that can ask for a change in either engine; broader than classify_intent's modify list
+# because a false match here only costs a skipped shortcut (template, coalescing, resolver)
+WRITE_KEYWORDS = [
+    'insert', 'add', 'create', 'register', 'hire', 'enroll',
+    'update', 'change', 'set', 'edit', 'replace', 'rename', 'modify', 'raise', 'increase',
+    'decrease', 'reduce', 'promote', 'demote', 'assign', 'transfer', 'move', 'mark',
+    'delete', 'remove', 'drop', 'fire', 'truncate', 'clear', 'erase', 'cancel'
+]
+
+
+def mentions_write(user_input: str) -> bool:
+    words = set(re.findall(r"[a-z]+", user_input.lower()))
+    return any(kw in words or kw + 's' in words or kw + 'd' in words or kw + 'ed' in words
+               for kw in WRITE_KEYWORDS)
+
+
+def is_read_request(user_input: str) -> bool:
+    """True when the keyword rules see a read and no write verb; needs no LLM call."""
+    return not mentions_write(user_input) and classify_intent(user_input) == 'query'
+
+
 # --- Intent Classifier local version ---
 def classify_intent(user_input: str) -> str:
     text = user_input.lower().strip()
@@ -1,5 +1,7 @@
 from collections import defaultdict
 
+SAMPLE_SIZE = 10
+
 def infer_type(value):
     if isinstance(value, str):
         return "string"
@@ -17,36 +19,46 @@ def infer_type(value):
         return "ObjectId"
     return "unknown"
 
+def parse_doc(d, fields, seen, prefix=""):
+    """Record the flattened path and type of every field of `d` in `fields`, and each path in `seen`."""
+    for k, v in d.items():
+        key = f"{prefix}.{k}" if prefix else k
+        seen.add(key)
+        if isinstance(v, dict):
+            fields[key] = "object"
+            parse_doc(v, fields, seen, key)
+        elif isinstance(v, list):
+            fields[key] = "array"
+            if v and isinstance(v[0], dict):
+                parse_doc(v[0], fields, seen, key)
+        else:
+            fields[key] = infer_type(v)
+
 def extract_schema_for_collection(db, collection_name):
     if collection_name not in db.list_collection_names():
         return None
 
     collection = db[collection_name]
-    sample_docs = list(collection.find().limit(10))
+    sample_docs = list(collection.find().limit(SAMPLE_SIZE))
     if not sample_docs:
         return None
+    return describe_sample(sample_docs, list(collection.index_information().keys()))
 
+def describe_sample(sample_docs, indexes):
     fields = {}
-
-    def parse_doc(d, prefix=""):
-        for k, v in d.items():
-            key = f"{prefix}.{k}" if prefix else k
-            if isinstance(v, dict):
-                fields[key] = "object"
-                parse_doc(v, key)
-            elif isinstance(v, list):
-                fields[key] = "array"
-                if v and isinstance(v[0], dict):
-                    parse_doc(v[0], key)
-            else:
-                fields[key] = infer_type(v)
+    # number of sampled documents that contain each field
+    counts = {}
 
     for doc in sample_docs:
-        parse_doc(doc)
+        seen = set()
+        parse_doc(doc, fields, seen)
+        for key in seen:
+            counts[key] = counts.get(key, 0) + 1
 
     return {
         "fields": fields,
-        "indexes": list(collection.index_information().keys())
+        "frequency": {key: counts[key] / len(sample_docs) for key in fields},
+        "indexes": indexes
     }
 
 def get_structured_schema(db, collections):
@@ -60,7 +72,10 @@ def get_structured_schema(db, collections):
         if col_schema:
             schema_info["collections"][collection_name] = col_schema
 
-    # Guess relationships
+    guess_relationships(schema_info)
+    return schema_info
+
+def guess_relationships(schema_info):
     for cname, cinfo in schema_info["collections"].items():
         for field, ftype in cinfo["fields"].items():
             if "id" in field.lower() and ftype == "ObjectId":
@@ -72,5 +87,3 @@ def get_structured_schema(db, collections):
                             "from": f"{cname}.{field}",
                             "to": f"{ref_coll}._id"
                         })
-
-    return schema_info
@@ -0,0 +1,306 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import deadline
+from shared_cache import cache_path
+
+# Admission control in front of scarce backends (LLMs, databases).
+#
+# Every backend has a concurrency limit and a bounded wait queue ordered by priority class.
+# A request that cannot get a slot within its queue-time budget is shed immediately with
+# Overloaded instead of piling up until everything times out:
+#   - queue full                              -> 429
+#   - expected wait longer than the budget    -> 503
+#   - waited for the whole budget             -> 503
+#
+# The limits hold for the whole host, not per worker process: serving.py starts one process per
+# core, and they all talk to the same local llama3. A call first takes a slot in its own process
+# (priority order, budgets as above) and then one of max_concurrent lock files in CHATDB_CACHE_DIR,
+# held with flock() for the duration of the call and released by the kernel if the process dies.
+# Processes compete for those by polling, without priorities between them. CHATDB_HOST_LIMITS=0
+# (or a platform without flock) makes the limits per process again.
+
+PRIORITIES = {"interactive": 0, "default": 1, "batch": 2}
+DEFAULT_QUEUE_BUDGET = float(os.environ.get("CHATDB_QUEUE_BUDGET", "10"))  # seconds
+
+# backend name -> (max concurrent, max queued); database backends ("mysql:<db>", "mongodb:<db>") use DB_LIMITS
+BACKEND_LIMITS = {
+    "ollama": (int(os.environ.get("OLLAMA_CONCURRENCY", "2")), 32),
+    "deepseek": (int(os.environ.get("DEEPSEEK_CONCURRENCY", "16")), 128),
+}
+DB_LIMITS = (int(os.environ.get("DB_CONCURRENCY", "8")), 64)
+HOST_LIMITS = os.environ.get("CHATDB_HOST_LIMITS", "1") == "1" and os.name == "posix"
+HOST_POLL_SECONDS = (0.002, 0.05)  # first and longest pause between attempts on the host-wide slots
+
+# priority and queue budget of the current request, set once at the edge (app.py)
+request_priority = contextvars.ContextVar("request_priority", default="default")
+request_budget = contextvars.ContextVar("request_budget", default=DEFAULT_QUEUE_BUDGET)
+
+
+class Overloaded(Exception):
+    def __init__(self, backend: str, status: int, reason: str, retry_after: float = 1.0):
+        super().__init__(f"{backend} is overloaded: {reason}")
+        self.backend = backend
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, loop=None):
+        self.event = threading.Event()
+        self.admitted = False
+        # a waiter from an event loop (async_app.py) is woken through a future instead of blocking a thread
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+
+    def wake(self):
+        self.event.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class _HostSlots:
+    """max_concurrent lock files shared by every worker process on the host."""
+
+    def __init__(self, name: str, count: int):
+        prefix = "admission-" + "".join(c if c.isalnum() else "_" for c in name)
+        self.paths = [cache_path(f"{prefix}.{i}.lock") for i in range(count)]
+        self._start = itertools.count()
+
+    def try_acquire(self):
+        """An open, locked slot file (close it to release), or None when every slot is taken."""
+        import fcntl
+
+        start = next(self._start)
+        for i in range(len(self.paths)):
+            # a fresh open file per attempt: flock() does not exclude threads sharing one file
+            f = open(self.paths[(start + i) % len(self.paths)], "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except BlockingIOError:
+                f.close()
+        return None
+
+
+class Backend:
+    def __init__(self, name: str, max_concurrent: int, max_queue: int):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.host_slots = _HostSlots(name, max_concurrent) if HOST_LIMITS else None
+        self.active = 0
+        self._queue = []  # heap of (priority, seq, waiter)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        # exponentially weighted mean of how long one admitted call holds its slot
+        self.service_seconds = 1.0
+        self.stats = {"admitted": 0, "rejected_full": 0, "rejected_budget": 0, "timed_out": 0,
+                      "host_timed_out": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+    def _expected_wait(self, ahead: int) -> float:
+        # every max_concurrent waiters ahead of us cost roughly one service time
+        return (ahead // self.max_concurrent + 1) * self.service_seconds
+
+    def acquire(self, priority: int, budget: float) -> float:
+        started = time.monotonic()
+        entry = self._enqueue(priority, budget, None)
+        if entry is None:
+            return 0.0
+        entry[2].event.wait(budget)
+        return self._finish_wait(entry, started, budget)
+
+    async def acquire_async(self, priority: int, budget: float) -> float:
+        started = time.monotonic()
+        entry = self._enqueue(priority, budget, asyncio.get_running_loop())
+        if entry is None:
+            return 0.0
+        try:
+            await asyncio.wait_for(asyncio.shield(entry[2].future), budget)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            self._abandon(entry)
+            raise
+        return self._finish_wait(entry, started, budget)
+
+    def _enqueue(self, priority: int, budget: float, loop):
+        """Take a free slot (returns None) or join the wait queue (returns the queue entry)."""
+        with self._lock:
+            if self.active < self.max_concurrent and not self._queue:
+                self.active += 1
+                self.stats["admitted"] += 1
+                return None
+            if len(self._queue) >= self.max_queue:
+                # a full queue still takes higher-priority work by shedding the newest lowest-priority waiter
+                victim = max(self._queue)
+                if victim[0] <= priority:
+                    self.stats["rejected_full"] += 1
+                    raise Overloaded(self.name, 429, "queue is full", self.service_seconds)
+                self._queue.remove(victim)
+                heapq.heapify(self._queue)
+                victim[2].wake()
+            ahead = sum(1 for p, _, _ in self._queue if p <= priority)
+            expected = self._expected_wait(ahead)
+            if expected > budget:
+                self.stats["rejected_budget"] += 1
+                raise Overloaded(self.name, 503, f"expected wait {expected:.1f}s exceeds budget {budget:.1f}s", expected)
+            entry = (priority, next(self._seq), _Waiter(loop))
+            heapq.heappush(self._queue, entry)
+            return entry
+
+    def _finish_wait(self, entry, started: float, budget: float) -> float:
+        waiter = entry[2]
+        with self._lock:
+            if not waiter.admitted:
+                if waiter.event.is_set():
+                    self.stats["rejected_full"] += 1
+                    raise Overloaded(self.name, 429, "displaced by higher-priority work", self.service_seconds)
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self.stats["timed_out"] += 1
+                raise Overloaded(self.name, 503, f"no slot within {budget:.1f}s", self.service_seconds)
+        # release() handed its slot over to us
+        waited = time.monotonic() - started
+        with self._lock:
+            self.stats["admitted"] += 1
+            self.stats["wait_seconds_total"] += waited
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+        return waited
+
+    def acquire_host_slot(self, budget: float):
+        """After acquire(): wait up to budget for a host-wide slot; returns what release() takes back."""
+        if self.host_slots is None:
+            return None
+        give_up = time.monotonic() + budget
+        pause = HOST_POLL_SECONDS[0]
+        while True:
+            held = self.host_slots.try_acquire()
+            if held is not None:
+                return held
+            self._check_host_wait(give_up, pause, budget)
+            time.sleep(pause)
+            pause = min(pause * 2, HOST_POLL_SECONDS[1])
+
+    async def acquire_host_slot_async(self, budget: float):
+        if self.host_slots is None:
+            return None
+        give_up = time.monotonic() + budget
+        pause = HOST_POLL_SECONDS[0]
+        while True:
+            held = self.host_slots.try_acquire()
+            if held is not None:
+                return held
+            self._check_host_wait(give_up, pause, budget)
+            await asyncio.sleep(pause)
+            pause = min(pause * 2, HOST_POLL_SECONDS[1])
+
+    def _check_host_wait(self, give_up: float, pause: float, budget: float):
+        if time.monotonic() + pause > give_up:
+            with self._lock:
+                self.stats["host_timed_out"] += 1
+            raise Overloaded(self.name, 503, f"no host-wide slot within {budget:.1f}s", self.service_seconds)
+
+    def _abandon(self, entry):
+        # the waiting task was cancelled: leave the queue, or pass on a slot that was already handed over
+        with self._lock:
+            handed_over = entry[2].admitted
+            if not handed_over and entry in self._queue:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+        if handed_over:
+            self.release(self.service_seconds)
+
+    def release(self, held_seconds: float):
+        with self._lock:
+            self.service_seconds = 0.8 * self.service_seconds + 0.2 * held_seconds
+            if self._queue:
+                # hand the slot directly to the highest-priority waiter
+                _, _, waiter = heapq.heappop(self._queue)
+                waiter.admitted = True
+                waiter.wake()
+            else:
+                self.active -= 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            snapshot = dict(self.stats)
+            snapshot.update(active=self.active, queued=len(self._queue), max_concurrent=self.max_concurrent,
+                            max_queue=self.max_queue, service_seconds=round(self.service_seconds, 3))
+        admitted = snapshot["admitted"]
+        snapshot["wait_seconds_mean"] = round(snapshot.pop("wait_seconds_total") / admitted, 4) if admitted else 0.0
+        snapshot["wait_seconds_max"] = round(snapshot["wait_seconds_max"], 4)
+        return snapshot
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def backend(name: str) -> Backend:
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = Backend(name, *BACKEND_LIMITS.get(name, DB_LIMITS))
+        return _backends[name]
+
+
+def _slot_request(name: str):
+    priority = PRIORITIES.get(request_priority.get(), PRIORITIES["default"])
+    # never queue past the request's deadline
+    budget = min(request_budget.get(), deadline.remaining(request_budget.get()))
+    return backend(name), priority, budget
+
+
+@contextmanager
+def admit(name: str):
+    """Hold a slot on backend `name` for the duration of the block, using the request's priority and budget."""
+    target, priority, budget = _slot_request(name)
+    waited = target.acquire(priority, budget)
+    try:
+        held = target.acquire_host_slot(budget - waited)
+    except BaseException:
+        target.release(target.service_seconds)
+        raise
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        if held is not None:
+            held.close()
+        target.release(time.monotonic() - started)
+
+
+@asynccontextmanager
+async def admit_async(name: str):
+    """admit() for coroutines: waiting for a slot suspends the task instead of blocking a thread."""
+    target, priority, budget = _slot_request(name)
+    waited = await target.acquire_async(priority, budget)
+    try:
+        held = await target.acquire_host_slot_async(budget - waited)
+    except BaseException:
+        target.release(target.service_seconds)
+        raise
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        if held is not None:
+            held.close()
+        target.release(time.monotonic() - started)
+
+
+def stats() -> dict:
+    with _backends_lock:
+        backends = list(_backends.values())
+    return {b.name: b.snapshot() for b in backends}
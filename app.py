@@ -1,11 +1,35 @@
-from pymongo import MongoClient
-from flask import Flask, request, jsonify, Response
+import time
+_import_started = time.perf_counter()
+
+from flask import Flask, request, jsonify, Response, g
+import nl2sql_v2
 from nl2sql_v2 import handle_query
 import json
+import os
+import threading
+import admission
+import deadline
+import federated
+import prompt_sessions
+import read_routing
+import result_summary
+import rollups
+import schema_prompt
+import singleflight
+import startup
+import workload
+from startup import lazy_import
 # from mongodb_component import gptHandler
 # from mongodb_component.llamaHandler import LlamaHandler
 from mongodb_component.deepseekHandler import DeepSeekHandler
+from mongodb_component.intentHandler import is_read_request
+from federated import handle_federated_query
 from flask_cors import CORS
+from query_templates import template_store
+from result_summary import summarize_documents
+
+# imported on first use to keep app start-up fast
+pymongo = lazy_import("pymongo")
 
 
 
@@ -14,25 +38,159 @@ CORS(app)
 
 
 # MongoDB connection (single instance with multiple databases)
-MONGO_URI = "mongodb://localhost:27017"
-client = MongoClient(MONGO_URI)
-
-# Set up mapping to multiple databases
-db_mapping = {
-    "WorldData": client["WorldData"],
-    "ChinaGDP": client["ChinaGDP"],
-    "NobelPrize": client["NobelPrize"]
-    # "Pokedex": client["Pokedex"],
-    # "WorldData": client["WorldData"]
-    # "SchoolDB": client["SchoolDB"]
-}
-# Initialize DeepSeekHandler
-deepseek_handler = DeepSeekHandler(db_mapping, api_key="Your_DeepSeek_API_Key_Here")
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017")
+MONGO_DATABASES = [
+    "WorldData",
+    "ChinaGDP",
+    "NobelPrize"
+    # "Pokedex",
+    # "SchoolDB"
+]
+DEEPSEEK_API_KEY = os.environ.get("DEEPSEEK_API_KEY", "Your_DeepSeek_API_Key_Here")
+
+# Clients are created lazily, once per process. MongoClient is not fork-safe, so a pre-fork
+# server must not inherit one from the master: the pid check rebuilds everything in a worker.
+_resources = {}
+_resources_lock = threading.Lock()
+
+
+def get_resources() -> dict:
+    pid = os.getpid()
+    if _resources.get("pid") != pid:
+        with _resources_lock:
+            if _resources.get("pid") != pid:
+                client = pymongo.MongoClient(MONGO_URI)
+                # Set up mapping to multiple databases (writes and read-your-writes go to the primary)
+                db_mapping = {name: client[name] for name in MONGO_DATABASES}
+                # generated reads and schema sampling may be served by secondaries
+                read_preference = read_routing.mongo_read_preference()
+                read_mapping = {name: client.get_database(name, read_preference=read_preference)
+                                for name in MONGO_DATABASES}
+                # Initialize DeepSeekHandler
+                deepseek_handler = DeepSeekHandler(db_mapping, api_key=DEEPSEEK_API_KEY, read_mapping=read_mapping)
+                _resources.clear()
+                _resources.update(client=client, db_mapping=db_mapping, read_mapping=read_mapping,
+                                  deepseek_handler=deepseek_handler, pid=pid)
+    return _resources
+
+
+def get_mongo_client():
+    return get_resources()["client"]
+
+
+def get_db_mapping() -> dict:
+    return get_resources()["db_mapping"]
+
+
+def get_read_mapping() -> dict:
+    return get_resources()["read_mapping"]
+
+
+def get_deepseek_handler() -> DeepSeekHandler:
+    return get_resources()["deepseek_handler"]
 
 # Initialize the LlamaHandler with a specific collection
 # llama_handler = LlamaHandler(db_mapping)
 
 
+def warm_up_mongodb():
+    get_mongo_client().admin.command('ping')
+    get_deepseek_handler().warm_up_catalog()
+
+
+startup.register_warm_up("mongodb", warm_up_mongodb)
+startup.register_warm_up("mysql", nl2sql_v2.warm_up_mysql)
+startup.register_warm_up("llm", nl2sql_v2.warm_up_llm)
+
+
+@app.before_request
+def begin_request():
+    # no-op after the first call in each process
+    startup.start_warm_up()
+    g.request_started = time.perf_counter()
+    # priority class and queue budget for admission control; set on every request because
+    # server threads are reused
+    body = request.get_json(silent=True) if request.is_json else None
+    priority = request.headers.get("X-Priority") or (body or {}).get("priority") or "default"
+    admission.request_priority.set(priority if priority in admission.PRIORITIES else "default")
+    try:
+        budget = float(request.headers.get("X-Queue-Budget", admission.DEFAULT_QUEUE_BUDGET))
+    except ValueError:
+        budget = admission.DEFAULT_QUEUE_BUDGET
+    admission.request_budget.set(budget)
+    # time budget for the whole pipeline; cancelled early if the client goes away
+    try:
+        deadline_ms = float(request.headers.get("X-Deadline-Ms") or (body or {}).get("deadline_ms") or 0)
+    except (TypeError, ValueError):
+        deadline_ms = 0
+    request_deadline = deadline.Deadline(deadline_ms / 1000 if deadline_ms > 0 else deadline.DEFAULT_DEADLINE_SECONDS)
+    deadline.current.set(request_deadline)
+    g.disconnect_watch = deadline.watcher.watch(deadline.request_socket(request.environ), request_deadline)
+    # sampled requests are recorded for replay (workload.py)
+    if request.path.startswith("/query"):
+        workload.begin(request.path, body, request.headers)
+
+
+@app.teardown_request
+def finish_request(exc):
+    deadline.watcher.unwatch(g.pop("disconnect_watch", None))
+    deadline.current.set(None)
+    workload.current.set(None)
+
+
+@app.errorhandler(deadline.DeadlineExceeded)
+def deadline_exceeded(e):
+    # 499: the client closed the connection (nginx convention); nobody will read it anyway
+    status = 499 if isinstance(e, deadline.Cancelled) else 504
+    return jsonify({"error": str(e), "deadline_stage": e.stage}), status
+
+
+@app.errorhandler(admission.Overloaded)
+def overloaded(e):
+    response = jsonify({"error": str(e), "backend": e.backend, "reason": e.reason})
+    response.status_code = e.status
+    response.headers["Retry-After"] = str(max(1, int(round(e.retry_after))))
+    return response
+
+
+@app.after_request
+def end_request(response):
+    if "request_started" in g and request.path.startswith("/query"):
+        startup.record_first_request(request.path, time.perf_counter() - g.request_started)
+    workload.finish(response.status_code, response.calculate_content_length() or 0)
+    return response
+
+
+def request_session_id(data):
+    return request.headers.get("X-Session-Id") or (data or {}).get("session_id")
+
+
+def coalesce_request(engine, data, fn):
+    """
+    Run fn() once for concurrent identical requests and hand every caller the same result.
+    Only requests known to be reads are coalesced: two identical inserts must both happen.
+    """
+    key = coalesce_key(engine, data or {}, request_session_id(data))
+    if key is None:
+        return fn()
+    return singleflight.group("requests").do(key, fn)
+
+
+def coalesce_key(engine, data, session_id):
+    """What makes two requests identical, or None unless it is a read (shared with async_app.py)."""
+    user_input = data.get("user_input") or ""
+    # the keyword rules are tuned for MongoDB and miss SQL writes such as "fire employee 10001";
+    # anything they do not positively see as a read runs on its own (its LLM calls still coalesce)
+    if not is_read_request(user_input):
+        return None
+    return (engine, " ".join(user_input.lower().split()), data.get("db_name"),
+            data.get("collection"), data.get("join_collection"), bool(data.get("narrative")),
+            # a session pinned to the primary must not share a replica read
+            read_routing.sessions.reads_pinned(session_id),
+            # a follow-up depends on its own conversation
+            session_id if prompt_sessions.sessions.has_history(session_id, (engine, data.get("db_name"))) else None)
+
+
 @app.route('/', methods=['GET'])
 def home():
     return "Welcome to ChatDB API!", 200
@@ -40,7 +198,7 @@ def home():
 @app.route('/check_connection', methods=['GET'])
 def check_connection():
     try:
-        client.admin.command('ping')
+        get_mongo_client().admin.command('ping')
         return "Connected to MongoDB successfully.", 200
     except Exception as e:
         return f"Failed to connect to MongoDB: {str(e)}", 500
@@ -59,6 +217,42 @@ def check_connection():
 #     return jsonify({"llm_response": response})
 
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    report = startup.report()
+    return jsonify(report), 200 if report["ready"] else 503
+
+
+@app.route('/session/reset', methods=['POST'])
+def reset_session():
+    # forget the conversation so the next question starts without follow-up context
+    session_id = request_session_id(request.get_json(silent=True))
+    if not session_id:
+        return jsonify({"error": "Missing X-Session-Id header or 'session_id' field"}), 400
+    prompt_sessions.sessions.clear(session_id)
+    return jsonify({"session_id": session_id, "status": "reset"}), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify(metrics_report()), 200
+
+
+def metrics_report() -> dict:
+    return {
+        "templates": template_store.stats(),
+        "coalescing": singleflight.stats(),
+        "admission": admission.stats(),
+        "schema_prompt": schema_prompt.stats(),
+        "summaries": result_summary.stats(),
+        "prompt_cache": prompt_sessions.stats(),
+        "federated": federated.stats(),
+        "rollups": rollups.stats(),
+        "workload": workload.stats(),
+        "startup": startup.report()
+    }
+
+
 @app.route('/test_deepseek', methods=['GET'])
 def test_deepseek():
     prompt = """
@@ -69,7 +263,7 @@ def test_deepseek():
     Do not explain anything, do not add Markdown.
     Only return the raw JSON.
     """
-    response = deepseek_handler.query_deepseek(prompt)
+    response = get_deepseek_handler().query_deepseek(prompt)
     try:
         parsed = json.loads(response)
         return jsonify(parsed), 200
@@ -79,92 +273,151 @@ def test_deepseek():
 
 @app.route('/query/mongodb', methods=['POST'])
 def query_mongodb():
+    data = request.get_json()
+    payload, status = coalesce_request("mongodb", data, lambda: run_mongodb_query(data))
+    return jsonify(payload), status
+
+
+def run_mongodb_query(data):
     try:
-        client.admin.command('ping')  # 检查 MongoDB
+        get_mongo_client().admin.command('ping')  # 检查 MongoDB
+        db_mapping = get_db_mapping()
+        deepseek_handler = get_deepseek_handler()
 
-        data = request.get_json()
         user_input = data.get('user_input')
         db_name = data.get('db_name')
         collection_name = data.get('collection')  # optional
         join_collection = data.get('join_collection')  # optional
+        session_id = request_session_id(data)  # optional, enables read-your-writes
 
         # check user_input
         if not user_input or not db_name:
-            return jsonify({"error": "Missing 'user_input' or 'db_name' in request."}), 400
+            return {"error": "Missing 'user_input' or 'db_name' in request."}, 400
 
         # check if the db is existed
         if db_name not in db_mapping:
-            return jsonify({"error": f"Invalid db_name. Available: {list(db_mapping.keys())}"}), 400
-
-        # get instance
-        db = db_mapping[db_name]
-        response = deepseek_handler.handle_user_input(user_input, db_name, collection_name, join_collection)
+            return {"error": f"Invalid db_name. Available: {list(db_mapping.keys())}"}, 400
+
+        # get instance: reads go to secondaries unless this session just wrote
+        if read_routing.sessions.reads_pinned(session_id):
+            db = db_mapping[db_name]
+        else:
+            db = get_read_mapping()[db_name]
+        started = time.perf_counter()
+        response = deepseek_handler.handle_user_input(user_input, db_name, collection_name, join_collection, session_id)
+        generation_seconds = time.perf_counter() - started
         print("LLM response:", response)
 
-        if "error" in response:
-            return jsonify(response), 400
+        return execute_mongo_command(response, db, db_name, user_input, collection_name, join_collection,
+                                     generation_seconds, session_id)
 
-        # schema
-        if response.get("type") == "schema":
-            return jsonify(response), 200
+    except (admission.Overloaded, deadline.DeadlineExceeded):
+        raise
+    except Exception as e:
+        return {"error": str(e)}, 500
 
-        # target_collection = response.get("collection") or \
-        #                     response.get("find") or \
-        #                     response.get("insert") or \
-        #                     response.get("update") or \
-        #                     response.get("delete")
-        #
-        # if not target_collection:
-        #     return jsonify({"error": "Collection name not found in LLM response"}), 400
 
+def execute_mongo_command(response, db, db_name, user_input, collection_name=None, join_collection=None,
+                          generation_seconds=0.0, session_id=None):
+    """
+    (payload, status) for a handle_user_input response: runs find/aggregate commands on db,
+    answering from rollups where possible (shared with async_app.py).
+    """
+    db_mapping = get_db_mapping()
+    deepseek_handler = get_deepseek_handler()
+
+    if "error" in response:
+        return response, 400
+
+    # schema
+    if response.get("type") == "schema":
+        return response, 200
+
+    # target_collection = response.get("collection") or \
+    #                     response.get("find") or \
+    #                     response.get("insert") or \
+    #                     response.get("update") or \
+    #                     response.get("delete")
+    #
+    # if not target_collection:
+    #     return jsonify({"error": "Collection name not found in LLM response"}), 400
+
+    # collection = db[target_collection]
+
+    # query
+    if "command" in response:
+        # command = response["command"]
+        # target_collection = response.get("collection")
+        # if not target_collection:
+        #     return jsonify({"error": "Missing 'collection' field in response"}), 400
+        #
         # collection = db[target_collection]
-
-        # query
-        if "command" in response:
-            # command = response["command"]
-            # target_collection = response.get("collection")
-            # if not target_collection:
-            #     return jsonify({"error": "Missing 'collection' field in response"}), 400
-            #
-            # collection = db[target_collection]
-            target_collection = response.get("collection")
-            if not target_collection:
-                return jsonify({"error": "Missing 'collection' field in LLM response"}), 400
-
-            collection = db[target_collection]
-            command = response["command"]
-
-            # find
-            if "find" in command:
-                find_block = command["find"]
-                filter_ = find_block.get("filter", {})
-                projection = find_block.get("projection")
-                sort = find_block.get("sort")
-                limit = find_block.get("limit")
-
-                cursor = collection.find(filter_, projection)
-                if sort:
-                    cursor = cursor.sort(list(sort.items()))
-                if limit:
-                    cursor = cursor.limit(limit)
-
+        target_collection = response.get("collection")
+        if not target_collection:
+            return {"error": "Missing 'collection' field in LLM response"}, 400
+
+        collection = db[target_collection]
+        command = response["command"]
+        workload.record_query("mongodb", response)
+
+        # find
+        if "find" in command:
+            find_block = command["find"]
+            filter_ = find_block.get("filter", {})
+            projection = find_block.get("projection")
+            sort = find_block.get("sort")
+            limit = find_block.get("limit")
+
+            cursor = collection.find(filter_, projection)
+            if sort:
+                cursor = cursor.sort(list(sort.items()))
+            if limit:
+                cursor = cursor.limit(limit)
+
+            started = time.perf_counter()
+            with deadline.stage("mongodb"), admission.admit(f"mongodb:{db_name}"):
+                max_time_ms = deadline.max_time_ms()
+                if max_time_ms:
+                    cursor = cursor.max_time_ms(max_time_ms)
                 results = list(cursor)
-                return jsonify({"result": results}), 200
-
-            # aggregate
-            elif "aggregate" in command:
-                pipeline = command["aggregate"]
-                results = list(collection.aggregate(pipeline))
-                return jsonify({"result": results}), 200
-
-        # modify
-        elif response.get("type") == "modify":
-            return jsonify(response), 200
-
-        return jsonify({"error": "Unsupported operation type"}), 400
-
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+            workload.record_db("mongodb", time.perf_counter() - started, len(results))
+            deepseek_handler.learn_template(user_input, response, db_name, collection_name, join_collection,
+                                            generation_seconds)
+            return {"result": results, "summary": summarize_documents(results)["text"]}, 200
+
+        # aggregate
+        elif "aggregate" in command:
+            pipeline = command["aggregate"]
+            db_started = time.perf_counter()
+            with deadline.stage("mongodb"), admission.admit(f"mongodb:{db_name}"):
+                max_time_ms = deadline.max_time_ms()
+                # recurring $group shapes are answered from their materialized rollup
+                rollup = rollups.mongo.answer(db_mapping[db_name], db, target_collection, pipeline,
+                                              max_time_ms)
+                if rollup:
+                    results = rollup[1]
+                else:
+                    started = time.perf_counter()
+                    if max_time_ms:
+                        results = list(collection.aggregate(pipeline, maxTimeMS=max_time_ms))
+                    else:
+                        results = list(collection.aggregate(pipeline))
+                    rollups.mongo.observe(db_mapping[db_name], target_collection, pipeline,
+                                          time.perf_counter() - started)
+            workload.record_db("mongodb", time.perf_counter() - db_started, len(results))
+            deepseek_handler.learn_template(user_input, response, db_name, collection_name, join_collection,
+                                            generation_seconds)
+            payload = {"result": results, "summary": summarize_documents(results)["text"]}
+            if rollup:
+                payload["rollup"] = rollup[0]
+            return payload, 200
+
+    # modify
+    elif response.get("type") == "modify":
+        read_routing.sessions.record_write(session_id)
+        return response, 200
+
+    return {"error": "Unsupported operation type"}, 400
 
 
 @app.route("/query/sql", methods=["POST"])
@@ -175,12 +428,39 @@ def query_handler():
 
     question = data.get("user_input")
     database = data.get("db_name", "employees")
-    result = handle_query(question, database)
+    session_id = request_session_id(data)
+    # the local summary is the default explanation; "narrative": true asks the LLM instead
+    narrative = bool(data.get("narrative"))
+    result = coalesce_request("sql", data, lambda: handle_query(question, database, session_id, narrative))
 
     return Response(json.dumps(result, indent=2), content_type="application/json")
 
 
+@app.route("/query/federated", methods=["POST"])
+def query_federated():
+    data = request.get_json() or {}
+    question = data.get("user_input")
+    sql_db = data.get("sql_db", "employees")
+    mongo_db = data.get("mongo_db")
+    if not question or not mongo_db:
+        return jsonify({"error": "Missing 'user_input' or 'mongo_db' in request."}), 400
+    if mongo_db not in get_db_mapping():
+        return jsonify({"error": f"Invalid mongo_db. Available: {list(get_db_mapping().keys())}"}), 400
+    session_id = request_session_id(data)
+    mongo_database = (get_db_mapping() if read_routing.sessions.reads_pinned(session_id) else get_read_mapping())[mongo_db]
+    result = coalesce_request("federated", dict(data, db_name=f"{sql_db}+{mongo_db}"), lambda: handle_federated_query(
+        question, sql_db, mongo_db, get_deepseek_handler(), mongo_database, session_id))
+    status = 400 if "error" in result else 200
+    return Response(json.dumps(result, indent=2, default=str), status=status, content_type="application/json")
+
+
+startup.record_import(time.perf_counter() - _import_started)
+
+
 if __name__ == '__main__':
+    # with the debug reloader only the child process serves requests
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        startup.start_warm_up()
     app.run(host='0.0.0.0', port=8080, debug=True)
 
 
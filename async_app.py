@@ -0,0 +1,478 @@
+import time
+_import_started = time.perf_counter()
+
+import asyncio
+import contextvars
+import functools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from quart import Quart, request, jsonify, Response, g
+from quart_cors import cors
+
+import admission
+import app as sync_app
+import deadline
+import nl2sql_v2
+import prompt_sessions
+import read_routing
+import singleflight
+import startup
+import workload
+from federated import handle_federated_query
+from mongodb_component.deepseekHandler import query_task, parse_query_response, strip_markdown
+from mongodb_component.intentHandler import classify_intent, is_read_request
+from query_templates import template_store
+from startup import lazy_import
+
+# Async serving mode: the API of app.py on one asyncio event loop per process.
+#
+#   hypercorn async_app:app --bind 0.0.0.0:8080 --workers 4
+#
+# app.py holds a server thread for every request, including the seconds spent waiting for an LLM.
+# Here the LLM calls (Ollama through ollama.AsyncClient, DeepSeek through openai.AsyncOpenAI) are
+# awaited, so a request waiting for a generation is a suspended coroutine and one process can keep
+# thousands of them open, while the admission limits (admission.admit_async) still bound what
+# reaches the models. Everything else runs the steps of app.py / nl2sql_v2.py themselves in a
+# thread (in_thread): schema loading, templates, execution with KILL QUERY and MAX_EXECUTION_TIME,
+# rollups, read-your-writes and catalog invalidation, so the two modes cannot drift apart.
+# Independent stages still overlap: the MongoDB ping with query generation, and with
+# CHATDB_SQL_GENERATION=staged the MySQL schema load with intent classification.
+#
+# A client that disconnects makes Quart cancel the request task. The cancellation reaches the
+# awaited LLM call directly; for thread work it cancels the request's deadline, which fires the
+# same KILL QUERY / stage checks as a disconnect in app.py.
+
+ASYNC_THREADS = int(os.environ.get("CHATDB_ASYNC_THREADS", "64"))
+
+# imported on first use to keep app start-up fast
+ollama = lazy_import("ollama")
+openai = lazy_import("openai")
+
+app = cors(Quart(__name__))
+
+# Async clients belong to the event loop that created them; rebuilt for a new loop or process
+_loop_state = {}
+
+
+def _clients() -> dict:
+    loop = asyncio.get_running_loop()
+    if _loop_state.get("loop") is not loop:
+        # the DeepSeek settings (key, base url) come from the threaded handler
+        deepseek = sync_app.get_deepseek_handler().client
+        _loop_state.clear()
+        _loop_state.update(
+            loop=loop,
+            ollama=ollama.AsyncClient(host=nl2sql_v2.OLLAMA_HOST),
+            deepseek=openai.AsyncOpenAI(api_key=deepseek.api_key, base_url=deepseek.base_url),
+        )
+    return _loop_state
+
+
+async def in_thread(fn, *args):
+    """
+    asyncio.to_thread (3.9+) for the shared pipeline steps. The thread sees the request's deadline and
+    admission context; if the request task is cancelled (the client disconnected), the deadline
+    is cancelled too, so a running statement is killed and the next stage check stops the thread.
+    """
+    try:
+        call = functools.partial(contextvars.copy_context().run, fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+    except asyncio.CancelledError:
+        d = deadline.current.get()
+        if d is not None:
+            d.cancel("client disconnected")
+        raise
+
+
+@asynccontextmanager
+async def stage(name: str):
+    """deadline.stage() for coroutines: the stage is cancelled once the request's time is up."""
+    with deadline.stage(name):
+        left = deadline.remaining()
+        if left is None:
+            yield
+            return
+        # asyncio.timeout() is 3.11+: cancel the task from a timer and tell that apart from a disconnect
+        task, expired = asyncio.current_task(), []
+
+        def expire():
+            expired.append(True)
+            task.cancel()
+
+        timer = asyncio.get_running_loop().call_later(left, expire)
+        try:
+            yield
+        except asyncio.CancelledError:
+            if expired:
+                raise deadline.DeadlineExceeded(name)
+            raise
+        finally:
+            timer.cancel()
+
+
+@app.before_serving
+async def begin_serving():
+    # database work runs in threads; a request waiting for a database slot holds one of them
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=ASYNC_THREADS, thread_name_prefix="chatdb-async"))
+    # warms the caches shared with the threaded handlers (MySQL schemas, MongoDB catalog, llama3)
+    startup.start_warm_up()
+
+
+@app.before_request
+async def begin_request():
+    g.request_started = time.perf_counter()
+    # same priority, queue budget and deadline as app.begin_request; a client that disconnects
+    # cancels the request task (Quart has no socket to watch), and in_thread passes that on to
+    # the deadline
+    body = await request.get_json(silent=True) if request.is_json else None
+    priority = request.headers.get("X-Priority") or (body or {}).get("priority") or "default"
+    admission.request_priority.set(priority if priority in admission.PRIORITIES else "default")
+    try:
+        budget = float(request.headers.get("X-Queue-Budget", admission.DEFAULT_QUEUE_BUDGET))
+    except ValueError:
+        budget = admission.DEFAULT_QUEUE_BUDGET
+    admission.request_budget.set(budget)
+    try:
+        deadline_ms = float(request.headers.get("X-Deadline-Ms") or (body or {}).get("deadline_ms") or 0)
+    except (TypeError, ValueError):
+        deadline_ms = 0
+    deadline.current.set(deadline.Deadline(deadline_ms / 1000 if deadline_ms > 0 else deadline.DEFAULT_DEADLINE_SECONDS))
+    if request.path.startswith("/query"):
+        workload.begin(request.path, body, request.headers)
+
+
+@app.after_request
+async def end_request(response):
+    if "request_started" in g and request.path.startswith("/query"):
+        startup.record_first_request(request.path, time.perf_counter() - g.request_started)
+    workload.finish(response.status_code, len(await response.get_data()))
+    return response
+
+
+@app.errorhandler(deadline.DeadlineExceeded)
+async def deadline_exceeded(e):
+    status = 499 if isinstance(e, deadline.Cancelled) else 504
+    return jsonify({"error": str(e), "deadline_stage": e.stage}), status
+
+
+@app.errorhandler(admission.Overloaded)
+async def overloaded(e):
+    response = jsonify({"error": str(e), "backend": e.backend, "reason": e.reason})
+    response.status_code = e.status
+    response.headers["Retry-After"] = str(max(1, int(round(e.retry_after))))
+    return response
+
+
+def request_session_id(data):
+    return request.headers.get("X-Session-Id") or (data or {}).get("session_id")
+
+
+async def coalesce_request(engine, data, fn):
+    """app.coalesce_request for coroutines: identical concurrent reads share one execution."""
+    key = sync_app.coalesce_key(engine, data or {}, request_session_id(data))
+    if key is None:
+        return await fn()
+    return await singleflight.group("requests").do_async(key, fn)
+
+
+def json_response(payload, status=200):
+    return Response(json.dumps(payload, indent=2, default=str), status=status, content_type="application/json")
+
+
+# --- LLM calls ---
+
+async def llm_chat(messages, **options):
+    options.setdefault("keep_alive", nl2sql_v2.LLM_KEEP_ALIVE)
+    # identical prompts in flight at the same time share one generation
+    key = json.dumps([messages, options], sort_keys=True, default=str)
+    return await singleflight.group("ollama").do_async(key, lambda: _admitted_chat(messages, options))
+
+
+async def _admitted_chat(messages, options):
+    async with stage("ollama"), admission.admit_async("ollama"):
+        started = time.perf_counter()
+        response = await _clients()["ollama"].chat(model=nl2sql_v2.LLM_MODEL, messages=messages, **options)
+        workload.record_llm("ollama", messages, response['message']['content'], time.perf_counter() - started,
+                            response.get("prompt_eval_count"), response.get("eval_count"))
+        return response
+
+
+async def session_chat(conversation, prefix, suffix, format=None, record=True):
+    messages = conversation.messages(prefix, suffix)
+    options = {}
+    if format is not None:
+        options["format"] = format
+    if conversation.persistent:
+        options["keep_alive"] = f"{int(prompt_sessions.SESSION_TTL_SECONDS)}s"
+    response = await llm_chat(messages, **options)
+    prompt_sessions.record_ollama_usage(messages, response)
+    answer = response['message']['content'].strip()
+    if record:
+        conversation.record(suffix, answer)
+    return answer
+
+
+async def classify_sql_intent(query):
+    response = await llm_chat(nl2sql_v2.intent_messages(query))
+    return nl2sql_v2.parse_intent(response['message']['content'])
+
+
+async def generate_json(prefix, prompt, conversation):
+    messages = conversation.messages(prefix, prompt)
+    response = await singleflight.group("deepseek").do_async(json.dumps(messages), lambda: _complete_json(messages))
+    if not response.startswith("Error calling DeepSeek"):
+        conversation.record(prompt, response)
+    return response
+
+
+async def _complete_json(messages):
+    try:
+        async with stage("deepseek"), admission.admit_async("deepseek"):
+            started = time.perf_counter()
+            response = await _clients()["deepseek"].chat.completions.create(
+                model=sync_app.get_deepseek_handler().model, messages=messages,
+                response_format={"type": "json_object"})
+        usage = getattr(response, "usage", None)
+        workload.record_llm("deepseek", messages, response.choices[0].message.content, time.perf_counter() - started,
+                            getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None))
+        prompt_sessions.record_deepseek_usage(response)
+        return strip_markdown(response.choices[0].message.content)
+    except (admission.Overloaded, deadline.DeadlineExceeded):
+        raise
+    except Exception as e:
+        return f"Error calling DeepSeek: {str(e)}"
+
+
+# --- MySQL ---
+
+def _with_connection(database, role, fn):
+    conn = nl2sql_v2.connect_to_db(database, role)
+    try:
+        return fn(conn)
+    finally:
+        conn.close()
+
+
+async def handle_sql_query(query, database, session_id=None, narrative=False):
+    """nl2sql_v2._dispatch with the LLM calls awaited and its other steps run in threads."""
+    namespace = ("sql", database)
+    role = "primary" if read_routing.sessions.reads_pinned(session_id) else "replica"
+
+    def on_connection(fn, *args, **kwargs):
+        return in_thread(_with_connection, database, role, lambda conn: fn(*args, conn=conn, **kwargs))
+
+    started = time.perf_counter()
+    staged = nl2sql_v2.SQL_GENERATION != "structured"
+    intent = None
+    # a learned template answers questions the keyword rules see as reads, without any LLM call
+    templated = template_store.matches(namespace, query) and is_read_request(query)
+    if nl2sql_v2.cached_schema(database) is None and staged and not templated:
+        # the intent does not depend on the schema: classify while the schema loads
+        (schema_info, resolved), intent = await asyncio.gather(
+            on_connection(nl2sql_v2.prepare_query, query, database), classify_sql_intent(query))
+    else:
+        schema_info, resolved = await on_connection(nl2sql_v2.prepare_query, query, database)
+    if resolved:
+        return resolved
+
+    # fast path: a learned template binds the new constants instead of generating SQL
+    if templated:
+        result = await on_connection(nl2sql_v2.answer_from_template, query, namespace,
+                                     schema_info=schema_info, narrative=narrative)
+        if result:
+            return result
+
+    prefix = nl2sql_v2.sql_prompt_prefix(database, schema_info)
+    conversation = prompt_sessions.sessions.get(session_id, namespace)
+    # a follow-up only makes sense with the earlier turns; it must not become a template
+    follow_up = bool(conversation.turns)
+    generated = None
+    if not staged and intent is None:
+        suffix = nl2sql_v2.structured_task(query, narrative)
+        reply = await session_chat(conversation, prefix, suffix, format=nl2sql_v2.sql_response_schema(narrative),
+                                   record=False)
+        generated = nl2sql_v2.parse_structured(reply)
+        if generated:
+            conversation.record(suffix, reply)
+    if generated:
+        intent = generated["intent"]
+    elif intent is None:
+        intent = await classify_sql_intent(query)
+
+    if intent == "schema":
+        if generated:
+            return {"answer": generated["answer"]}
+        return {"answer": await session_chat(conversation, prefix, nl2sql_v2.SCHEMA_TASK.format(query=query))}
+    elif intent == "query":
+        sql = generated["sql"] if generated else \
+            await session_chat(conversation, prefix, nl2sql_v2.SELECT_TASK.format(query=query))
+    elif intent == "modification":
+        sql = generated["sql"] if generated else \
+            await session_chat(conversation, prefix, nl2sql_v2.MODIFY_TASK.format(query=query))
+    else:
+        return {"error": f"Unrecognized request type: {intent}"}
+    return await on_connection(nl2sql_v2.run_generated, query, database, schema_info=schema_info, intent=intent,
+                               sql=sql, explanation_template=generated["explanation"] if generated else None,
+                               generation_seconds=time.perf_counter() - started, follow_up=follow_up,
+                               session_id=session_id, narrative=narrative)
+
+
+# --- MongoDB ---
+
+async def generate_mongo_query(user_input, db_name, collection_name=None, join_collection=None, session_id=None):
+    """DeepSeekHandler.handle_query with the DeepSeek call awaited."""
+    handler = sync_app.get_deepseek_handler()
+    # fast path for reads: bind the constants into a learned query template, no LLM call
+    parsed = handler.template_hit(user_input, db_name, collection_name, join_collection)
+    if parsed:
+        return parsed
+    # the schema sampling and its catalog cache are the threaded handler's
+    prefix = await in_thread(lambda: handler.prompt_prefix(
+        db_name, handler.prompt_collections(db_name, collection_name, join_collection)))
+    conversation = prompt_sessions.sessions.get(session_id, ("mongodb", db_name))
+    # a follow-up only makes sense with the earlier turns; it must not become a template
+    follow_up = bool(conversation.turns)
+    response = await generate_json(prefix, query_task(user_input), conversation)
+    print("Raw LLM response:", response)
+    return parse_query_response(response, follow_up)
+
+
+async def run_mongodb_query(data):
+    """app.run_mongodb_query with the DeepSeek call awaited; the command runs app.execute_mongo_command."""
+    try:
+        db_mapping = sync_app.get_db_mapping()
+        deepseek_handler = sync_app.get_deepseek_handler()
+
+        user_input = data.get('user_input')
+        db_name = data.get('db_name')
+        collection_name = data.get('collection')  # optional
+        join_collection = data.get('join_collection')  # optional
+        session_id = request_session_id(data)  # optional, enables read-your-writes
+
+        if not user_input or not db_name:
+            return {"error": "Missing 'user_input' or 'db_name' in request."}, 400
+        if db_name not in db_mapping:
+            return {"error": f"Invalid db_name. Available: {list(db_mapping.keys())}"}, 400
+
+        # reads go to secondaries unless this session just wrote
+        if read_routing.sessions.reads_pinned(session_id):
+            db = db_mapping[db_name]
+        else:
+            db = sync_app.get_read_mapping()[db_name]
+
+        ping = sync_app.get_mongo_client().admin.command
+        started = time.perf_counter()
+        if classify_intent(user_input) == "query":
+            generation = generate_mongo_query(user_input, db_name, collection_name, join_collection, session_id)
+        else:
+            # schema questions and modifications use the threaded handler
+            generation = in_thread(deepseek_handler.handle_user_input, user_input, db_name, collection_name,
+                                   join_collection, session_id)
+        # the health check runs alongside the generation instead of before it
+        _, response = await asyncio.gather(in_thread(ping, 'ping'), generation)
+        generation_seconds = time.perf_counter() - started
+        print("LLM response:", response)
+
+        return await in_thread(sync_app.execute_mongo_command, response, db, db_name, user_input, collection_name,
+                               join_collection, generation_seconds, session_id)
+
+    except (admission.Overloaded, deadline.DeadlineExceeded):
+        raise
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+
+# --- routes ---
+
+@app.route('/', methods=['GET'])
+async def home():
+    return "Welcome to ChatDB API!", 200
+
+
+@app.route('/check_connection', methods=['GET'])
+async def check_connection():
+    def mysql_ping(conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT 1;")
+            cursor.fetchall()
+        finally:
+            cursor.close()
+
+    checks = {
+        "mongodb": in_thread(sync_app.get_mongo_client().admin.command, 'ping'),
+        "mysql": in_thread(_with_connection, nl2sql_v2.MYSQL_DATABASES[0], "primary", mysql_ping),
+        "ollama": _clients()["ollama"].ps(),
+    }
+    outcomes = await asyncio.gather(*checks.values(), return_exceptions=True)
+    report = {name: f"error: {outcome}" if isinstance(outcome, BaseException) else "ok"
+              for name, outcome in zip(checks, outcomes)}
+    return jsonify(report), 200 if all(v == "ok" for v in report.values()) else 500
+
+
+@app.route('/ready', methods=['GET'])
+async def ready():
+    report = startup.report()
+    return jsonify(report), 200 if report["ready"] else 503
+
+
+@app.route('/session/reset', methods=['POST'])
+async def reset_session():
+    session_id = request_session_id(await request.get_json(silent=True))
+    if not session_id:
+        return jsonify({"error": "Missing X-Session-Id header or 'session_id' field"}), 400
+    prompt_sessions.sessions.clear(session_id)
+    return jsonify({"session_id": session_id, "status": "reset"}), 200
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return jsonify(sync_app.metrics_report()), 200
+
+
+@app.route('/query/mongodb', methods=['POST'])
+async def query_mongodb():
+    data = await request.get_json()
+    payload, status = await coalesce_request("mongodb", data, lambda: run_mongodb_query(data))
+    return json_response(payload, status)
+
+
+@app.route("/query/sql", methods=["POST"])
+async def query_handler():
+    data = await request.get_json()
+    question = data.get("user_input")
+    database = data.get("db_name", "employees")
+    session_id = request_session_id(data)
+    narrative = bool(data.get("narrative"))
+    result = await coalesce_request("sql", data, lambda: handle_sql_query(question, database, session_id, narrative))
+    return json_response(result)
+
+
+@app.route("/query/federated", methods=["POST"])
+async def query_federated():
+    data = await request.get_json() or {}
+    question = data.get("user_input")
+    sql_db = data.get("sql_db", "employees")
+    mongo_db = data.get("mongo_db")
+    if not question or not mongo_db:
+        return jsonify({"error": "Missing 'user_input' or 'mongo_db' in request."}), 400
+    if mongo_db not in sync_app.get_db_mapping():
+        return jsonify({"error": f"Invalid mongo_db. Available: {list(sync_app.get_db_mapping().keys())}"}), 400
+    session_id = request_session_id(data)
+    mapping = sync_app.get_db_mapping() if read_routing.sessions.reads_pinned(session_id) else sync_app.get_read_mapping()
+    # the streaming hash join runs on the threaded drivers
+    result = await coalesce_request("federated", dict(data, db_name=f"{sql_db}+{mongo_db}"), lambda: in_thread(
+        handle_federated_query, question, sql_db, mongo_db, sync_app.get_deepseek_handler(), mapping[mongo_db],
+        session_id))
+    return json_response(result, 400 if "error" in result else 200)
+
+
+startup.record_import(time.perf_counter() - _import_started)
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=int(os.environ.get("CHATDB_PORT", "8080")))
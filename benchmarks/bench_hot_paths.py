@@ -0,0 +1,271 @@
+"""
+Microbenchmarks for the pure-Python functions that run on every request.
+
+Inputs are built from the bundled Datasets/ (nested NobelPrize documents, WorldData cities and
+countries, the sakila schema); no database or LLM is needed. Each case reports the median time
+per call over --repeat runs, the run-to-run spread of that time, and the peak memory allocated per
+call, and is compared against benchmarks/baseline.json.
+
+    python benchmarks/bench_hot_paths.py --update-baseline  # record numbers on this machine first
+    python benchmarks/bench_hot_paths.py                    # compare, exit 1 on regression
+    python benchmarks/bench_hot_paths.py --filter schema --threshold 0.5
+
+The baseline is machine specific and is not committed: record your own before changing the code.
+A time only counts as a regression when it is worse by more than --threshold and by more than
+three times the spread measured in either run, so an unchanged tree passes on a noisy machine.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import timeit
+import tracemalloc
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mongodb_component.deepseekHandler import (flatten_fields, format_schema_info, convert_object_ids,
+                                               stringify_object_ids)
+from mongodb_component.intentHandler import classify_intent
+from mongodb_component.schema_tool import parse_doc
+from nl2sql_v2 import enforce_limit, validate_safe_sql
+from result_summary import summarize_documents
+
+DATASETS = os.path.join(ROOT, "Datasets")
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+
+# --- inputs ---
+
+def load_json_array(path):
+    # NobelPrize.json is one big array; decode it document by document like mongoimport does
+    text = open(path, encoding="utf-8").read()
+    decoder = json.JSONDecoder()
+    docs, pos = [], 0
+    while True:
+        while pos < len(text) and text[pos] in " \n\r\t,[":
+            pos += 1
+        if pos >= len(text) or text[pos] == "]":
+            return docs
+        doc, pos = decoder.raw_decode(text, pos)
+        docs.append(doc)
+
+
+def load_ndjson(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_sql_tables(path):
+    """{table: [(column, type), ...]} from the CREATE TABLE statements of a dump."""
+    tables = {}
+    for name, body in re.findall(r"CREATE TABLE `?(\w+)`?\s*\((.*?)\n\)", open(path, encoding="utf-8").read(), re.S):
+        columns = []
+        for line in body.splitlines():
+            m = re.match(r"\s*`?(\w+)`?\s+([A-Z]+(?:\([^)]*\))?(?: UNSIGNED)?)", line)
+            if m and m.group(1).upper() not in ("PRIMARY", "KEY", "UNIQUE", "CONSTRAINT", "INDEX", "FULLTEXT"):
+                columns.append((m.group(1), m.group(2).lower()))
+        tables[name] = columns
+    return tables
+
+
+QUESTIONS = [
+    "show all collections in this database",
+    "what fields does the laureates collection have",
+    "find laureates who won the physics prize in 2020",
+    "how many prizes were awarded in chemistry",
+    "list the top 10 most populated cities in Japan",
+    "update the population of Kabul to 1800000",
+    "give me the average life expectancy per continent",
+    "delete all cities with population below 1000",
+    "which films have a rating of PG-13 and length over 120 minutes",
+    "show 5 sample documents from country",
+    "what is the total payment amount per customer",
+    "tell me something interesting",
+]
+
+
+def build_inputs():
+    nobel = load_json_array(os.path.join(DATASETS, "MongoDB", "NobelPrize", "NobelPrize.json"))
+    cities = load_ndjson(os.path.join(DATASETS, "MongoDB", "WorldData", "city.json"))
+    countries = load_ndjson(os.path.join(DATASETS, "MongoDB", "WorldData", "country.json"))
+    sakila = load_sql_tables(os.path.join(DATASETS, "Mysql", "sakila-mv-schema.sql"))
+
+    # schema_info as get_structured_schema builds it, from 10 sampled documents per collection
+    schema_info = {"collections": {}, "relationships": []}
+    for name, docs in (("laureates", nobel), ("city", cities), ("country", countries)):
+        fields = {}
+        for doc in docs[:10]:
+            parse_doc(doc, fields, set())
+        schema_info["collections"][name] = {"fields": fields, "indexes": ["_id_"]}
+    schema_info["relationships"].append({"from": "city.CountryCode", "to": "country._id"})
+
+    # generated queries in extended JSON, the way DeepSeek returns them
+    mongo_queries = []
+    for i, doc in enumerate(nobel[:50]):
+        mongo_queries.append({
+            "filter": {"_id": {"$oid": f"{i:024x}"}, "year": doc.get("year"), "category": doc.get("category")},
+            "pipeline": [{"$match": {"laureates.id": {"$in": [l.get("id") for l in doc.get("laureates", [])]}}},
+                         {"$lookup": {"from": "city", "localField": "ref", "foreignField": "_id", "as": "c"}}],
+            "update": {"$set": {"ref": {"$oid": f"{i + 1:024x}"}}},
+        })
+
+    selects = []
+    for table, columns in sakila.items():
+        names = [c for c, _ in columns]
+        selects.append(f"SELECT {', '.join(names)} FROM {table} WHERE {names[0]} > 10 ORDER BY {names[-1]};")
+        selects.append(f"SELECT COUNT(*) FROM {table} LIMIT 5;")
+        selects.append(f"UPDATE {table} SET {names[-1]} = NOW() WHERE {names[0]} = 1;")
+
+    return {
+        "nobel": nobel, "cities": cities, "schema_info": schema_info,
+        "mongo_queries": mongo_queries, "converted": [convert_object_ids(q) for q in mongo_queries],
+        "selects": selects,
+    }
+
+
+# --- cases: each runs over a whole batch of realistic inputs ---
+
+def build_cases(inputs):
+    nobel = inputs["nobel"][:100]
+    cities = inputs["cities"][:500]
+
+    def run_classify_intent():
+        # classify_intent prints its decision; keep that out of the terminal but inside the measurement
+        with redirect_stdout(_NULL):
+            for q in QUESTIONS:
+                classify_intent(q)
+
+    def run_parse_doc():
+        fields = {}
+        for doc in nobel:
+            parse_doc(doc, fields, set())
+
+    def run_flatten_fields():
+        out = {}
+        for doc in nobel:
+            flatten_fields(doc, out=out)
+        for doc in cities:
+            flatten_fields(doc, out=out)
+
+    def run_format_schema_info():
+        format_schema_info(inputs["schema_info"])
+
+    def run_convert_object_ids():
+        for q in inputs["mongo_queries"]:
+            convert_object_ids(q)
+
+    def run_stringify_object_ids():
+        for q in inputs["converted"]:
+            stringify_object_ids(q)
+
+    def run_summarize_documents():
+        summarize_documents(cities)
+
+    def run_sql_guards():
+        for sql in inputs["selects"]:
+            validate_safe_sql(enforce_limit(sql))
+
+    return {
+        "classify_intent": run_classify_intent,
+        "parse_doc": run_parse_doc,
+        "flatten_fields": run_flatten_fields,
+        "format_schema_info": run_format_schema_info,
+        "convert_object_ids": run_convert_object_ids,
+        "stringify_object_ids": run_stringify_object_ids,
+        "summarize_documents": run_summarize_documents,
+        "enforce_limit+validate_safe_sql": run_sql_guards,
+    }
+
+
+class _NullWriter(io.TextIOBase):
+    def write(self, s):
+        return len(s)
+
+
+_NULL = _NullWriter()
+
+
+# --- measurement ---
+
+def measure(fn, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    runs = sorted(t / number for t in timer.repeat(repeat=repeat, number=number))
+    # the median is stable between invocations where the single fastest run is not;
+    # the interquartile range relative to it is the noise of this machine for this case
+    median = statistics.median(runs)
+    quartiles = statistics.quantiles(runs, n=4)
+    spread = (quartiles[2] - quartiles[0]) / median if median else 0.0
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"us_per_call": round(median * 1e6, 2), "spread": round(spread, 3), "peak_kib": round(peak / 1024, 1)}
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            print(f"  {name}: no baseline")
+            continue
+        noise = 3 * max(base.get("spread", 0.0), result["spread"])
+        for metric, allowed, slack in (("us_per_call", max(threshold, noise), 0.0), ("peak_kib", threshold, 1.0)):
+            # small absolute slack so rounding of tiny peaks does not count as a regression
+            if base[metric] and result[metric] > base[metric] * (1 + allowed) + slack:
+                change = result[metric] / base[metric] - 1
+                regressions.append(f"{name} {metric}: {base[metric]} -> {result[metric]} "
+                                   f"(+{change:.0%}, allowed +{allowed:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pure-Python hot paths")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown/growth ratio (0.25 = 25%%)")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this text")
+    parser.add_argument("--repeat", type=int, default=15)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    cases = {name: fn for name, fn in build_cases(build_inputs()).items() if args.filter in name}
+    results = {}
+    for name, fn in cases.items():
+        results[name] = measure(fn, args.repeat)
+        print(f"{name:34s} {results[name]['us_per_call']:>12.2f} us/call (+-{results[name]['spread']:.0%}) "
+              f"{results[name]['peak_kib']:>10.1f} KiB peak")
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            baseline = json.load(open(args.baseline)).get("cases", {})
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "cases": baseline},
+                      f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline yet; run with --update-baseline first.")
+        return 0
+    regressions = compare(results, json.load(open(args.baseline))["cases"], args.threshold)
+    if regressions:
+        print("Regressions:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"No regressions beyond {args.threshold:.0%}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
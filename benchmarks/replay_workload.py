@@ -0,0 +1,303 @@
+"""
+Replay a captured workload (see workload.py) against a running ChatDB server.
+
+Requests are re-sent with their original bodies, headers and pacing. LLM calls are answered by a
+local stand-in that serves the recorded Ollama and DeepSeek replies, looked up by prompt hash, so
+two runs see the same generated queries and differ only in the database and serving side.
+
+    # capture in production: CHATDB_CAPTURE=/var/log/chatdb-capture CHATDB_CAPTURE_SAMPLE=0.1
+
+    # point the server under test at the stand-in, then replay
+    OLLAMA_HOST=http://127.0.0.1:11500 DEEPSEEK_BASE_URL=http://127.0.0.1:11500 python app.py
+    python benchmarks/replay_workload.py replay capture/ --serve-llm 11500 --out before.json
+    ... change the server, restart it ...
+    python benchmarks/replay_workload.py replay capture/ --serve-llm 11500 --out after.json
+    python benchmarks/replay_workload.py compare before.json after.json
+
+    # the stand-in on its own
+    python benchmarks/replay_workload.py serve-llm capture/ --port 11500
+
+Replies are matched on the hash of the whole prompt first and on the last message alone second, so
+a changed schema prefix still gets its recorded answer. Unknown prompts get a 404 and are counted.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from workload import prompt_key
+
+
+# --- captured records ---
+
+def load_records(paths):
+    """Captured requests from files or capture directories, oldest first."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(glob.glob(os.path.join(path, "workload-*.jsonl*")))
+        else:
+            files.append(path)
+    records = []
+    for name in files:
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass  # a line cut short by a crash or a rotation
+    records.sort(key=lambda r: r.get("ts", 0))
+    return records
+
+
+# --- LLM stand-in ---
+
+class RecordedReplies:
+    def __init__(self, records, latency_scale: float = 1.0):
+        self.latency_scale = latency_scale
+        self.by_key = {}
+        self.by_last_key = {}
+        self.positions = {}
+        self.stats = {"exact": 0, "last_message": 0, "missing": 0}
+        self._lock = threading.Lock()
+        for record in records:
+            for event in record.get("llm", []):
+                self.by_key.setdefault((event["backend"], event["key"]), []).append(event)
+                self.by_last_key.setdefault((event["backend"], event["last_key"]), []).append(event)
+
+    def find(self, backend: str, messages: list):
+        """The next recorded reply for this prompt; repeated prompts cycle through their recordings."""
+        with self._lock:
+            for kind, index, key in (("exact", self.by_key, prompt_key(messages)),
+                                     ("last_message", self.by_last_key, prompt_key(messages[-1:]))):
+                events = index.get((backend, key))
+                if events:
+                    position = self.positions.get((kind, backend, key), 0)
+                    self.positions[(kind, backend, key)] = position + 1
+                    self.stats[kind] += 1
+                    return events[position % len(events)]
+            self.stats["missing"] += 1
+            return None
+
+    def wait(self, event):
+        # keep the recorded generation time so the server sees the same traffic shape
+        if self.latency_scale > 0:
+            time.sleep(event["ms"] / 1000 * self.latency_scale)
+
+
+def make_handler(replies: RecordedReplies):
+    class StandInHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, payload: dict):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self) -> dict:
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_GET(self):
+            if self.path in ("/api/ps", "/api/tags"):
+                return self._send(200, {"models": []})
+            self._send(404, {"error": f"not found: {self.path}"})
+
+        def do_POST(self):
+            body = self._body()
+            if self.path == "/api/generate":
+                # warm-up call: nothing to load
+                return self._send(200, {"model": body.get("model"), "response": "", "done": True})
+            if self.path == "/api/chat":
+                event = replies.find("ollama", body.get("messages", []))
+                if event is None:
+                    return self._send(404, {"error": "no recorded reply for this prompt"})
+                replies.wait(event)
+                return self._send(200, {
+                    "model": body.get("model"),
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                    "message": {"role": "assistant", "content": event["reply"]},
+                    "done": True,
+                    "done_reason": "stop",
+                    "prompt_eval_count": event.get("prompt_tokens"),
+                    "eval_count": event.get("completion_tokens"),
+                })
+            if self.path in ("/chat/completions", "/v1/chat/completions"):
+                event = replies.find("deepseek", body.get("messages", []))
+                if event is None:
+                    return self._send(404, {"error": {"message": "no recorded reply for this prompt"}})
+                replies.wait(event)
+                prompt_tokens = event.get("prompt_tokens") or 0
+                completion_tokens = event.get("completion_tokens") or 0
+                return self._send(200, {
+                    "id": f"replay-{event['key']}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": event["reply"]}}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                              "total_tokens": prompt_tokens + completion_tokens},
+                })
+            self._send(404, {"error": f"not found: {self.path}"})
+
+    return StandInHandler
+
+
+def start_stand_in(replies: RecordedReplies, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), make_handler(replies))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"LLM stand-in on http://{host}:{port} "
+          f"(OLLAMA_HOST=http://{host}:{port} DEEPSEEK_BASE_URL=http://{host}:{port})")
+    return server
+
+
+# --- replay ---
+
+def send(target: str, record: dict, timeout: float) -> dict:
+    data = json.dumps(record.get("request") or {}).encode("utf-8")
+    headers = dict(record.get("headers") or {}, **{"Content-Type": "application/json"})
+    req = urllib.request.Request(target.rstrip("/") + record["path"], data=data, headers=headers, method="POST")
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            status, size = response.status, len(response.read())
+    except urllib.error.HTTPError as e:
+        status, size = e.code, len(e.read())
+    except OSError as e:
+        status, size = 0, 0
+        print(f"  {record['path']}: {e}")
+    return {"path": record["path"], "status": status, "bytes": size,
+            "ms": round((time.perf_counter() - started) * 1000, 1),
+            "captured_status": record.get("status"), "captured_ms": record.get("ms")}
+
+
+def replay(records, target: str, speed: float, concurrency: int, timeout: float) -> list:
+    """Send every record; speed 1.0 keeps the captured inter-arrival times, 0 sends as fast as possible."""
+    results = [None] * len(records)
+    first_ts = records[0].get("ts", 0) if records else 0
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = []
+        for i, record in enumerate(records):
+            if speed > 0:
+                delay = (record.get("ts", first_ts) - first_ts) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append((i, pool.submit(send, target, record, timeout)))
+        for i, future in futures:
+            results[i] = future.result()
+    return results
+
+
+def percentile(values, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(results: list, records: list) -> dict:
+    replayed = [r["ms"] for r in results]
+    captured = [r["captured_ms"] for r in results if r["captured_ms"] is not None]
+    db_ms = [e["ms"] for record in records for e in record.get("db", [])]
+    summary = {
+        "requests": len(results),
+        "errors": sum(1 for r in results if r["status"] == 0 or r["status"] >= 500),
+        "status_changed": sum(1 for r in results if r["captured_status"] is not None
+                              and r["status"] != r["captured_status"]),
+        "bytes": sum(r["bytes"] for r in results),
+        "captured_db_ms_total": round(sum(db_ms), 1),
+    }
+    for name, values in (("ms", replayed), ("captured_ms", captured)):
+        for q in (0.5, 0.95, 0.99):
+            summary[f"{name}_p{int(q * 100)}"] = percentile(values, q)
+        summary[f"{name}_max"] = max(values) if values else None
+    return summary
+
+
+def compare(before: dict, after: dict):
+    print(f"{'metric':24s} {'before':>12s} {'after':>12s} {'change':>9s}")
+    for metric, value in before["summary"].items():
+        other = after["summary"].get(metric)
+        change = f"{other / value - 1:+.0%}" if isinstance(value, (int, float)) and value and other is not None else ""
+        print(f"{metric:24s} {str(value):>12s} {str(other):>12s} {change:>9s}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured ChatDB traffic with recorded LLM replies")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve-llm", help="only run the LLM stand-in")
+    serve.add_argument("capture", nargs="+", help="capture files or directories")
+    serve.add_argument("--port", type=int, default=11500)
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--latency-scale", type=float, default=1.0, help="1 = recorded LLM latency, 0 = none")
+
+    run = commands.add_parser("replay", help="re-send the captured requests")
+    run.add_argument("capture", nargs="+", help="capture files or directories")
+    run.add_argument("--target", default="http://localhost:8080")
+    run.add_argument("--serve-llm", type=int, metavar="PORT", help="also run the LLM stand-in on this port")
+    run.add_argument("--latency-scale", type=float, default=1.0, help="1 = recorded LLM latency, 0 = none")
+    run.add_argument("--speed", type=float, default=1.0, help="arrival rate multiplier; 0 = as fast as possible")
+    run.add_argument("--concurrency", type=int, default=32, help="requests in flight at most")
+    run.add_argument("--timeout", type=float, default=300)
+    run.add_argument("--out", help="write per-request results and the summary here (JSON)")
+
+    diff = commands.add_parser("compare", help="compare two --out files")
+    diff.add_argument("before")
+    diff.add_argument("after")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(json.load(open(args.before)), json.load(open(args.after)))
+        return 0
+
+    records = load_records(args.capture)
+    replies = RecordedReplies(records, args.latency_scale)
+    print(f"Loaded {len(records)} requests with {sum(len(r.get('llm', [])) for r in records)} LLM replies")
+
+    if args.command == "serve-llm":
+        server = start_stand_in(replies, args.port, args.host)
+        try:
+            while True:
+                time.sleep(60)
+                print(f"stand-in lookups: {replies.stats}")
+        except KeyboardInterrupt:
+            server.shutdown()
+        return 0
+
+    server = start_stand_in(replies, args.serve_llm) if args.serve_llm else None
+    try:
+        results = replay(records, args.target, args.speed, args.concurrency, args.timeout)
+    finally:
+        if server:
+            server.shutdown()
+    summary = summarize(results, records)
+    summary["llm_lookups"] = dict(replies.stats)
+    for name, value in summary.items():
+        print(f"  {name}: {value}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"summary": summary, "requests": results}, f, indent=2)
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
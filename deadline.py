@@ -0,0 +1,269 @@
+import contextvars
+import heapq
+import itertools
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-request deadlines and cancellation.
+#
+# app.py gives every request a Deadline (X-Deadline-Ms / "deadline_ms", or DEFAULT_DEADLINE_SECONDS)
+# and stores it in a context variable. Each pipeline stage runs inside stage(name), which fails fast
+# once the budget is spent and turns timeouts into DeadlineExceeded(stage). Stages pass what is left
+# of the budget down to their backend: LLM client timeouts, max_time_ms on Mongo cursors,
+# MAX_EXECUTION_TIME / KILL QUERY for MySQL. If the HTTP client disconnects, the deadline is
+# cancelled and pending stages stop at their next check.
+
+DEFAULT_DEADLINE_SECONDS = float(os.environ.get("CHATDB_DEFAULT_DEADLINE", "120"))
+
+current = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: str, message: str = None):
+        super().__init__(message or f"Deadline exceeded during stage '{stage}'")
+        self.stage = stage
+
+
+class Cancelled(DeadlineExceeded):
+    def __init__(self, stage: str, reason: str):
+        super().__init__(stage, f"Request cancelled during stage '{stage}': {reason}")
+        self.reason = reason
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.stage = "start"
+        self.cancel_reason = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.cancel_reason is not None or time.monotonic() >= self.expires_at
+
+    def check(self, stage: str = None):
+        stage = stage or self.stage
+        if self.cancel_reason is not None:
+            raise Cancelled(stage, self.cancel_reason)
+        if time.monotonic() >= self.expires_at:
+            raise DeadlineExceeded(stage)
+
+    def cancel(self, reason: str):
+        with self._lock:
+            if self.cancel_reason is not None:
+                return
+            self.cancel_reason = reason
+            callbacks = list(self._callbacks)
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception as e:
+                print(f"Cancel callback failed: {e}")
+
+    def add_callback(self, fn):
+        with self._lock:
+            self._callbacks.append(fn)
+
+    def remove_callback(self, fn):
+        with self._lock:
+            if fn in self._callbacks:
+                self._callbacks.remove(fn)
+
+    def error(self) -> DeadlineExceeded:
+        if self.cancel_reason is not None:
+            return Cancelled(self.stage, self.cancel_reason)
+        return DeadlineExceeded(self.stage)
+
+
+@contextmanager
+def stage(name: str):
+    """Run a pipeline stage under the current deadline; failures after expiry become DeadlineExceeded(name)."""
+    d = current.get()
+    if d is None:
+        yield None
+        return
+    d.check(name)
+    previous, d.stage = d.stage, name
+    try:
+        yield d
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        if d.expired():
+            raise d.error() from e
+        raise
+    finally:
+        d.stage = previous
+
+
+def check(stage_name: str):
+    """Raise if the current request's deadline has passed or it was cancelled."""
+    d = current.get()
+    if d is not None:
+        d.check(stage_name)
+
+
+def remaining(default: float = None):
+    """Seconds left for the current request, or `default` when no deadline is set."""
+    d = current.get()
+    return d.remaining() if d is not None else default
+
+
+def max_time_ms():
+    """Server-side time limit for a database operation, or None without a deadline."""
+    left = remaining()
+    if left is None:
+        return None
+    return max(1, int(left * 1000))
+
+
+class _Guard:
+    """One block under on_expiry(): fires at most once, and only while the block is still running."""
+
+    def __init__(self, fn, due: float):
+        self.fn = fn
+        self.due = due
+        self.active = True
+        self.lock = threading.Lock()
+
+    def fire(self):
+        with self.lock:
+            if not self.active:
+                return
+            self.active = False
+            try:
+                self.fn()
+            except Exception as e:
+                print(f"Expiry callback failed: {e}")
+
+    def disarm(self):
+        # waits for a callback that is already running (e.g. a KILL QUERY), so it cannot reach
+        # whatever the connection runs next
+        with self.lock:
+            self.active = False
+
+
+class ExpiryWatchdog:
+    """One thread per process that fires the on_expiry() guards whose deadline has passed."""
+
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._compact_at = 1024
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def arm(self, guard: _Guard):
+        with self._cond:
+            if self._pid != os.getpid():
+                # the thread of a pre-fork master does not survive the fork
+                self._heap = []
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="chatdb-expiry-watchdog", daemon=True).start()
+            if len(self._heap) >= self._compact_at:
+                # finished blocks stay queued until their due time; drop them in bulk
+                self._heap = [entry for entry in self._heap if entry[2].active]
+                heapq.heapify(self._heap)
+                self._compact_at = max(1024, 2 * len(self._heap))
+            heapq.heappush(self._heap, (guard.due, next(self._order), guard))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and not self._heap[0][2].active:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                guard = heapq.heappop(self._heap)[2]
+            guard.fire()
+
+
+watchdog = ExpiryWatchdog()
+
+
+@contextmanager
+def on_expiry(fn):
+    """Call fn() if the current deadline expires or is cancelled while the block is running."""
+    d = current.get()
+    if d is None:
+        yield
+        return
+    guard = _Guard(fn, d.expires_at)
+    watchdog.arm(guard)
+    d.add_callback(guard.fire)
+    try:
+        yield
+    finally:
+        guard.disarm()
+        d.remove_callback(guard.fire)
+
+
+class DisconnectWatcher:
+    """
+    One background thread that polls the sockets of in-flight requests and cancels the
+    request's deadline when its client has gone away.
+    """
+
+    def __init__(self, interval: float = 0.25):
+        self.interval = interval
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, sock, d: Deadline):
+        if sock is None:
+            return None
+        token = object()
+        with self._lock:
+            self._watched[token] = (sock, d)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="chatdb-disconnect-watcher", daemon=True)
+                self._thread.start()
+        return token
+
+    def unwatch(self, token):
+        if token is None:
+            return
+        with self._lock:
+            self._watched.pop(token, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                watched = list(self._watched.items())
+            for token, (sock, d) in watched:
+                if _peer_closed(sock):
+                    self.unwatch(token)
+                    d.cancel("client disconnected")
+
+
+def _peer_closed(sock) -> bool:
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except BlockingIOError:
+        return False
+    except (OSError, ValueError):
+        return True
+
+
+def request_socket(environ):
+    # gunicorn and werkzeug both expose the client socket in the WSGI environ
+    return environ.get("gunicorn.socket") or environ.get("werkzeug.socket")
+
+
+watcher = DisconnectWatcher()
@@ -0,0 +1,395 @@
+import json
+import math
+import os
+import pickle
+import re
+import sys
+import tempfile
+import threading
+import time
+from decimal import Decimal
+
+import admission
+import deadline
+import prompt_sessions
+import read_routing
+import workload
+from mongodb_component.deepseekHandler import convert_object_ids, stringify_object_ids
+from nl2sql_v2 import connect_to_db, get_schema_cached, is_select, kill_query, mysql_connector, \
+    validate_safe_sql, with_execution_time_limit
+from result_summary import flatten_document, summarize_documents
+from schema_prompt import encode_mongo_schema, encode_sql_schema
+
+# Federated questions that need MySQL and MongoDB data at the same time.
+#
+# DeepSeek plans one SELECT for MySQL and one find for a Mongo collection, with every filter and
+# projection pushed into the sub-query that owns the data, plus the join columns. Both sides are
+# streamed: the Mongo side builds an in-process hash table, then MySQL rows probe it. When the Mongo
+# side has few distinct join keys they are also pushed into the SQL as `IN (...)`. A build side
+# larger than FEDERATED_MEMORY_LIMIT_MB is partitioned to disk (grace hash join) and joined
+# partition by partition. Only the joined, projected, limited rows leave the server.
+
+FEDERATED_MAX_ROWS = int(os.environ.get("FEDERATED_MAX_ROWS", "1000"))
+FEDERATED_MEMORY_LIMIT_MB = float(os.environ.get("FEDERATED_MEMORY_LIMIT_MB", "64"))
+FEDERATED_SPILL_DIR = os.environ.get("FEDERATED_SPILL_DIR") or None  # default: the system temp dir
+PUSHDOWN_MAX_KEYS = 1000
+SPILL_PARTITIONS = 16
+FETCH_BATCH = 1000
+
+_stats = {"queries": 0, "spilled": 0, "pushdowns": 0, "sql_rows": 0, "mongodb_rows": 0, "returned_rows": 0}
+_stats_lock = threading.Lock()
+
+FEDERATED_PREFIX = """You plan questions that need data from both a MySQL database and a MongoDB database.
+Split the question into one SQL SELECT for MySQL and one find on one MongoDB collection, and name the
+columns that join them. Push every filter and column choice into the sub-query that owns the data:
+select only the columns needed for the output and the join, and filter as much as possible on each side.
+Do not use LIMIT or sort in the sub-queries; the joined result is limited afterwards.
+Return ONLY a strict JSON object, no explanations and no Markdown:
+{{
+  "sql": "SELECT ... FROM ... WHERE ...",
+  "mongodb": {{"collection": "<name>", "filter": {{...}}, "projection": {{...}}}},
+  "join": {{"sql_column": "<column returned by the SELECT>", "mongodb_field": "<dotted.field>", "type": "inner" | "left"}},
+  "output": ["<sql column or mongodb dotted.field>", ...],
+  "limit": 100
+}}
+"left" keeps MySQL rows that have no MongoDB match.
+
+MySQL database `{sql_db}`, one table per line as table(column:type,...):
+{sql_schema}
+
+MongoDB database "{mongo_db}", one collection per line:
+{mongo_schema}
+"""
+
+
+def join_key(value):
+    """Normalize join values so 42, 42.0, Decimal("42") and "42" meet in the same bucket."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        # NaN and infinity have no integer form; they stay floats and simply match nothing
+        return int(value) if math.isfinite(value) and value == int(value) else float(value)
+    if isinstance(value, str):
+        value = value.strip()
+        return int(value) if re.fullmatch(r"-?\d+", value) else value
+    return str(value)
+
+
+def _row_bytes(row: dict) -> int:
+    return sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values())
+
+
+class _Partitions:
+    """Rows written to SPILL_PARTITIONS files by join key hash."""
+
+    def __init__(self, directory: str, name: str):
+        self.paths = [os.path.join(directory, f"{name}-{i}.pkl") for i in range(SPILL_PARTITIONS)]
+        self._files = [open(path, "wb") for path in self.paths]
+
+    def add(self, key, row):
+        pickle.dump((key, row), self._files[hash(key) % SPILL_PARTITIONS], pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+    def read(self, index):
+        with open(self.paths[index], "rb") as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+
+class HashJoin:
+    """
+    Equi-join of a build side held in a hash table and a streamed probe side.
+    Above memory_limit bytes the build side is partitioned to disk and the probe side follows it.
+    """
+
+    def __init__(self, memory_limit: int, join_type: str = "inner", spill_dir: str = None):
+        self.memory_limit = memory_limit
+        self.join_type = join_type
+        self.spill_dir = spill_dir
+        self.table = {}
+        self.build_rows = 0
+        self.bytes = 0
+        self.spilled = False
+        self._tmp = None
+        self._build = None
+
+    def add(self, key, row):
+        self.build_rows += 1
+        if key is None:
+            return  # never matches
+        if self.spilled:
+            self._build.add(key, row)
+            return
+        self.table.setdefault(key, []).append(row)
+        self.bytes += _row_bytes(row)
+        if self.bytes > self.memory_limit:
+            self._spill()
+
+    def _spill(self):
+        print(f"Federated join: build side over {self.memory_limit} bytes, spilling to disk")
+        self.spilled = True
+        self._tmp = tempfile.TemporaryDirectory(prefix="chatdb-join-", dir=self.spill_dir)
+        self._build = _Partitions(self._tmp.name, "build")
+        for key, rows in self.table.items():
+            for row in rows:
+                self._build.add(key, row)
+        self.table = {}
+
+    def keys(self):
+        return None if self.spilled else self.table.keys()
+
+    def probe(self, rows):
+        """Yield (probe row, build row or None) pairs; rows is an iterable of (key, row)."""
+        try:
+            if not self.spilled:
+                for key, row in rows:
+                    yield from self._match(self.table, key, row)
+                return
+            self._build.close()
+            probe = _Partitions(self._tmp.name, "probe")
+            unmatched = []
+            for key, row in rows:
+                if key is None:
+                    unmatched.append(row)
+                else:
+                    probe.add(key, row)
+            probe.close()
+            for row in unmatched:
+                yield from self._match({}, None, row)
+            for i in range(SPILL_PARTITIONS):
+                deadline.check("join")
+                table = {}
+                for key, row in self._build.read(i):
+                    table.setdefault(key, []).append(row)
+                for key, row in probe.read(i):
+                    yield from self._match(table, key, row)
+        finally:
+            if self._tmp is not None:
+                self._tmp.cleanup()
+
+    def _match(self, table, key, row):
+        matches = table.get(key) if key is not None else None
+        if matches:
+            for match in matches:
+                yield row, match
+        elif self.join_type == "left":
+            yield row, None
+
+
+def prompt_prefix(sql_db, sql_schema_info, mongo_db, handler):
+    mongo_schema = handler.get_structured_schema(mongo_db, handler.list_collections(mongo_db))
+    return FEDERATED_PREFIX.format(sql_db=sql_db, sql_schema=encode_sql_schema(sql_schema_info)["text"],
+                                   mongo_db=mongo_db, mongo_schema=encode_mongo_schema(mongo_schema)["text"])
+
+
+def validate_plan(plan, handler, mongo_db):
+    if not isinstance(plan, dict):
+        return "Plan is not a JSON object."
+    sql = plan.get("sql")
+    if not isinstance(sql, str) or not is_select(sql):
+        return "Plan must contain one SQL SELECT statement."
+    error = validate_safe_sql(sql)
+    if error:
+        return error
+    mongo = plan.get("mongodb")
+    if not isinstance(mongo, dict) or mongo.get("collection") not in handler.list_collections(mongo_db):
+        return f"Plan must name one collection of {mongo_db}."
+    join = plan.get("join")
+    if not isinstance(join, dict) or not join.get("sql_column") or not join.get("mongodb_field"):
+        return "Plan must name the join columns."
+    if join.get("type", "inner") not in ("inner", "left"):
+        return f"Unsupported join type: {join.get('type')}"
+    return None
+
+
+def _mongo_projection(projection, field):
+    """Make sure the pushed-down projection still returns the join field."""
+    if not projection:
+        return None
+    projection = dict(projection)
+    if any(v not in (0, False) for k, v in projection.items() if k != "_id"):
+        # {"_id": 0, "_id.Code": 1} would be a path collision
+        projection = {k: v for k, v in projection.items() if not field.startswith(k + ".")}
+        projection[field] = 1
+    else:
+        projection = {k: v for k, v in projection.items() if k != field and not field.startswith(k + ".")}
+    return projection or None
+
+
+def _get_path(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def stream_mongodb(database, db_name, plan):
+    mongo = plan["mongodb"]
+    field = plan["join"]["mongodb_field"]
+    cursor = database[mongo["collection"]].find(convert_object_ids(mongo.get("filter") or {}),
+                                                _mongo_projection(mongo.get("projection"), field))
+    cursor = cursor.batch_size(FETCH_BATCH)
+    max_time_ms = deadline.max_time_ms()
+    if max_time_ms:
+        cursor = cursor.max_time_ms(max_time_ms)
+    with deadline.stage("mongodb"), admission.admit(f"mongodb:{db_name}"):
+        try:
+            for doc in cursor:
+                yield join_key(_get_path(doc, field)), doc
+        finally:
+            cursor.close()
+
+
+def _sql_literal(key):
+    # join keys are ints, floats or strings (see join_key); strings go in as hex so nothing needs escaping
+    if isinstance(key, str):
+        return f"_utf8mb4 X'{key.encode('utf-8').hex()}'"
+    if isinstance(key, int) or (isinstance(key, float) and math.isfinite(key)):
+        return repr(key)
+    return None  # NULL, NaN and infinity never equal a MySQL value
+
+
+def _pushdown(sql, column, keys):
+    # the planned SELECT becomes a derived table filtered on the keys the Mongo side can match;
+    # keys are inlined rather than bound because the connector would also read the planned SQL's
+    # own % signs (LIKE '%sales%') as placeholders
+    literals = [literal for literal in map(_sql_literal, keys) if literal is not None]
+    condition = f"federated_probe.`{column}` IN ({', '.join(literals)})" if literals else "FALSE"
+    return f"SELECT * FROM ({sql.strip().rstrip(';')}) AS federated_probe WHERE {condition}"
+
+
+def stream_mysql(conn, plan, keys=None):
+    column = plan["join"]["sql_column"].split(".")[-1].strip("`")
+    sql = plan["sql"].strip().rstrip(";")
+    if keys is not None:
+        sql = _pushdown(sql, column, keys)
+    cursor = conn.cursor()
+    with deadline.stage("mysql"), admission.admit(f"mysql:{conn.database}"), \
+            deadline.on_expiry(lambda: kill_query(conn)):
+        try:
+            cursor.execute(with_execution_time_limit(sql))
+            names = cursor.column_names
+            if column not in names:
+                raise ValueError(f"SQL sub-query does not return the join column '{column}'")
+            position = names.index(column)
+            while True:
+                batch = cursor.fetchmany(FETCH_BATCH)
+                if not batch:
+                    break
+                for row in batch:
+                    yield join_key(row[position]), dict(zip(names, row))
+        finally:
+            # stopping early leaves the server sending rows nobody reads: kill the statement so
+            # only what is already in flight has to be drained before the connection is reused
+            if conn.unread_result:
+                kill_query(conn)
+                try:
+                    conn.consume_results()
+                except mysql_connector.Error:
+                    pass  # the interrupted statement ends with "Query execution was interrupted"
+            cursor.close()
+
+
+def _merge(sql_row, doc, collection):
+    merged = dict(sql_row)
+    if doc is not None:
+        for key, value in flatten_document(doc).items():
+            merged[f"{collection}.{key}" if key in merged else key] = value
+    return merged
+
+
+def execute_plan(plan, conn, mongo_database, mongo_db):
+    join = plan["join"]
+    limit = min(int(plan.get("limit") or FEDERATED_MAX_ROWS), FEDERATED_MAX_ROWS)
+    hash_join = HashJoin(int(FEDERATED_MEMORY_LIMIT_MB * 1024 * 1024), join.get("type", "inner"),
+                         FEDERATED_SPILL_DIR)
+    for key, doc in stream_mongodb(mongo_database, mongo_db, plan):
+        hash_join.add(key, doc)
+
+    keys = hash_join.keys()
+    pushdown = keys is not None and hash_join.join_type == "inner" and len(keys) <= PUSHDOWN_MAX_KEYS
+    if pushdown and not keys:
+        sql_rows = iter(())  # nothing on the Mongo side can match
+    else:
+        sql_rows = stream_mysql(conn, plan, list(keys) if pushdown else None)
+
+    counted = {"sql": 0}
+
+    def counting(rows):
+        for item in rows:
+            counted["sql"] += 1
+            yield item
+
+    output = plan.get("output") or []
+    results = []
+    probe_rows = counting(sql_rows)
+    pairs = hash_join.probe(probe_rows)
+    with deadline.stage("join"):
+        try:
+            for sql_row, doc in pairs:
+                merged = _merge(sql_row, doc, plan["mongodb"]["collection"])
+                results.append({name: merged.get(name) for name in output} if output else merged)
+                if len(results) >= limit:
+                    break
+        finally:
+            # stop both streams now so the MySQL cursor is drained before the connection is reused
+            pairs.close()
+            probe_rows.close()
+            if hasattr(sql_rows, "close"):
+                sql_rows.close()
+
+    stats = {"sql_rows": counted["sql"], "mongodb_rows": hash_join.build_rows, "returned_rows": len(results),
+             "spilled": hash_join.spilled, "pushdown_keys": len(keys) if pushdown else 0}
+    with _stats_lock:
+        _stats["queries"] += 1
+        _stats["spilled"] += int(hash_join.spilled)
+        _stats["pushdowns"] += int(pushdown)
+        _stats["sql_rows"] += stats["sql_rows"]
+        _stats["mongodb_rows"] += stats["mongodb_rows"]
+        _stats["returned_rows"] += stats["returned_rows"]
+    return results, stats
+
+
+def handle_federated_query(question, sql_db, mongo_db, handler, mongo_database, session_id=None):
+    """Plan, run and join a question over MySQL database sql_db and MongoDB database mongo_db."""
+    role = "primary" if read_routing.sessions.reads_pinned(session_id) else "replica"
+    conn = connect_to_db(sql_db, role)
+    try:
+        with deadline.stage("schema"):
+            sql_schema_info, _ = get_schema_cached(conn, sql_db)
+            prefix = prompt_prefix(sql_db, sql_schema_info, mongo_db, handler)
+        conversation = prompt_sessions.sessions.get(session_id, ("federated", f"{sql_db}+{mongo_db}"))
+        response = handler.generate_json(prefix, f"Question: {question}", conversation)
+        print("Federated plan:", response)
+        try:
+            plan = json.loads(response)
+        except ValueError as e:
+            return {"error": f"LLM did not return a valid plan: {e}"}
+        error = validate_plan(plan, handler, mongo_db)
+        if error:
+            return {"error": error, "plan": plan}
+        workload.record_query("federated", plan)
+        started = time.perf_counter()
+        try:
+            results, stats = execute_plan(plan, conn, mongo_database, mongo_db)
+            workload.record_db("federated", time.perf_counter() - started, stats["returned_rows"])
+        except (admission.Overloaded, deadline.DeadlineExceeded):
+            raise
+        except Exception as e:
+            return {"error": f"Federated query failed: {e}", "plan": plan}
+    finally:
+        conn.close()
+    results = stringify_object_ids(results)
+    return {"plan": plan, "results": results, "summary": summarize_documents(results)["text"], "stats": stats}
+
+
+def stats() -> dict:
+    with _stats_lock:
+        return dict(_stats)
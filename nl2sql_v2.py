@@ -1,16 +1,175 @@
 
-import ollama
-import mysql.connector
+import json
+import os
 import re
+import threading
+import time
+import admission
+import deadline
+import itertools
+import prompt_sessions
+import read_routing
+import rollups
+import singleflight
+import workload
+from startup import lazy_import
 
-# Connect to MySQL database
-def connect_to_db(database):
-    return mysql.connector.connect(
-        host="localhost",
-        user="root",
-        password="********",
-        database=database
-    )
+# imported on first use to keep app start-up fast
+httpx = lazy_import("httpx")
+ollama = lazy_import("ollama")
+mysql_connector = lazy_import("mysql.connector")
+mysql_pooling = lazy_import("mysql.connector.pooling")
+from mongodb_component.intentHandler import is_read_request
+from query_templates import template_store
+from result_summary import summarize_rows, record_narrative, render_explanation
+from schema_prompt import encode_sql_schema
+from schema_resolver import resolve_schema_request
+
+SCHEMA_CACHE_TTL = 300  # seconds
+_schema_cache = {}
+
+MYSQL_CONFIG = {
+    "host": os.environ.get("MYSQL_HOST", "localhost"),
+    "user": os.environ.get("MYSQL_USER", "root"),
+    "password": os.environ.get("MYSQL_PASSWORD", "********"),
+}
+MYSQL_POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", "5"))
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+LLM_MODEL = "llama3"
+LLM_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+# "structured": one JSON-constrained call returns intent, SQL or answer and explanation template;
+# "staged": the older classify -> generate -> explain sequence of calls
+SQL_GENERATION = os.environ.get("CHATDB_SQL_GENERATION", "structured")
+MYSQL_DATABASES = ["employees", "sakila", "Chinook"]
+
+# Pools and LLM clients are per process: they are (re)created lazily after a fork
+_process_state = {}
+_process_lock = threading.Lock()
+
+
+def _state():
+    pid = os.getpid()
+    if _process_state.get("pid") != pid:
+        with _process_lock:
+            if _process_state.get("pid") != pid:
+                _process_state.clear()
+                # one connection pool to Ollama per process, also behind the per-call clients
+                transport = httpx.HTTPTransport()
+                _process_state.update(pools={}, ollama=ollama.Client(host=OLLAMA_HOST, transport=transport),
+                                      ollama_transport=_PooledTransport(transport),
+                                      replica_cycle=itertools.cycle(read_routing.MYSQL_REPLICA_HOSTS or [None]),
+                                      pid=pid)
+    return _process_state
+
+
+class _PooledTransport:
+    """The process's Ollama transport for a short-lived client: closing that client keeps the pool."""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def handle_request(self, request):
+        return self.transport.handle_request(request)
+
+    def close(self):
+        pass
+
+
+def _host_config(host):
+    return dict(MYSQL_CONFIG, host=host) if host else MYSQL_CONFIG
+
+
+def get_pool(database, host=None):
+    pools = _state()["pools"]
+    key = (database, host)
+    if key not in pools:
+        with _process_lock:
+            if key not in pools:
+                pools[key] = mysql_pooling.MySQLConnectionPool(
+                    pool_name=f"chatdb_{database}_{len(pools)}_{os.getpid()}",
+                    pool_size=MYSQL_POOL_SIZE,
+                    database=database,
+                    **_host_config(host)
+                )
+    return pools[key]
+
+
+def pick_host(role="primary"):
+    """The next read replica for role="replica", otherwise None (the primary in MYSQL_CONFIG)."""
+    return next(_state()["replica_cycle"]) if role == "replica" else None
+
+
+# Connect to MySQL database (close() hands a pooled connection back to the pool).
+# role="replica" picks the next read replica round-robin, or the primary when none are configured.
+def connect_to_db(database, role="primary"):
+    host = pick_host(role)
+    try:
+        return get_pool(database, host).get_connection()
+    except mysql_connector.errors.PoolError:
+        # pool exhausted: fall back to a dedicated connection rather than failing the request
+        return mysql_connector.connect(database=database, **_host_config(host))
+
+
+def llm_chat(messages, **options):
+    options.setdefault("keep_alive", LLM_KEEP_ALIVE)
+    # identical prompts in flight at the same time share one generation
+    key = json.dumps([messages, options], sort_keys=True, default=str)
+    return singleflight.group("ollama").do(key, lambda: _admitted_chat(messages, options))
+
+
+def _admitted_chat(messages, options):
+    # only a few generations can run at once on a local model; wait in the admission queue
+    with deadline.stage("ollama"), admission.admit("ollama"):
+        left = deadline.remaining()
+        started = time.perf_counter()
+        if left is None:
+            response = _state()["ollama"].chat(model=LLM_MODEL, messages=messages, **options)
+        else:
+            # the shared client has no timeout: a client bounded by the deadline sends this call over
+            # the same connection pool
+            with ollama.Client(host=OLLAMA_HOST, timeout=left, transport=_state()["ollama_transport"]) as client:
+                response = client.chat(model=LLM_MODEL, messages=messages, **options)
+        workload.record_llm("ollama", messages, response['message']['content'], time.perf_counter() - started,
+                            response.get("prompt_eval_count"), response.get("eval_count"))
+        return response
+
+
+# MAX_EXECUTION_TIME only applies to SELECT; other statements are stopped with KILL QUERY
+def with_execution_time_limit(sql_query):
+    limit_ms = deadline.max_time_ms()
+    if limit_ms is None or not is_select(sql_query):
+        return sql_query
+    return re.sub(r"^\s*SELECT", f"SELECT /*+ MAX_EXECUTION_TIME({limit_ms}) */", sql_query, count=1, flags=re.IGNORECASE)
+
+
+def kill_query(conn):
+    # issued from a separate connection to the same server
+    killer = mysql_connector.connect(**dict(MYSQL_CONFIG, host=conn.server_host, port=conn.server_port))
+    try:
+        cursor = killer.cursor()
+        cursor.execute(f"KILL QUERY {int(conn.connection_id)}")
+        cursor.close()
+        print(f"Killed query on connection {conn.connection_id}")
+    finally:
+        killer.close()
+
+
+# Warm-up: open a pool and cache the schema for every known database
+def warm_up_mysql():
+    for database in MYSQL_DATABASES:
+        for host in read_routing.MYSQL_REPLICA_HOSTS:
+            get_pool(database, host)
+        conn = connect_to_db(database)
+        try:
+            _schema_cache.pop(database, None)
+            get_schema_cached(conn, database)
+        finally:
+            conn.close()
+
+
+# Warm-up: an empty prompt makes Ollama load the model into memory and keep it there
+def warm_up_llm():
+    _state()["ollama"].generate(model=LLM_MODEL, prompt="", keep_alive=LLM_KEEP_ALIVE)
     
 # conn = connect_to_db("employees")
 def get_schema_text(conn):
@@ -18,7 +177,7 @@ def get_schema_text(conn):
 
     # Retrieve schema information
     cursor.execute("SHOW TABLES;")
-    tables = [row[0] for row in cursor.fetchall()]
+    tables = [row[0] for row in cursor.fetchall() if not rollups.is_internal(row[0])]
 
     schema_info = {}
     for table in tables:
@@ -26,70 +185,206 @@ def get_schema_text(conn):
         columns = [(row[0], row[1]) for row in cursor.fetchall()] 
         schema_info[table] = columns
 
-    schema_text = "\\n".join([f"{table}: " + ", ".join(f"{col} ({typ})" for col, typ in cols) for table, cols in schema_info.items()])
+    return schema_info, format_schema_text(schema_info)
+
+def format_schema_text(schema_info):
+    return "\n".join([f"{table}: " + ", ".join(f"{col} ({typ})" for col, typ in cols) for table, cols in schema_info.items()])
+
+def cached_schema(database):
+    """(schema_info, schema_text) while the cached copy is fresh, otherwise None."""
+    entry = _schema_cache.get(database)
+    if entry and time.monotonic() - entry[0] < SCHEMA_CACHE_TTL:
+        return entry[1], entry[2]
+    return None
+
+def cache_schema(database, schema_info, schema_text):
+    _schema_cache[database] = (time.monotonic(), schema_info, schema_text)
+
+def get_schema_cached(conn, database):
+    cached = cached_schema(database)
+    if cached:
+        return cached
+    # concurrent misses for the same database wait for a single schema load
+    schema_info, schema_text = singleflight.group("mysql_schema").do(database, lambda: get_schema_text(conn))
+    cache_schema(database, schema_info, schema_text)
     return schema_info, schema_text
 
+# Answer schema exploration directly from the catalog when the request is unambiguous
+def resolve_schema_query(query, schema_info, conn):
+    resolved = resolve_schema_request(query, list(schema_info.keys()))
+    if resolved is None:
+        return None
+    print(f"Schema request resolved locally: {resolved}")
+    intent = resolved["intent"]
+    if intent == "list_collections":
+        tables = list(schema_info.keys())
+        return {"answer": f"The database has {len(tables)} tables: {', '.join(tables)}.", "tables": tables}
+    if intent == "get_schema_for_all":
+        return {
+            "answer": "\n".join(f"{table}: " + ", ".join(col for col, _ in cols) for table, cols in schema_info.items()),
+            "tables": {table: [col for col, _ in cols] for table, cols in schema_info.items()}
+        }
+    table = resolved["collection"]
+    if intent == "get_fields":
+        columns = schema_info[table]
+        return {
+            "answer": f"Table {table} has columns: " + ", ".join(f"{col} ({typ})" for col, typ in columns) + ".",
+            "table": table,
+            "columns": [{"name": col, "type": typ} for col, typ in columns]
+        }
+    if intent == "get_samples":
+        limit = int(resolved.get("limit", 3))
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SELECT * FROM `{table}` LIMIT {limit};")
+            rows = cursor.fetchall()
+            columns = [desc[0] for desc in cursor.description]
+        finally:
+            cursor.close()
+        return {
+            "answer": f"Showing {len(rows)} sample rows from {table}.",
+            "table": table,
+            "columns": columns,
+            "results": rows
+        }
+    return None
+
 # Intent Classification using LLM
-def classify_intent(query):
+def intent_messages(query):
     system_prompt = "You are a SQL assistant. Given a user's natural language request, classify it into one of the following types: 'schema', 'query', or 'modification'.\nOnly return one of these words, and nothing else."
     user_prompt = f"User request: {query}"
-    response = ollama.chat(model='llama3', messages=[
+    return [
         {'role': 'system', 'content': system_prompt},
         {'role': 'user', 'content': user_prompt}
-    ])
-    raw = response['message']['content'].strip().lower()
-    intent = raw.replace('"', '').replace("'", "").strip()
+    ]
+
+def parse_intent(raw):
+    intent = raw.strip().lower().replace('"', '').replace("'", "").strip()
     print(f"Intent classified as: {intent}")
     return intent
 
-# Schema Exploration Handler
-def handle_schema_query(query, schema_text):
-    prompt = f"""
-You are a database assistant. The following is the schema of a MySQL database:
+def classify_intent(query):
+    response = llm_chat(intent_messages(query))
+    return parse_intent(response['message']['content'])
 
-{schema_text}
+# Prompt layout: one stable system prefix per database (rules + schema), then the session's
+# earlier turns, then a short task line with the question. See prompt_sessions.py.
+SQL_PREFIX = """You are a MySQL assistant for the database `{database}`.
+Each request starts with a task line. Depending on it you either answer a question about the schema,
+write one SQL SELECT statement, or write one INSERT, UPDATE or DELETE statement.
 
-The user is asking about the database schema—such as what tables exist, what columns are in a table, or requesting sample data from a table.
-Please respond appropriately based on the question. Do not generate SQL.
+Rules:
+- Use only table and column names as shown in the schema.
+- When the task asks for SQL, only return the SQL. Do not include explanations or commentary.
+  Do NOT include any markdown (like ``` or "sql").
+- When the task is a schema question, answer in plain English and do not generate SQL.
+- When the task asks for JSON, return only the JSON object with the requested fields.
+- A request may follow up on earlier requests in this conversation; resolve references like
+  "those" or "only the ones" against them.
 
-User question: {query}
+Database schema, one table per line as table(column:type,...):
+{schema_text}
 """
-    # print(schema_text)
-    response = ollama.chat(model='llama3', messages=[{'role': 'user', 'content': prompt}])
-    return {"answer": response['message']['content'].strip()}
 
-# SELECT Query Handler
-def handle_select_query(nl_query, schema_text):
-    prompt = f"""
-You are a helpful assistant that translates natural language into SQL SELECT queries for a MySQL database.
+def sql_prompt_prefix(database, schema_info):
+    # no question-specific pinning here: the prefix must be byte-identical across requests
+    return SQL_PREFIX.format(database=database, schema_text=encode_sql_schema(schema_info)["text"])
 
-Database Schema:
-{schema_text}
+def session_chat(conversation, prefix, suffix, format=None, record=True):
+    messages = conversation.messages(prefix, suffix)
+    options = {}
+    if format is not None:
+        options["format"] = format
+    if conversation.persistent:
+        # keep the model, and with it the conversation's KV cache, loaded for the whole session
+        options["keep_alive"] = f"{int(prompt_sessions.SESSION_TTL_SECONDS)}s"
+    response = llm_chat(messages, **options)
+    prompt_sessions.record_ollama_usage(messages, response)
+    answer = response['message']['content'].strip()
+    if record:
+        conversation.record(suffix, answer)
+    return answer
 
-The user's request is a SELECT query. Convert the following natural language request into an appropriate SQL SELECT statement.
-Only return the SQL. Do not include explanations or commentary. Do NOT include any markdown (like ``` or "sql").
-Use only table and column names as shown in the schema.
-Query: {nl_query}
-"""
-    response = ollama.chat(model='llama3', messages=[{'role': 'user', 'content': prompt}])
-    return response['message']['content'].strip()
+# Task lines that follow the stable prefix; async_app.py sends the same ones
+SCHEMA_TASK = """Task: schema question (tables, columns or sample data). Do not generate SQL.
+User question: {query}"""
+SELECT_TASK = """Task: convert the request into one SQL SELECT statement. Only return the SQL.
+Query: {query}"""
+MODIFY_TASK = """Task: convert the request into one SQL statement (INSERT, UPDATE, or DELETE). Only return the SQL.
+Query: {query}"""
+
+# Schema Exploration Handler
+def handle_schema_query(query, prefix, conversation):
+    return {"answer": session_chat(conversation, prefix, SCHEMA_TASK.format(query=query))}
+
+# SELECT Query Handler
+def handle_select_query(nl_query, prefix, conversation):
+    return session_chat(conversation, prefix, SELECT_TASK.format(query=nl_query))
 
 # Modification Handler (INSERT/UPDATE/DELETE)
-def handle_modify_query(nl_query,schema_text):
-    prompt = f"""
-Database Schema:
-{schema_text}
+def handle_modify_query(nl_query, prefix, conversation):
+    return session_chat(conversation, prefix, MODIFY_TASK.format(query=nl_query))
 
-The user's request is to modify the database. Convert the following natural language request into an appropriate SQL statement (INSERT, UPDATE, or DELETE).
-Only return the SQL. Do not include explanations or commentary.
+# Single-call generation: Ollama constrains the output to this JSON schema, so the intent, the
+# statement and the explanation come back in one response and need no text clean-up.
+def sql_response_schema(narrative=False):
+    properties = {
+        "intent": {"type": "string", "enum": ["schema", "query", "modification"]},
+        "sql": {"type": "string"},
+        "answer": {"type": "string"},
+    }
+    required = ["intent", "sql", "answer"]
+    if narrative:
+        # only generated when asked for; the local summary is the default explanation
+        properties["explanation"] = {"type": "string"}
+        required.append("explanation")
+    return {"type": "object", "properties": properties, "required": required}
 
-Query: {nl_query}
-"""
-    response = ollama.chat(model='llama3', messages=[{'role': 'user', 'content': prompt}])
-    return response['message']['content'].strip()
+def structured_task(nl_query, narrative=False):
+    suffix = """Task: classify the request and answer it as JSON.
+- intent: "schema" for questions about tables, columns or sample data, "query" for reading data,
+  "modification" for INSERT, UPDATE or DELETE.
+- sql: the single SQL statement for "query" or "modification"; empty for "schema".
+- answer: the plain English answer for "schema"; empty otherwise."""
+    if narrative:
+        suffix += """
+- explanation: one or two sentences describing the result of the SQL for the user. Do not guess
+  numbers; write {rows} for the row count, {column} for the value of a single-row column and
+  {column.min}, {column.max}, {column.mean}, {column.sum}, {column.top} for statistics."""
+    return suffix + f"\nQuery: {nl_query}"
+
+def parse_structured(reply):
+    """{"intent", "sql", "answer", "explanation"} from a structured reply, or None if it is unusable."""
+    try:
+        generated = json.loads(reply)
+    except ValueError:
+        print(f"Structured generation returned invalid JSON: {reply[:200]}")
+        return None
+    if not isinstance(generated, dict):
+        return None
+    intent = generated.get("intent")
+    sql = (generated.get("sql") or "").strip()
+    answer = (generated.get("answer") or "").strip()
+    if intent not in ("schema", "query", "modification") or (intent == "schema" and not answer) \
+            or (intent != "schema" and not sql):
+        print(f"Structured generation returned an incomplete reply: {generated}")
+        return None
+    print(f"Intent classified as: {intent}")
+    return {"intent": intent, "sql": sql, "answer": answer,
+            "explanation": (generated.get("explanation") or "").strip() or None}
+
+def generate_structured(nl_query, prefix, conversation, narrative=False):
+    """One LLM call for intent, SQL or answer and explanation template; None if the reply is unusable."""
+    suffix = structured_task(nl_query, narrative)
+    reply = session_chat(conversation, prefix, suffix, format=sql_response_schema(narrative), record=False)
+    generated = parse_structured(reply)
+    if generated:
+        # an unusable reply must not become part of the conversation the fallback continues
+        conversation.record(suffix, reply)
+    return generated
 
 # Generate brief explanation (for SELECT results)
-def explain_result(nl_query, sql_query, results):
+def explain_messages(nl_query, sql_query, results):
     sample_text = "\n".join([", ".join(map(str, row)) for row in results[:3]])
     prompt = f"""
 The user asked: "{nl_query}"
@@ -98,7 +393,10 @@ Here are the top few rows of the result:
 {sample_text}
 Write a short (1–2 sentence) explanation of what this result shows, in plain English:
 """
-    response = ollama.chat(model='llama3', messages=[{'role': 'user', 'content': prompt}])
+    return [{'role': 'user', 'content': prompt}]
+
+def explain_result(nl_query, sql_query, results):
+    response = llm_chat(explain_messages(nl_query, sql_query, results))
     return response['message']['content'].strip()
 
 
@@ -115,8 +413,9 @@ def validate_safe_sql(sql):
     return None
 
 # SQL Execution Function
-def execute_sql(sql_query, conn,schema_info, original_question=None):
+def execute_sql(sql_query, conn,schema_info, original_question=None, narrative=False, explanation_template=None):
     sql_query = enforce_limit(sql_query)
+    workload.record_query("sql", sql_query)
     validation_error = validate_safe_sql(sql_query)
     if validation_error:
         return {"error": validation_error}
@@ -125,51 +424,175 @@ def execute_sql(sql_query, conn,schema_info, original_question=None):
         sql_type = sql_query.split()[0].upper()
         if sql_type == "SELECT":
             print(f"Executing SQL: {sql_query}")
-            cursor.execute(sql_query)
-            results = cursor.fetchall()
+            started = time.perf_counter()
+            with deadline.stage("mysql"), admission.admit(f"mysql:{conn.database}"), \
+                    deadline.on_expiry(lambda: kill_query(conn)):
+                # a fresh pre-aggregated rollup answers recurring GROUP BY shapes
+                rollup = rollups.sql.answer(conn, sql_query)
+                if rollup:
+                    try:
+                        print(f"Answering from rollup {rollup[0]}: {rollup[1]}")
+                        cursor.execute(with_execution_time_limit(rollup[1]))
+                        results = cursor.fetchall()
+                    except mysql_connector.Error as e:
+                        print(f"Rollup query failed, using the base tables: {e}")
+                        rollup = None
+                if not rollup:
+                    cursor.execute(with_execution_time_limit(sql_query))
+                    results = cursor.fetchall()
+            workload.record_db("mysql", time.perf_counter() - started, len(results))
+            if not rollup:
+                rollups.sql.observe(conn.database, sql_query, time.perf_counter() - started,
+                                    lambda: connect_to_db(conn.database, "primary"))
             if not results:
                 return {
                     "sql": sql_query,
                     "results": [],
                     "explanation": f"No results found for your query: \"{original_question}\""
                 }
-            explanation = explain_result(original_question, sql_query, results)
-            return {
+            column_names = [d[0] for d in cursor.description]
+            summary = summarize_rows(results, column_names)
+            explanation = summary["text"]
+            if narrative:
+                # the LLM only writes prose when the request asks for it; a template written
+                # together with the SQL saves the extra call
+                rendered = render_explanation(explanation_template, summary) if explanation_template else None
+                if rendered:
+                    explanation = rendered
+                else:
+                    with deadline.stage("explanation"):
+                        explanation = explain_result(original_question, sql_query, results)
+                record_narrative(templated=bool(rendered))
+            result = {
                 "sql": sql_query,
                 "results": results,
-                "explanation": explanation
+                "explanation": explanation,
+                "summary": summary["columns"]
             }
+            if rollup:
+                result["rollup"] = rollup[0]
+            return result
         else:
             print(f"Executing SQL: {sql_query}")
-            cursor.execute(sql_query)
-            conn.commit()
+            primary = lambda: connect_to_db(conn.database, "primary")
+            # rollups over the written table are marked stale before the write and refreshed after it
+            pending = rollups.sql.before_write(conn.database, sql_query, primary)
+            changed_rows = None
+            started = time.perf_counter()
+            try:
+                with deadline.stage("mysql"), admission.admit(f"mysql:{conn.database}"), \
+                        deadline.on_expiry(lambda: kill_query(conn)):
+                    cursor.execute(sql_query)
+                    conn.commit()
+                    changed_rows = cursor.rowcount
+            finally:
+                rollups.sql.after_write(pending, changed_rows, primary)
+            workload.record_db("mysql", time.perf_counter() - started, cursor.rowcount)
             return {
                 "sql": sql_query,
                 "status": f"{sql_type} executed successfully."
             }
         
+    except (admission.Overloaded, deadline.DeadlineExceeded):
+        raise
     except Exception as e:
         return {"error": str(e)}
     finally:
         cursor.close()
 
+def is_select(sql_query):
+    return sql_query.strip().upper().startswith("SELECT")
+
+# Writes are pinned to the primary and start the session's read-your-writes window
+def execute_on_primary(sql_query, database, schema_info, original_question=None, session_id=None, narrative=False):
+    conn = connect_to_db(database, "primary")
+    try:
+        result = execute_sql(sql_query, conn, schema_info, original_question, narrative)
+    finally:
+        conn.close()
+    read_routing.sessions.record_write(session_id)
+    _schema_cache.pop(database, None)
+    return result
+
 # Main dispatcher
-def handle_query(query,database):
-    conn = connect_to_db(database)
-    schema_info, schema_text = get_schema_text(conn)
-    intent = classify_intent(query)
+# Reads (schema, SELECT) use a replica connection unless the session wrote recently;
+# modifications always run on the primary.
+# narrative=True asks the LLM to explain SELECT results instead of the local summary
+def handle_query(query, database, session_id=None, narrative=False):
+    role = "primary" if read_routing.sessions.reads_pinned(session_id) else "replica"
+    conn = connect_to_db(database, role)
+    try:
+        return _dispatch(query, database, conn, session_id, narrative)
+    finally:
+        conn.close()
+
+def _dispatch(query, database, conn, session_id=None, narrative=False):
+    namespace = ("sql", database)
+
+    started = time.perf_counter()
+    schema_info, resolved = prepare_query(query, database, conn)
+    if resolved:
+        return resolved
+
+    # fast path: a learned template binds the new constants instead of generating SQL. Templates
+    # are learned from reads only, so the keyword rules must see a read first (no LLM call).
+    if template_store.matches(namespace, query) and is_read_request(query):
+        result = answer_from_template(query, namespace, conn, schema_info, narrative)
+        if result:
+            return result
+
+    prefix = sql_prompt_prefix(database, schema_info)
+    conversation = prompt_sessions.sessions.get(session_id, namespace)
+    # a follow-up only makes sense with the earlier turns; it must not become a template
+    follow_up = bool(conversation.turns)
+    generated = None
+    if SQL_GENERATION == "structured":
+        generated = generate_structured(query, prefix, conversation, narrative)
+    # an unusable structured reply falls back to the staged calls
+    intent = generated["intent"] if generated else classify_intent(query)
     if intent == "schema":
-        result = handle_schema_query(query, schema_text)
+        result = {"answer": generated["answer"]} if generated else handle_schema_query(query, prefix, conversation)
         print(result)
         return result
     elif intent == "query":
-        sql = handle_select_query(query, schema_text)
-        return execute_sql(sql, conn, schema_info, query)
+        sql = generated["sql"] if generated else handle_select_query(query, prefix, conversation)
     elif intent == "modification":
-        sql = handle_modify_query(query, schema_text)
-        return execute_sql(sql, conn, schema_info, query)
+        sql = generated["sql"] if generated else handle_modify_query(query, prefix, conversation)
     else:
         return {"error": f"Unrecognized request type: {intent}"}
+    return run_generated(query, database, conn, schema_info, intent, sql, generated["explanation"] if generated else None,
+                         time.perf_counter() - started, follow_up, session_id, narrative)
+
+# The steps of _dispatch around the LLM calls; async_app.py runs them in threads
+def prepare_query(query, database, conn):
+    """(schema_info, result) where result is set when the catalog answers the question by itself."""
+    with deadline.stage("schema"):
+        schema_info, _ = get_schema_cached(conn, database)
+        return schema_info, resolve_schema_query(query, schema_info, conn)
+
+def answer_from_template(query, namespace, conn, schema_info, narrative=False):
+    """The result of the learned template for a question classified as a read, or None."""
+    hit = template_store.lookup(namespace, query)
+    if not hit:
+        return None
+    print(f"Template hit: {hit['template']}")
+    result = execute_sql(hit["query"], conn, schema_info, query, narrative)
+    if "error" in result:
+        return None
+    result["template"] = hit["template"]
+    return result
+
+def run_generated(query, database, conn, schema_info, intent, sql, explanation_template=None,
+                  generation_seconds=0.0, follow_up=False, session_id=None, narrative=False):
+    """Execute generated SQL: writes on the primary, reads on conn, successful reads learned as templates."""
+    if intent == "modification":
+        return execute_on_primary(sql, database, schema_info, query, session_id)
+    if not is_select(sql):
+        return execute_on_primary(sql, database, schema_info, query, session_id, narrative)
+    result = execute_sql(sql, conn, schema_info, query, narrative, explanation_template)
+    if "error" not in result and not follow_up:
+        template_store.learn(("sql", database), query, sql, "sql", generation_seconds)
+    return result
 
 # CLI interface
 if __name__ == "__main__":
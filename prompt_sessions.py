@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from schema_prompt import estimate_tokens
+from shared_cache import cache_path
+
+# Stable prompt prefixes and conversational sessions.
+#
+# Every LLM prompt is laid out as
+#   system: rules + schema for the database   <- byte-identical for every request on that database
+#   user/assistant turns of the session       <- append-only, so each prompt extends the previous one
+#   user: short task line + the question      <- the only part that changes
+# Both backends reuse work for a repeated prefix: DeepSeek's context cache bills cached prompt tokens
+# separately (usage.prompt_cache_hit_tokens), and Ollama keeps the KV cache of the previous prompt
+# in the loaded model and only evaluates the new tail (prompt_eval_count). Anything that varies per
+# request (the question, pinned fields, timestamps) must stay out of the prefix.
+#
+# Clients opt into multi-turn conversations by sending a session id (X-Session-Id); follow-ups
+# such as "only the ones after 2000" then see the earlier questions and generated queries.
+# Conversations are kept in CHATDB_CACHE_DIR, one small JSON file per session and scope, because
+# consecutive requests of a session are usually served by different worker processes.
+
+SESSION_TTL_SECONDS = float(os.environ.get("CHATDB_SESSION_TTL", "1800"))
+MAX_TURNS = int(os.environ.get("CHATDB_SESSION_TURNS", "6"))
+PRUNE_EVERY = 1000  # recorded turns between sweeps for expired sessions
+
+_usage = {}
+_usage_lock = threading.Lock()
+
+
+class Conversation:
+    def __init__(self, path: str = None, turns: list = None):
+        # a conversation without a file is a throwaway one for a request without a session id
+        self.path = path
+        self.persistent = path is not None
+        self.turns = turns or []  # [(user content, assistant content)]
+        self.lock = threading.Lock()
+
+    def messages(self, prefix: str, suffix: str) -> list:
+        messages = [{"role": "system", "content": prefix}]
+        with self.lock:
+            for question, answer in self.turns:
+                messages.append({"role": "user", "content": question})
+                messages.append({"role": "assistant", "content": answer})
+        messages.append({"role": "user", "content": suffix})
+        return messages
+
+    def record(self, suffix: str, answer: str):
+        if not self.persistent:
+            return
+        with self.lock:
+            self.turns.append((suffix, answer))
+            # dropping the oldest turn shifts the history, but the system prefix still matches
+            del self.turns[:-MAX_TURNS]
+        sessions.append_turn(self.path, suffix, answer)
+
+
+def _read_turns(f, ttl_seconds: float) -> list:
+    if time.time() - os.fstat(f.fileno()).st_mtime > ttl_seconds:
+        return []
+    f.seek(0)
+    try:
+        return [tuple(turn) for turn in json.loads(f.read() or "[]")]
+    except ValueError:
+        return []
+
+
+class SessionStore:
+    """Conversations per (session id, scope), where scope is e.g. ("sql", "employees"), shared by all workers."""
+
+    def __init__(self, ttl_seconds: float = SESSION_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._directory = None
+        self._recorded = 0
+        self._lock = threading.Lock()
+
+    def _session_dir(self, session_id) -> str:
+        if self._directory is None:
+            self._directory = cache_path("sessions")
+        return os.path.join(self._directory, hashlib.sha256(str(session_id).encode("utf-8")).hexdigest()[:32])
+
+    def _path(self, session_id, scope) -> str:
+        name = hashlib.sha256(json.dumps(list(scope)).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self._session_dir(session_id), name + ".json")
+
+    def get(self, session_id, scope) -> Conversation:
+        """The session's conversation, or a throwaway one when there is no session id."""
+        if not session_id or self.ttl_seconds <= 0:
+            return Conversation()
+        import fcntl
+
+        path = self._path(session_id, scope)
+        try:
+            with open(path, encoding="utf-8") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                turns = _read_turns(f, self.ttl_seconds)
+        except OSError:
+            turns = []
+        return Conversation(path, turns)
+
+    def append_turn(self, path: str, suffix: str, answer: str):
+        import fcntl
+
+        # re-read under the lock: another worker may have added a turn since this request loaded it
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a+", encoding="utf-8") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                turns = _read_turns(f, self.ttl_seconds)
+                turns.append((suffix, answer))
+                f.seek(0)
+                f.truncate()
+                json.dump(turns[-MAX_TURNS:], f)
+        except OSError as e:
+            print(f"Could not save the conversation turn: {e}")
+            return
+        with self._lock:
+            self._recorded += 1
+            prune = self._recorded % PRUNE_EVERY == 0
+        if prune:
+            self._prune()
+
+    def has_history(self, session_id, scope) -> bool:
+        if not session_id or self.ttl_seconds <= 0:
+            return False
+        try:
+            return time.time() - os.stat(self._path(session_id, scope)).st_mtime <= self.ttl_seconds
+        except OSError:
+            return False
+
+    def clear(self, session_id):
+        shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+
+    def _sessions(self):
+        self._session_dir("")  # resolves the directory
+        try:
+            return [entry.path for entry in os.scandir(self._directory) if entry.is_dir()]
+        except OSError:
+            return []
+
+    def _last_used(self, session_dir: str) -> float:
+        try:
+            return max((entry.stat().st_mtime for entry in os.scandir(session_dir)), default=0.0)
+        except OSError:
+            return 0.0
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl_seconds
+        for session_dir in self._sessions():
+            if self._last_used(session_dir) < cutoff:
+                shutil.rmtree(session_dir, ignore_errors=True)
+
+    def active(self) -> int:
+        cutoff = time.time() - self.ttl_seconds
+        return sum(1 for session_dir in self._sessions() if self._last_used(session_dir) >= cutoff)
+
+
+def record_usage(backend: str, prompt_tokens: int, cached_tokens: int):
+    with _usage_lock:
+        usage = _usage.setdefault(backend, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        usage["calls"] += 1
+        usage["prompt_tokens"] += prompt_tokens
+        usage["cached_tokens"] += max(0, cached_tokens)
+
+
+def record_deepseek_usage(response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    record_usage("deepseek", getattr(usage, "prompt_tokens", 0) or 0,
+                 getattr(usage, "prompt_cache_hit_tokens", 0) or 0)
+
+
+def record_ollama_usage(messages: list, response):
+    # Ollama only counts the prompt tokens it had to evaluate; the rest came from the KV cache.
+    # The total is estimated, so the cached share is approximate.
+    evaluated = response.get("prompt_eval_count") or 0
+    total = max(evaluated, sum(estimate_tokens(m["content"]) + 4 for m in messages))
+    record_usage("ollama", total, total - evaluated)
+
+
+def stats() -> dict:
+    with _usage_lock:
+        usage = {backend: dict(values) for backend, values in _usage.items()}
+    for values in usage.values():
+        values["cache_hit_rate"] = round(values["cached_tokens"] / max(1, values["prompt_tokens"]), 3)
+    return {"sessions": sessions.active(), "usage": usage}
+
+
+sessions = SessionStore()
@@ -0,0 +1,333 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# Parameterized query templates learned from successful LLM generations.
+#
+# A template pairs a normalized natural language shape ("top <num> cities in <str> by population")
+# with the generated query split into text segments and slots. Literals are only turned into slots
+# when they can be aligned one-to-one between the user input and the generated query, and only
+# where the query holds a value: inside a quoted string, or as a bare numeric literal. Keywords,
+# function, table and field names never become slots. Every other literal stays part of the key,
+# so a template never guesses at constants it has not seen move. Bound values are escaped for the
+# quotes around their slot.
+
+_QUOTED = re.compile(r"\"([^\"]+)\"|'([^']+)'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_PROPER = re.compile(r"\b[A-Z][\w-]*(?:\s+[A-Z][\w-]*)*")
+
+
+def extract_literals(user_input: str) -> list:
+    """Return (start, end, value, kind) for quoted strings, numbers and capitalized words."""
+    literals = []
+    taken = []
+
+    def free(start, end):
+        return all(end <= s or start >= e for s, e in taken)
+
+    for m in _QUOTED.finditer(user_input):
+        value = m.group(1) if m.group(1) is not None else m.group(2)
+        literals.append((m.start(), m.end(), value, "str"))
+        taken.append((m.start(), m.end()))
+    for m in _NUMBER.finditer(user_input):
+        if free(m.start(), m.end()):
+            literals.append((m.start(), m.end(), m.group(0), "num"))
+            taken.append((m.start(), m.end()))
+    for m in _PROPER.finditer(user_input):
+        if free(m.start(), m.end()):
+            literals.append((m.start(), m.end(), m.group(0), "str"))
+            taken.append((m.start(), m.end()))
+    return sorted(literals)
+
+
+def _literal_pattern(value, kind):
+    if kind == "num":
+        return re.compile(r"(?<![\w.])" + re.escape(value) + r"(?![\w.])")
+    # case-sensitive: "Count" in a question must not match COUNT in the query
+    return re.compile(r"(?<!\w)" + re.escape(value) + r"(?!\w)")
+
+
+def _quoted_spans(query_text, dialect):
+    """(start, end, quote) of the contents of every quoted string (and SQL `identifier`) in a query."""
+    quotes = "'\"`" if dialect == "sql" else '"'
+    spans = []
+    i, n = 0, len(query_text)
+    while i < n:
+        quote = query_text[i]
+        if quote not in quotes:
+            i += 1
+            continue
+        j = i + 1
+        while j < n:
+            if query_text[j] == "\\" and quote != "`":
+                j += 2
+            elif query_text[j] == quote and dialect == "sql" and query_text[j + 1:j + 2] == quote:
+                j += 2  # a doubled quote inside the string
+            elif query_text[j] == quote:
+                break
+            else:
+                j += 1
+        spans.append((i + 1, min(j, n), quote))
+        i = j + 1
+    return spans
+
+
+def _slot_quote(query_text, spans, start, end, kind, dialect):
+    """
+    The quote character around a literal found at [start, end) of the query, "" for a bare number,
+    or None when the literal is not a value there (keyword, name, JSON key, partial token).
+    """
+    for s, e, quote in spans:
+        if s <= start and end <= e:
+            if quote == "`":
+                return None
+            if dialect == "json" and query_text[e + 1:].lstrip().startswith(":"):
+                return None  # an object key, i.e. a field name
+            return quote
+        if start < e and s < end:
+            return None
+    return "" if kind == "num" else None
+
+
+def _normalize_key(parts):
+    text = " ".join(parts).lower()
+    text = re.sub(r"[^\w<>#\s-]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def parameterize(user_input: str, query_text: str, dialect: str = "sql"):
+    """
+    Split a (user input, generated query) pair into a template key and query segments.
+    Returns (key, segments, slot_kinds, slot_quotes) or None when the literals cannot be aligned unambiguously.
+    """
+    literals = extract_literals(user_input)
+    spans = _quoted_spans(query_text, dialect)
+    aligned = []
+    seen_values = set()
+    for start, end, value, kind in literals:
+        matches = list(_literal_pattern(value, kind).finditer(query_text))
+        if not matches:
+            continue
+        quotes = {_slot_quote(query_text, spans, m.start(), m.end(), kind, dialect) for m in matches}
+        if len(quotes) != 1 or None in quotes:
+            # not a value everywhere it appears in the query: keep it as part of the key
+            continue
+        # the same constant used twice in the input cannot be told apart in the query
+        if value.lower() in seen_values:
+            return None
+        seen_values.add(value.lower())
+        aligned.append((start, end, value, kind, quotes.pop(), matches))
+
+    # slots must not overlap in the query (e.g. "New York" and "York")
+    spans = sorted((m.start(), m.end()) for *_, matches in aligned for m in matches)
+    if any(prev[1] > cur[0] for prev, cur in zip(spans, spans[1:])):
+        return None
+
+    key_parts = []
+    cursor = 0
+    slot_of_span = {}
+    slot_kinds = []
+    slot_quotes = []
+    for slot, (start, end, value, kind, quote, matches) in enumerate(aligned):
+        key_parts.append(user_input[cursor:start])
+        key_parts.append(f"<{kind}#{slot}>")
+        cursor = end
+        slot_kinds.append(kind)
+        slot_quotes.append(quote)
+        for m in matches:
+            slot_of_span[(m.start(), m.end())] = slot
+    key_parts.append(user_input[cursor:])
+
+    segments = []
+    cursor = 0
+    for start, end in sorted(slot_of_span):
+        segments.append(query_text[cursor:start])
+        segments.append(slot_of_span[(start, end)])
+        cursor = end
+    segments.append(query_text[cursor:])
+    return _normalize_key(key_parts), segments, slot_kinds, slot_quotes
+
+
+def _escape(value, kind, quote, dialect):
+    if not quote:
+        # a bare numeric literal; anything else would change the statement
+        if kind != "num" or not _NUMBER.fullmatch(value):
+            raise ValueError(f"not a number: {value!r}")
+        return value
+    if dialect == "sql":
+        return value.replace("\\", "\\\\").replace(quote, quote * 2)
+    # json: the slot sits inside an already quoted JSON string
+    return json.dumps(value)[1:-1]
+
+
+class QueryTemplate:
+    def __init__(self, segments, slot_kinds, slot_quotes, dialect):
+        self.segments = segments
+        self.slot_kinds = slot_kinds
+        self.slot_quotes = slot_quotes
+        self.dialect = dialect
+        self.support = 1
+        self.conflicted = False
+        self.hits = 0
+        self.generation_seconds = 0.0
+
+    def bind(self, values):
+        out = []
+        for seg in self.segments:
+            if isinstance(seg, int):
+                out.append(_escape(values[seg], self.slot_kinds[seg], self.slot_quotes[seg], self.dialect))
+            else:
+                out.append(seg)
+        return "".join(out)
+
+
+class TemplateStore:
+    """
+    In-memory template index keyed by (namespace, normalized input shape).
+
+    A template only serves lookups once `min_support` distinct generations produced the same
+    query shape for it, and is disabled for good if a later generation disagrees.
+    """
+
+    def __init__(self, min_support: int = 2, max_templates: int = 1000):
+        self.min_support = min_support
+        self.max_templates = max_templates
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "hits": 0, "learned": 0, "conflicts": 0, "seconds_saved": 0.0}
+
+    def lookup(self, namespace, user_input: str):
+        """Return {"query", "template"} for a confident match, otherwise None."""
+        literals = extract_literals(user_input)
+        with self._lock:
+            self._stats["lookups"] += 1
+            for full_key, values, template in self._candidates(namespace, user_input, literals):
+                if template.conflicted or template.support < self.min_support:
+                    continue
+                try:
+                    query = template.bind(values)
+                except ValueError:
+                    continue
+                template.hits += 1
+                self._stats["hits"] += 1
+                self._stats["seconds_saved"] += template.generation_seconds
+                self._templates.move_to_end(full_key)
+                return {"query": query, "template": full_key[1]}
+        return None
+
+    def matches(self, namespace, user_input: str) -> bool:
+        """Whether lookup() would find a template; no statistics are recorded."""
+        literals = extract_literals(user_input)
+        with self._lock:
+            return any(not template.conflicted and template.support >= self.min_support
+                       for _, _, template in self._candidates(namespace, user_input, literals))
+
+    def _candidates(self, namespace, user_input, literals):
+        # A stored key only keeps the literals that were aligned at learn time, so try every
+        # choice of literals as slots (most slots first); inputs with many literals only get exact matches.
+        n = len(literals)
+        masks = sorted(range(1 << n), key=lambda m: -bin(m).count("1")) if n <= 8 else [0]
+        for mask in masks:
+            chosen = [lit for i, lit in enumerate(literals) if mask & (1 << i)]
+            parts = []
+            cursor = 0
+            for slot, (start, end, value, kind) in enumerate(chosen):
+                parts.append(user_input[cursor:start])
+                parts.append(f"<{kind}#{slot}>")
+                cursor = end
+            parts.append(user_input[cursor:])
+            full_key = (namespace, _normalize_key(parts))
+            template = self._templates.get(full_key)
+            if template is not None and template.slot_kinds == [lit[3] for lit in chosen]:
+                yield full_key, [lit[2] for lit in chosen], template
+
+    def learn(self, namespace, user_input: str, query_text: str, dialect: str, generation_seconds: float = 0.0):
+        parsed = parameterize(user_input, query_text, dialect)
+        if parsed is None:
+            return False
+        key, segments, slot_kinds, slot_quotes = parsed
+        full_key = (namespace, key)
+        with self._lock:
+            template = self._templates.get(full_key)
+            if template is None:
+                template = QueryTemplate(segments, slot_kinds, slot_quotes, dialect)
+                template.generation_seconds = generation_seconds
+                self._templates[full_key] = template
+                self._stats["learned"] += 1
+                while len(self._templates) > self.max_templates:
+                    self._templates.popitem(last=False)
+            elif template.segments == segments and template.slot_kinds == slot_kinds \
+                    and template.slot_quotes == slot_quotes:
+                template.support += 1
+                # running mean of what one generation costs for this shape
+                template.generation_seconds += (generation_seconds - template.generation_seconds) / template.support
+            elif not template.conflicted:
+                template.conflicted = True
+                self._stats["conflicts"] += 1
+            self._templates.move_to_end(full_key)
+        return True
+
+    def _merge(self, entries):
+        for entry in entries:
+            if "slot_quotes" not in entry:
+                continue  # saved before slots recorded their quoting; cannot be bound safely
+            full_key = (tuple(entry["namespace"]), entry["key"])
+            template = self._templates.get(full_key)
+            if template is None:
+                template = QueryTemplate(entry["segments"], entry["slot_kinds"], entry["slot_quotes"], entry["dialect"])
+                template.support = entry["support"]
+                template.conflicted = entry["conflicted"]
+                template.generation_seconds = entry["generation_seconds"]
+                self._templates[full_key] = template
+            elif template.segments != entry["segments"] or template.slot_quotes != entry["slot_quotes"] \
+                    or entry["conflicted"]:
+                template.conflicted = True
+            else:
+                # other workers saw the same generations independently; max() keeps re-saves idempotent
+                template.support = max(template.support, entry["support"])
+
+    def _entries(self):
+        return [{
+            "namespace": list(namespace), "key": key, "segments": t.segments, "slot_kinds": t.slot_kinds,
+            "slot_quotes": t.slot_quotes, "dialect": t.dialect, "support": t.support, "conflicted": t.conflicted,
+            "generation_seconds": t.generation_seconds
+        } for (namespace, key), t in self._templates.items()]
+
+    def load(self, path: str):
+        """Merge templates persisted by any worker into this store."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            self._merge(entries)
+
+    def save(self, path: str):
+        """Merge with the on-disk store and write the union back; safe across worker processes."""
+        import fcntl
+
+        with open(path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.load(path)
+            with self._lock:
+                entries = self._entries()[-self.max_templates:]
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["templates"] = len(self._templates)
+            stats["active"] = sum(1 for t in self._templates.values()
+                                  if not t.conflicted and t.support >= self.min_support)
+        stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+        stats["seconds_saved"] = round(stats["seconds_saved"], 3)
+        return stats
+
+
+template_store = TemplateStore()
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import threading
+import time
+
+from shared_cache import cache_path
+
+# Read routing configuration shared by the MongoDB and MySQL paths.
+#
+# Generated reads (Mongo find/aggregate, schema sampling, SQL SELECTs) go to secondaries/replicas,
+# writes always go to the primary. A client that sends a session id gets read-your-writes: after it
+# writes, its reads are pinned to the primary for READ_YOUR_WRITES_SECONDS so replication lag
+# cannot hide its own change. The marker of the last write is shared by all worker processes
+# (see SessionTracker), since the session's next read usually lands on a different worker.
+
+# primary | primaryPreferred | secondary | secondaryPreferred | nearest
+MONGO_READ_PREFERENCE = os.environ.get("MONGO_READ_PREFERENCE", "secondaryPreferred")
+# bounded staleness for secondary reads; MongoDB requires at least 90 seconds, -1 disables the bound
+MONGO_MAX_STALENESS_SECONDS = int(os.environ.get("MONGO_MAX_STALENESS_SECONDS", "90"))
+# comma separated MySQL replica hosts; empty means every statement goes to the primary
+MYSQL_REPLICA_HOSTS = [h.strip() for h in os.environ.get("MYSQL_REPLICA_HOSTS", "").split(",") if h.strip()]
+READ_YOUR_WRITES_SECONDS = float(os.environ.get("READ_YOUR_WRITES_SECONDS", "5"))
+
+
+def mongo_read_preference():
+    from pymongo import read_preferences
+
+    modes = {
+        "primary": read_preferences.Primary,
+        "primaryPreferred": read_preferences.PrimaryPreferred,
+        "secondary": read_preferences.Secondary,
+        "secondaryPreferred": read_preferences.SecondaryPreferred,
+        "nearest": read_preferences.Nearest,
+    }
+    mode = modes.get(MONGO_READ_PREFERENCE, read_preferences.SecondaryPreferred)
+    if mode is read_preferences.Primary:
+        return mode()
+    return mode(max_staleness=MONGO_MAX_STALENESS_SECONDS)
+
+
+class SessionTracker:
+    """
+    Remembers which sessions wrote recently so their reads can be pinned to the primary.
+
+    A session's last write is the modification time of a marker file in CHATDB_CACHE_DIR, so a
+    write through any worker of serving.py pins the reads served by every other worker. Hosts
+    behind one load balancer need that directory on shared storage (or sticky sessions).
+    """
+
+    def __init__(self, window_seconds: float = READ_YOUR_WRITES_SECONDS, prune_every: int = 1000):
+        self.window_seconds = window_seconds
+        self.prune_every = prune_every
+        self._directory = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _path(self, session_id) -> str:
+        if self._directory is None:
+            directory = cache_path("session-writes")
+            os.makedirs(directory, exist_ok=True)
+            self._directory = directory
+        return os.path.join(self._directory, hashlib.sha256(str(session_id).encode("utf-8")).hexdigest()[:32])
+
+    def record_write(self, session_id):
+        if not session_id or self.window_seconds <= 0:
+            return
+        try:
+            path = self._path(session_id)
+            with open(path, "a"):
+                pass
+            os.utime(path)
+        except OSError as e:
+            print(f"Could not record the write of session {session_id}: {e}")
+            return
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.prune_every == 0
+        if prune:
+            self._prune()
+
+    def _prune(self):
+        cutoff = time.time() - self.window_seconds
+        for entry in os.scandir(self._directory):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass  # removed by another worker
+
+    def reads_pinned(self, session_id) -> bool:
+        if not session_id or self.window_seconds <= 0:
+            return False
+        try:
+            return time.time() - os.stat(self._path(session_id)).st_mtime < self.window_seconds
+        except OSError:
+            return False
+
+
+sessions = SessionTracker()
@@ -0,0 +1,234 @@
+import importlib.util
+import math
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import date, time as dtime, timedelta
+from decimal import Decimal
+
+from startup import lazy_import
+
+# Local summaries of query results.
+#
+# Instead of sending the first rows to the LLM for a one-sentence explanation, the whole result is
+# turned into columns and every column is described in one pass: non-null count, null rate, min/max
+# and mean for numbers and dates, most common values for everything else. The numbers are rendered
+# into a short templated sentence, which takes milliseconds. The LLM explanation is still used when
+# the request asks for a narrative, unless the SQL generation already wrote an explanation template
+# (see nl2sql_v2.generate_structured); the template is then filled in from the same statistics.
+#
+# NumPy is optional: numeric columns are reduced with it when it is installed.
+# It is only imported on the first summary so it does not slow down start-up.
+numpy = lazy_import("numpy") if importlib.util.find_spec("numpy") else None
+
+MAX_COLUMNS_IN_TEXT = 6
+TOP_VALUES = 3
+
+_stats = {"local": 0, "narrative": 0, "templated": 0, "local_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def _is_finite(value) -> bool:
+    # inf and NaN, and ints or Decimals too large for a float, cannot take part in min/max/mean
+    if isinstance(value, float):
+        return math.isfinite(value)
+    if isinstance(value, Decimal) and not value.is_finite():
+        return False
+    return abs(value) <= sys.float_info.max
+
+
+def _numeric_stats(values: list) -> dict:
+    if numpy is not None:
+        array = numpy.fromiter(values, dtype=float, count=len(values))
+        low, high, mean, total = array.min(), array.max(), array.mean(), array.sum()
+    else:
+        floats = [float(v) for v in values]
+        low, high, total = min(floats), max(floats), sum(floats)
+        mean = total / len(floats)
+    return {"kind": "number", "min": float(low), "max": float(high), "mean": float(mean), "sum": float(total)}
+
+
+def describe_column(values: list) -> dict:
+    """Statistics for one column of a result set."""
+    present = [v for v in values if v is not None]
+    stats = {"count": len(present), "nulls": len(values) - len(present),
+             "null_rate": round((len(values) - len(present)) / len(values), 3) if values else 0.0}
+    if not present:
+        stats["kind"] = "empty"
+        return stats
+    if all(_is_number(v) for v in present):
+        # non-finite values are counted instead of being summarized
+        finite = [v for v in present if _is_finite(v)]
+        if len(finite) < len(present):
+            stats["non_finite"] = len(present) - len(finite)
+        if not finite:
+            stats["kind"] = "non_finite"
+            return stats
+        stats.update(_numeric_stats(finite))
+        return stats
+    if all(isinstance(v, (date, dtime, timedelta)) for v in present):
+        try:
+            stats.update(kind="date", min=str(min(present)), max=str(max(present)))
+            return stats
+        except TypeError:
+            pass  # mixed date and datetime values; fall through to categorical
+    if all(isinstance(v, (list, dict)) for v in present):
+        stats["kind"] = "nested"
+        return stats
+    counts = Counter(v.decode(errors="replace") if isinstance(v, bytes) else str(v) for v in present)
+    stats.update(kind="text", distinct=len(counts),
+                 top=[{"value": v, "count": c} for v, c in counts.most_common(TOP_VALUES)])
+    return stats
+
+
+def _format_number(value: float) -> str:
+    if not math.isfinite(value):
+        return str(value)
+    if abs(value) < 1e15 and value == int(value):
+        return f"{int(value):,}"
+    return f"{value:,.2f}"
+
+
+def _describe_in_words(name: str, stats: dict, rows: int) -> str:
+    missing = f" ({stats['nulls']} missing)" if stats["nulls"] else ""
+    kind = stats["kind"]
+    if kind == "number":
+        non_finite = f", {stats['non_finite']} not finite" if stats.get("non_finite") else ""
+        if stats["min"] == stats["max"]:
+            return f"{name} is {_format_number(stats['min'])} throughout{missing}{non_finite}"
+        nulls = f", {stats['nulls']} missing" if stats["nulls"] else ""
+        nulls += non_finite
+        return (f"{name} ranges from {_format_number(stats['min'])} to {_format_number(stats['max'])}"
+                f" (mean {_format_number(stats['mean'])}{nulls})")
+    if kind == "date":
+        return f"{name} spans {stats['min']} to {stats['max']}{missing}"
+    if kind == "text":
+        top = stats["top"][0]
+        if stats["distinct"] == stats["count"]:
+            examples = ", ".join(t["value"] for t in stats["top"])
+            return f"{name} has {stats['distinct']} distinct values, e.g. {examples}{missing}"
+        return (f"{name} has {stats['distinct']} distinct values, most often {top['value']}"
+                f" ({top['count']} of {rows}){missing}")
+    if kind == "empty":
+        return f"{name} is always empty"
+    if kind == "non_finite":
+        return f"{name} has no finite values{missing}"
+    return f"{name} holds nested values"
+
+
+def summarize_columns(columns: dict, rows: int) -> dict:
+    """{"text", "rows", "columns": {name: stats}} for a result given as {name: [values]}."""
+    started = time.perf_counter()
+    described = {name: describe_column(values) for name, values in columns.items()}
+
+    if rows == 0:
+        text = "No rows returned."
+    elif rows == 1:
+        # a single row (usually an aggregate) reads best as the values themselves
+        values = ", ".join(f"{name} = {_single_value(values[0])}" for name, values in
+                           list(columns.items())[:MAX_COLUMNS_IN_TEXT])
+        text = f"1 row: {values}."
+    else:
+        parts = [_describe_in_words(name, stats, rows) for name, stats in
+                 list(described.items())[:MAX_COLUMNS_IN_TEXT]]
+        more = len(described) - MAX_COLUMNS_IN_TEXT
+        plural = "s" if len(described) != 1 else ""
+        text = f"{rows} rows, {len(described)} column{plural}. " + "; ".join(parts)
+        text += f"; and {more} more columns." if more > 0 else "."
+
+    with _stats_lock:
+        _stats["local"] += 1
+        _stats["local_seconds"] += time.perf_counter() - started
+    return {"text": text, "rows": rows, "columns": described}
+
+
+def _single_value(value) -> str:
+    if _is_number(value):
+        return _format_number(float(value))
+    return str(value)
+
+
+def summarize_rows(rows: list, column_names: list) -> dict:
+    """Summarize a DB-API result (list of tuples) with its column names."""
+    # one transpose turns the row-major result into columns
+    columns = list(zip(*rows)) if rows else [() for _ in column_names]
+    return summarize_columns({name: list(values) for name, values in zip(column_names, columns)}, len(rows))
+
+
+def flatten_document(doc: dict, prefix: str = "", out: dict = None) -> dict:
+    """Embedded documents become dotted keys; arrays and scalars are kept as values."""
+    if out is None:
+        out = {}
+    for key, value in doc.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict) and value:
+            flatten_document(value, path, out)
+        else:
+            out[path] = value
+    return out
+
+
+def summarize_documents(docs: list) -> dict:
+    """Summarize MongoDB find/aggregate results; embedded documents become dotted columns."""
+    flat = [flatten_document(doc) for doc in docs]
+    names = list(dict.fromkeys(name for doc in flat for name in doc))
+    return summarize_columns({name: [doc.get(name) for doc in flat] for name in names}, len(flat))
+
+
+_PLACEHOLDER = re.compile(r"\{([^{}]+)\}")
+
+
+def render_explanation(template: str, summary: dict):
+    """Fill an explanation template written together with the query.
+
+    Placeholders are {rows}, {column} for a column with a single value, and {column.stat} for any
+    statistic of describe_column (min, max, mean, sum, distinct, ...; top is the most common value).
+    Returns None when a placeholder does not match the result.
+    """
+    columns = summary["columns"]
+
+    def value_of(match):
+        name = match.group(1).strip()
+        if name == "rows":
+            return str(summary["rows"])
+        column, _, stat = name.rpartition(".")
+        if not column or column not in columns:
+            column, stat = name, "value"
+        stats = columns.get(column)
+        if stats is None:
+            raise KeyError(name)
+        if stat == "value":
+            if stats["kind"] == "number" and stats["min"] == stats["max"]:
+                return _format_number(stats["min"])
+            if stats["kind"] == "text" and stats["distinct"] == 1:
+                return stats["top"][0]["value"]
+            raise KeyError(name)
+        if stat == "top" and stats.get("top"):
+            return stats["top"][0]["value"]
+        value = stats[stat]
+        return _format_number(float(value)) if _is_number(value) else str(value)
+
+    try:
+        return _PLACEHOLDER.sub(value_of, template).strip() or None
+    except KeyError:
+        return None
+
+
+def record_narrative(templated: bool = False):
+    with _stats_lock:
+        _stats["templated" if templated else "narrative"] += 1
+
+
+def stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    seconds = stats.pop("local_seconds")
+    stats["local_seconds_mean"] = round(seconds / stats["local"], 6) if stats["local"] else 0.0
+    stats["numpy"] = numpy is not None
+    return stats
@@ -0,0 +1,586 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+# Auto-materialized pre-aggregations ("rollups") for recurring aggregate questions.
+#
+# Every executed aggregate is reduced to its shape: the Mongo $group stage or the SQL
+# table/WHERE/GROUP BY/aggregates. Once a shape has been executed ROLLUP_MIN_HITS times, taking at
+# least ROLLUP_MIN_SECONDS each time, its grouped output is materialized next to the source data:
+#   MongoDB: a "_rollup_<hash>" collection, written with $out (full) or $merge (touched groups)
+#   MySQL:   a "_rollup_<hash>" table, refreshed with DELETE + INSERT ... SELECT in one transaction
+# Later queries with the same shape read the rollup instead: leading $match stages on group keys
+# and the stages after $group run against the rollup, and the SQL is rewritten to select the
+# stored aggregate columns.
+#
+# A "_chatdb_rollups" collection/table in each database records, for every rollup, its source,
+# a write version and whether it is stale. Writes through handle_modify / execute_sql bump the
+# version and mark the rollups of the written collection/table stale before the write is sent
+# (before_write), and refresh them in the background once it is done (after_write); the refresh
+# clears the flag only if no newer write came in meanwhile. Stale rollups are never read, and the
+# flag lives in the database, so every worker process sees it. Writes made outside the app are not
+# tracked. The names of existing rollups are cached for ROLLUP_META_SECONDS per database, so
+# aggregates without a rollup do not query the meta table; a newly built rollup can take that
+# long to be used by other workers.
+#
+# Off unless CHATDB_ROLLUPS=1: materializing writes collections/tables into the users' databases.
+
+ROLLUPS_ENABLED = os.environ.get("CHATDB_ROLLUPS", "0") == "1"
+ROLLUP_MIN_HITS = int(os.environ.get("ROLLUP_MIN_HITS", "3"))
+ROLLUP_MIN_SECONDS = float(os.environ.get("ROLLUP_MIN_SECONDS", "0.05"))
+ROLLUP_MAX_PER_DB = int(os.environ.get("ROLLUP_MAX_PER_DB", "20"))
+ROLLUP_META_SECONDS = 30
+INCREMENTAL_MAX_GROUPS = 1000
+META = "_chatdb_rollups"
+
+
+def is_internal(name: str) -> bool:
+    """Rollup collections/tables and the meta table are hidden from schemas and catalogs."""
+    return name.startswith("_rollup_") or name == META
+
+
+def rollup_name(shape) -> str:
+    return "_rollup_" + hashlib.sha1(json.dumps(shape, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+class _Registry:
+    """Hit counting and per-process bookkeeping shared by both engines."""
+
+    def __init__(self):
+        self.hits = {}
+        self.known = {}  # rollup name -> shape info, once materialized (or seen in the meta table)
+        self.building = set()
+        self.rejected = set()  # shapes not built because their database already has ROLLUP_MAX_PER_DB
+        self.listed = {}  # per-db key -> (loaded at, names in the meta table)
+        self.lock = threading.Lock()
+        self.stats = {"observed": 0, "materialized": 0, "refreshes": 0, "incremental_refreshes": 0,
+                      "answered": 0, "stale_skips": 0, "over_limit": 0, "errors": 0}
+
+    def count(self, name) -> bool:
+        """Record one expensive execution; True when the shape should be materialized now."""
+        with self.lock:
+            self.stats["observed"] += 1
+            if name in self.known or name in self.building or name in self.rejected:
+                return False
+            self.hits[name] = self.hits.get(name, 0) + 1
+            if self.hits[name] < ROLLUP_MIN_HITS:
+                return False
+            self.building.add(name)
+            return True
+
+    def names(self, per_db_key, loader) -> set:
+        """Rollup names in a database's meta table, reloaded every ROLLUP_META_SECONDS."""
+        with self.lock:
+            entry = self.listed.get(per_db_key)
+        if entry and time.monotonic() - entry[0] < ROLLUP_META_SECONDS:
+            return entry[1]
+        try:
+            names = set(loader())
+        except Exception:
+            names = set()  # no meta table/collection in this database yet
+        with self.lock:
+            self.listed[per_db_key] = (time.monotonic(), names)
+        return names
+
+    def remember(self, name, per_db_key, source):
+        # materialized by this or another worker process
+        with self.lock:
+            self.known.setdefault(name, {"db": per_db_key, "source": source})
+            entry = self.listed.get(per_db_key)
+            if entry:
+                entry[1].add(name)
+
+    def reject(self, name):
+        with self.lock:
+            self.rejected.add(name)
+            self.stats["over_limit"] += 1
+
+    def bump(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+
+def _background(name, fn):
+    thread = threading.Thread(target=fn, name=f"chatdb-rollup-{name}", daemon=True)
+    thread.start()
+    return thread
+
+
+# --- MongoDB ---
+
+class MongoRollups:
+    def __init__(self):
+        self.registry = _Registry()
+
+    @staticmethod
+    def shape(collection, pipeline):
+        """(group stage, leading $match stages, tail stages) or None when the pipeline has no usable $group."""
+        if not isinstance(pipeline, list):
+            return None
+        group_at = next((i for i, stage in enumerate(pipeline) if isinstance(stage, dict) and "$group" in stage), None)
+        if group_at is None:
+            return None
+        head, tail = pipeline[:group_at], pipeline[group_at + 1:]
+        if any(list(stage) != ["$match"] for stage in head):
+            return None  # $lookup/$unwind/... before grouping change what is grouped
+        if any("$out" in stage or "$merge" in stage for stage in tail):
+            return None
+        return pipeline[group_at]["$group"], head, tail
+
+    @staticmethod
+    def key_fields(group):
+        """Source field -> rollup path for group keys that are plain field references."""
+        _id = group.get("_id")
+        if isinstance(_id, str) and _id.startswith("$"):
+            return {_id[1:]: "_id"}
+        if isinstance(_id, dict) and all(isinstance(v, str) and v.startswith("$") for v in _id.values()):
+            return {v[1:]: f"_id.{k}" for k, v in _id.items()}
+        return {}
+
+    def _rewrite_matches(self, head, group):
+        # a $match before $group can only be answered from the rollup if it filters on group keys
+        fields = self.key_fields(group)
+        stages = []
+        for stage in head:
+            match = stage["$match"]
+            if any(k.startswith("$") or k not in fields for k in match):
+                return None
+            stages.append({"$match": {fields[k]: v for k, v in match.items()}})
+        return stages
+
+    def answer(self, primary_db, read_db, collection, pipeline, max_time_ms=None):
+        """Results from a fresh rollup as (rollup name, documents), or None."""
+        if not ROLLUPS_ENABLED:
+            return None
+        shape = self.shape(collection, pipeline)
+        if shape is None:
+            return None
+        group, head, tail = shape
+        matches = self._rewrite_matches(head, group)
+        if matches is None:
+            return None
+        name = rollup_name(["mongodb", primary_db.name, collection, group])
+        known = self.registry.names(("mongodb", primary_db.name),
+                                    lambda: [m["_id"] for m in primary_db[META].find({}, {"_id": 1})])
+        if name not in known:
+            return None
+        # the stale flag is always read from the database: another worker may just have written
+        meta = primary_db[META].find_one({"_id": name}, {"stale": 1})
+        if meta is None:
+            return None
+        self.registry.remember(name, ("mongodb", primary_db.name), collection)
+        if meta.get("stale"):
+            self.registry.bump("stale_skips")
+            return None
+        self.registry.bump("answered")
+        options = {"maxTimeMS": max_time_ms} if max_time_ms else {}
+        return name, list(read_db[name].aggregate(matches + tail, **options))
+
+    def observe(self, primary_db, collection, pipeline, seconds):
+        """Count an executed pipeline; materialize its shape in the background once it recurs."""
+        if not ROLLUPS_ENABLED or seconds < ROLLUP_MIN_SECONDS:
+            return
+        shape = self.shape(collection, pipeline)
+        # a leading $match on anything but the group keys could never be answered from the rollup
+        if shape is None or self._rewrite_matches(shape[1], shape[0]) is None:
+            return
+        group = shape[0]
+        name = rollup_name(["mongodb", primary_db.name, collection, group])
+        if self.registry.count(name):
+            _background(name, lambda: self._materialize(primary_db, name, collection, group))
+
+    def _materialize(self, db, name, collection, group):
+        try:
+            created = db[META].update_one({"_id": name},
+                                          {"$setOnInsert": {"source": collection, "group": json.dumps(group),
+                                                            "version": 0, "stale": True}},
+                                          upsert=True).upserted_id is not None
+            if not created:
+                # another worker built (or is building) it
+                self.registry.remember(name, ("mongodb", db.name), collection)
+                return
+            # the limit counts what every worker created; an entry over it removes itself again
+            if db[META].count_documents({}) > ROLLUP_MAX_PER_DB:
+                db[META].delete_one({"_id": name})
+                self.registry.reject(name)
+                return
+            self._refresh_full(db, name, collection, group)
+            self.registry.remember(name, ("mongodb", db.name), collection)
+            self.registry.bump("materialized")
+            print(f"Materialized rollup {name} for {db.name}.{collection}")
+        except Exception as e:
+            self.registry.bump("errors")
+            print(f"Rollup {name} failed: {e}")
+        finally:
+            with self.registry.lock:
+                self.registry.building.discard(name)
+
+    def _refresh_full(self, db, name, collection, group):
+        version = db[META].find_one({"_id": name})["version"]
+        db[collection].aggregate([{"$group": group}, {"$out": name}])
+        self._mark_fresh(db, name, version)
+
+    def _refresh_groups(self, db, name, collection, group, docs):
+        # only the groups the inserted documents fall into are recomputed and merged
+        fields = self.key_fields(group)
+        keys = {json.dumps({f: _get_path(doc, f) for f in fields}, sort_keys=True, default=str): doc for doc in docs}
+        if not fields or len(keys) > INCREMENTAL_MAX_GROUPS:
+            return self._refresh_full(db, name, collection, group)
+        version = db[META].find_one({"_id": name})["version"]
+        match = {"$or": [{f: _get_path(doc, f) for f in fields} for doc in keys.values()]}
+        db[collection].aggregate([{"$match": match}, {"$group": group},
+                                  {"$merge": {"into": name, "on": "_id", "whenMatched": "replace",
+                                              "whenNotMatched": "insert"}}])
+        self.registry.bump("incremental_refreshes")
+        self._mark_fresh(db, name, version)
+
+    @staticmethod
+    def _mark_fresh(db, name, version):
+        # a write that arrived during the refresh bumped the version; the rollup then stays stale
+        db[META].update_one({"_id": name, "version": version},
+                            {"$set": {"stale": False, "refreshed_at": time.time()}})
+
+    def before_write(self, db, collection):
+        """Mark the rollups of a collection stale before it is written; pass the result to after_write."""
+        if not ROLLUPS_ENABLED or not collection:
+            return None
+        # not the cached names: a rollup another worker just built must be marked as well
+        try:
+            rollups = list(db[META].find({"source": collection}))
+            for meta in rollups:
+                before = db[META].find_one_and_update({"_id": meta["_id"]},
+                                                      {"$inc": {"version": 1}, "$set": {"stale": True}})
+                meta["was_fresh"] = before is not None and not before.get("stale")
+        except Exception as e:
+            self.registry.bump("errors")
+            print(f"Could not mark rollups of {collection} stale: {e}")
+            return None
+        return rollups or None
+
+    def after_write(self, db, collection, rollups, action, inserted=None):
+        """Refresh the rollups that before_write marked stale, in the background."""
+        if not rollups:
+            return
+        docs = inserted if isinstance(inserted, list) else [inserted] if isinstance(inserted, dict) else None
+
+        def refresh():
+            for meta in rollups:
+                group = json.loads(meta["group"])
+                try:
+                    if action in ("insertOne", "insertMany") and docs and meta["was_fresh"]:
+                        self._refresh_groups(db, meta["_id"], collection, group, docs)
+                    else:
+                        self._refresh_full(db, meta["_id"], collection, group)
+                    self.registry.bump("refreshes")
+                except Exception as e:
+                    self.registry.bump("errors")
+                    print(f"Rollup refresh {meta['_id']} failed: {e}")
+
+        _background(collection, refresh)
+
+
+def _get_path(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+# --- MySQL ---
+
+_SQL_SHAPE = re.compile(
+    r"^\s*SELECT\s+(?P<select>.+?)\s+FROM\s+`?(?P<table>\w+)`?(?:\s+(?:AS\s+)?(?P<alias>(?!WHERE\b|GROUP\b)\w+))?"
+    r"(?:\s+WHERE\s+(?P<where>.+?))?\s+GROUP\s+BY\s+(?P<group>.+?)"
+    r"(?:\s+HAVING\s+(?P<having>.+?))?(?:\s+ORDER\s+BY\s+(?P<order>.+?))?"
+    r"(?:\s+LIMIT\s+(?P<limit>\d+(?:\s*,\s*\d+)?))?\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL)
+_AGGREGATE = re.compile(r"\b(COUNT|SUM|AVG|MIN|MAX)\s*\(\s*(DISTINCT\s+)?([^()]*?)\s*\)", re.IGNORECASE)
+_JOIN_OR_SUBQUERY = re.compile(r"\bJOIN\b|\(\s*SELECT\b|\bUNION\b|\bWITH\b|\bROLLUP\b", re.IGNORECASE)
+
+
+def _split_top_level(text):
+    """Split a select list on the commas that are not inside parentheses."""
+    items, depth, start = [], 0, 0
+    for i, ch in enumerate(text):
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            items.append(text[start:i].strip())
+            start = i + 1
+    items.append(text[start:].strip())
+    return items
+
+
+class SqlRollups:
+    def __init__(self):
+        self.registry = _Registry()
+        self._meta_ready = set()
+
+    @staticmethod
+    def _unqualify(text, alias, table):
+        for prefix in filter(None, (alias, table)):
+            text = re.sub(rf"`?\b{re.escape(prefix)}`?\.", "", text)
+        return text
+
+    def shape(self, database, sql):
+        m = _SQL_SHAPE.match(sql)
+        if not m or _JOIN_OR_SUBQUERY.search(sql):
+            return None
+        table, alias = m.group("table"), m.group("alias")
+        group = [self._unqualify(c.strip(), alias, table).strip("`") for c in m.group("group").split(",")]
+        if not all(re.fullmatch(r"\w+", c) for c in group):
+            return None  # grouping on expressions
+        aggregates = []
+        for part in ("select", "having", "order"):
+            for agg in _AGGREGATE.finditer(m.group(part) or ""):
+                normalized = self._normalize_aggregate(agg, alias, table)
+                if normalized not in aggregates:
+                    aggregates.append(normalized)
+        if not aggregates:
+            return None
+        where = " ".join(self._unqualify(m.group("where") or "", alias, table).split())
+        return {"database": database, "table": table, "alias": alias, "where": where, "group": group,
+                "aggregates": sorted(aggregates), "match": m}
+
+    def _normalize_aggregate(self, agg, alias, table):
+        func, distinct, arg = agg.group(1).upper(), agg.group(2), agg.group(3)
+        arg = " ".join(self._unqualify(arg, alias, table).split())
+        return f"{func}({'DISTINCT ' if distinct else ''}{arg})"
+
+    @staticmethod
+    def _name(shape):
+        return rollup_name(["mysql", shape["database"], shape["table"], shape["where"], shape["group"],
+                            shape["aggregates"]])
+
+    def rewrite(self, shape, name):
+        """The query against the rollup table: aggregates become their stored columns."""
+        m, alias, table = shape["match"], shape["alias"], shape["table"]
+        columns = {agg: f"agg_{i}" for i, agg in enumerate(shape["aggregates"])}
+
+        def replace(text):
+            text = _AGGREGATE.sub(lambda a: f"`{columns[self._normalize_aggregate(a, alias, table)]}`", text)
+            return self._unqualify(text, alias, table)
+
+        items = []
+        for item in _split_top_level(m.group("select")):
+            if _AGGREGATE.fullmatch(item):
+                # keep the column name the base query would have returned
+                items.append(f"{replace(item)} AS `{item.replace('`', '')}`")
+            else:
+                items.append(replace(item))
+        sql = f"SELECT {', '.join(items)} FROM `{name}`"
+        if m.group("having"):
+            sql += f" WHERE {replace(m.group('having'))}"
+        if m.group("order"):
+            sql += f" ORDER BY {replace(m.group('order'))}"
+        if m.group("limit"):
+            sql += f" LIMIT {m.group('limit')}"
+        return sql + ";"
+
+    def answer(self, conn, sql):
+        """(rollup name, rewritten SQL) when a fresh rollup covers this query, else None."""
+        if not ROLLUPS_ENABLED:
+            return None
+        shape = self.shape(conn.database, sql)
+        if shape is None:
+            return None
+        name = self._name(shape)
+        if name not in self.registry.names(("mysql", conn.database), lambda: self._list_names(conn)):
+            return None
+        # the stale flag is always read from the database: another worker may just have written
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SELECT stale FROM `{META}` WHERE name = %s", (name,))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        if row is None:
+            return None
+        self.registry.remember(name, ("mysql", conn.database), shape["table"])
+        if row[0]:
+            self.registry.bump("stale_skips")
+            return None
+        self.registry.bump("answered")
+        return name, self.rewrite(shape, name)
+
+    @staticmethod
+    def _list_names(conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SELECT name FROM `{META}`")
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def observe(self, database, sql, seconds, connect):
+        """Count an executed SELECT; materialize its shape in the background once it recurs."""
+        if not ROLLUPS_ENABLED or seconds < ROLLUP_MIN_SECONDS:
+            return
+        shape = self.shape(database, sql)
+        if shape is None:
+            return
+        name = self._name(shape)
+        if self.registry.count(name):
+            _background(name, lambda: self._materialize(shape, name, connect))
+
+    @staticmethod
+    def _source_select(shape):
+        aggregates = ", ".join(f"{agg} AS `agg_{i}`" for i, agg in enumerate(shape["aggregates"]))
+        group = ", ".join(f"`{c}`" for c in shape["group"])
+        where = f" WHERE {shape['where']}" if shape["where"] else ""
+        return f"SELECT {group}, {aggregates} FROM `{shape['table']}`{where} GROUP BY {group}"
+
+    def _ensure_meta(self, conn):
+        if conn.database in self._meta_ready:
+            return
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"""CREATE TABLE IF NOT EXISTS `{META}` (
+                name VARCHAR(64) PRIMARY KEY, source VARCHAR(64) NOT NULL, shape TEXT NOT NULL,
+                version INT NOT NULL DEFAULT 0, stale TINYINT NOT NULL DEFAULT 1,
+                refreshed_at TIMESTAMP NULL, KEY idx_source (source))""")
+            conn.commit()
+        finally:
+            cursor.close()
+        self._meta_ready.add(conn.database)
+
+    def _materialize(self, shape, name, connect):
+        conn = connect()
+        try:
+            self._ensure_meta(conn)
+            cursor = conn.cursor()
+            try:
+                stored = {k: v for k, v in shape.items() if k != "match"}
+                cursor.execute(f"INSERT IGNORE INTO `{META}` (name, source, shape) VALUES (%s, %s, %s)",
+                               (name, shape["table"], json.dumps(stored)))
+                created = cursor.rowcount == 1
+                cursor.execute(f"SELECT COUNT(*) FROM `{META}`")
+                over_limit = cursor.fetchone()[0] > ROLLUP_MAX_PER_DB
+                if created and over_limit:
+                    # the limit counts what every worker created; an entry over it removes itself again
+                    cursor.execute(f"DELETE FROM `{META}` WHERE name = %s", (name,))
+                conn.commit()
+                if not created:
+                    # another worker built (or is building) it
+                    self.registry.remember(name, ("mysql", shape["database"]), shape["table"])
+                    return
+                if over_limit:
+                    self.registry.reject(name)
+                    return
+                # LIMIT 0 creates the table with the column types of the grouped result
+                cursor.execute(f"CREATE TABLE IF NOT EXISTS `{name}` AS {self._source_select(shape)} LIMIT 0")
+                conn.commit()
+            finally:
+                cursor.close()
+            self._refresh(conn, name, shape)
+            self.registry.remember(name, ("mysql", shape["database"]), shape["table"])
+            self.registry.bump("materialized")
+            print(f"Materialized rollup {name} for {shape['database']}.{shape['table']}")
+        except Exception as e:
+            self.registry.bump("errors")
+            print(f"Rollup {name} failed: {e}")
+        finally:
+            conn.close()
+            with self.registry.lock:
+                self.registry.building.discard(name)
+
+    def _refresh(self, conn, name, shape):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SELECT version FROM `{META}` WHERE name = %s", (name,))
+            version = cursor.fetchone()[0]
+            conn.commit()
+            # readers keep seeing the previous contents until the transaction commits
+            conn.start_transaction()
+            cursor.execute(f"DELETE FROM `{name}`")
+            cursor.execute(f"INSERT INTO `{name}` {self._source_select(shape)}")
+            cursor.execute(f"UPDATE `{META}` SET stale = 0, refreshed_at = NOW() WHERE name = %s AND version = %s",
+                           (name, version))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def written_table(sql):
+        m = re.match(r"\s*(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM)\s+`?(\w+)`?", sql,
+                     re.IGNORECASE)
+        return m.group(1) if m else None
+
+    def before_write(self, database, sql, connect):
+        """
+        Mark the rollups over the table a statement writes stale before it runs, so no reader can
+        see them between the write and their refresh. Pass the result to after_write.
+        """
+        table = self.written_table(sql)
+        if not ROLLUPS_ENABLED or not table or table.startswith("_"):
+            return None
+        conn = connect()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"SELECT name, shape, version + 1, stale = 0 FROM `{META}` WHERE source = %s "
+                               f"FOR UPDATE", (table,))
+                rollups = cursor.fetchall()
+                cursor.execute(f"UPDATE `{META}` SET version = version + 1, stale = 1 WHERE source = %s", (table,))
+                conn.commit()
+            finally:
+                cursor.close()
+        except Exception:
+            return None  # no rollups in this database
+        finally:
+            conn.close()
+        return rollups or None
+
+    def after_write(self, rollups, changed_rows, connect):
+        """
+        Bring the rollups before_write marked stale up to date in the background. A statement that
+        changed no rows only clears the flag again on rollups that were fresh; anything else rebuilds them.
+        """
+        if not rollups:
+            return
+
+        def refresh():
+            conn = connect()
+            try:
+                for name, stored, version, was_fresh in rollups:
+                    try:
+                        if changed_rows == 0 and was_fresh:
+                            self._mark_fresh(conn, name, version)
+                        else:
+                            self._refresh(conn, name, json.loads(stored))
+                            self.registry.bump("refreshes")
+                    except Exception as e:
+                        self.registry.bump("errors")
+                        print(f"Rollup refresh {name} failed: {e}")
+            finally:
+                conn.close()
+
+        _background(rollups[0][0], refresh)
+
+    @staticmethod
+    def _mark_fresh(conn, name, version):
+        # only if no other write came in after ours
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"UPDATE `{META}` SET stale = 0 WHERE name = %s AND version = %s", (name, version))
+            conn.commit()
+        finally:
+            cursor.close()
+
+
+mongo = MongoRollups()
+sql = SqlRollups()
+
+
+def stats() -> dict:
+    return {"enabled": ROLLUPS_ENABLED, "mongodb": dict(mongo.registry.stats, known=len(mongo.registry.known)),
+            "mysql": dict(sql.registry.stats, known=len(sql.registry.known))}
@@ -0,0 +1,169 @@
+import os
+import re
+import threading
+
+# Compact, token-budgeted schema encoding for LLM prompts.
+#
+# Flattened field paths repeat their prefixes on every line ("prizes.laureates.firstname",
+# "prizes.laureates.surname", ...). The encoder writes each collection/table as one nested tree
+# with the shared prefix written once and abbreviated types:
+#
+#   laureates(_id:oid,year:str,prizes:arr[category:str,laureates:arr[firstname:str,surname:str]])
+#
+# When the text does not fit the token budget, the least frequent fields are dropped first
+# (deepest first among equals). Id/key fields are never dropped, nor are fields named in `query` when
+# one is passed; the stable prompt prefixes (prompt_sessions.py) pass none.
+
+SCHEMA_TOKEN_BUDGET = int(os.environ.get("SCHEMA_TOKEN_BUDGET", "1500"))
+
+TYPE_ABBREVIATIONS = {
+    "string": "str", "int": "int", "double": "dbl", "number": "num", "boolean": "bool",
+    "object": "obj", "array": "arr", "array<object>": "arr", "ObjectId": "oid", "unknown": "?",
+    "varchar": "str", "char": "str", "text": "txt", "mediumtext": "txt", "longtext": "txt",
+    "tinyint": "int", "smallint": "int", "mediumint": "int", "bigint": "int", "year": "int",
+    "decimal": "dec", "float": "num", "datetime": "dt", "timestamp": "dt", "date": "date",
+    "time": "time", "blob": "blob", "longblob": "blob", "set": "set",
+}
+
+_stats = {"encodings": 0, "tokens_verbose": 0, "tokens_compact": 0, "fields_dropped": 0}
+_stats_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough BPE token count: ~4 characters per word piece, punctuation counts separately."""
+    tokens = 0
+    for piece in re.findall(r"\w+|[^\w\s]", text):
+        tokens += (len(piece) + 3) // 4 if piece[0].isalnum() or piece[0] == "_" else 1
+    return tokens
+
+
+def abbreviate_type(type_name: str) -> str:
+    type_name = type_name.decode() if isinstance(type_name, bytes) else str(type_name)
+    enum = re.match(r"(enum|set)\((.*)\)", type_name, re.IGNORECASE)
+    if enum:
+        # enum values are what WHERE clauses need: keep them, drop the quoting
+        values = [v.strip().strip("'") for v in enum.group(2).split(",")]
+        return f"{enum.group(1).lower()}{{{'|'.join(values)}}}"
+    base = re.sub(r"\(.*\)|\s+unsigned", "", type_name).strip()
+    return TYPE_ABBREVIATIONS.get(base, TYPE_ABBREVIATIONS.get(base.lower(), base.lower()))
+
+
+def _query_terms(query: str) -> set:
+    return {w.lower() for w in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", query or "")}
+
+
+def _pinned(path: str, terms: set) -> bool:
+    leaf = path.rsplit(".", 1)[-1]
+    is_key = leaf.lower() in ("_id", "id") or leaf.endswith(("_id", "Id", "ID", "_no"))
+    return is_key or leaf.lower() in terms
+
+
+def _render(fields: dict) -> str:
+    # fields: ordered {path: abbreviated type}; children follow their parent path
+    tree = {}
+    for path, ftype in fields.items():
+        node = tree
+        parts = path.split(".")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {"type": "obj", "children": {}})["children"]
+        entry = node.setdefault(parts[-1], {"type": ftype, "children": {}})
+        entry["type"] = ftype
+
+    def render(children):
+        out = []
+        for name, entry in children.items():
+            if entry["children"]:
+                inner = render(entry["children"])
+                # arrays of objects use [...], embedded documents {...}
+                out.append(f"{name}:[{inner}]" if entry["type"] == "arr" else f"{name}:{{{inner}}}")
+            else:
+                out.append(f"{name}:{entry['type']}")
+        return ",".join(out)
+
+    return render(tree)
+
+
+def encode_schema(tables: dict, frequencies: dict = None, budget: int = None, query: str = None) -> dict:
+    """
+    Encode {table: {path: type}} as compact text within `budget` tokens.
+    `frequencies` maps table -> {path: fraction of sampled rows/documents that have it}.
+    Returns {"text", "tokens", "fields", "dropped"}.
+    """
+    budget = SCHEMA_TOKEN_BUDGET if budget is None else budget
+    frequencies = frequencies or {}
+    terms = _query_terms(query)
+    kept = {t: {p: abbreviate_type(ftype) for p, ftype in fields.items()} for t, fields in tables.items()}
+
+    def text_of():
+        lines = []
+        for table, fields in kept.items():
+            more = len(tables[table]) - len(fields)
+            suffix = f",+{more} more" if more else ""
+            lines.append(f"{table}({_render(fields)}{suffix})")
+        return "\n".join(lines)
+
+    text = text_of()
+    tokens = estimate_tokens(text)
+    dropped = 0
+    if tokens > budget:
+        # drop candidates: leaf fields only, least frequent and deepest first, later columns before earlier
+        candidates = []
+        for table, fields in kept.items():
+            parents = {p.rsplit(".", 1)[0] for p in fields if "." in p}
+            for position, path in enumerate(fields):
+                if path in parents or _pinned(path, terms):
+                    continue
+                freq = frequencies.get(table, {}).get(path, 1.0)
+                # tables the question names keep their fields longest
+                candidates.append((table.lower() in terms, freq, -path.count("."), -position, table, path))
+        candidates.sort()
+        for *_, table, path in candidates:
+            del kept[table][path]
+            dropped += 1
+            tokens -= estimate_tokens(f"{path.rsplit('.', 1)[-1]}:x,")
+            if tokens <= budget:
+                break
+        text = text_of()
+        tokens = estimate_tokens(text)
+
+    return {"text": text, "tokens": tokens, "fields": sum(len(f) for f in tables.values()), "dropped": dropped}
+
+
+def _record(encoded: dict, verbose_text: str):
+    with _stats_lock:
+        _stats["encodings"] += 1
+        _stats["tokens_verbose"] += estimate_tokens(verbose_text)
+        _stats["tokens_compact"] += encoded["tokens"]
+        _stats["fields_dropped"] += encoded["dropped"]
+
+
+def encode_mongo_schema(schema_info: dict, query: str = None, budget: int = None) -> dict:
+    """Encode the output of schema_tool.get_structured_schema."""
+    tables = {name: info["fields"] for name, info in schema_info["collections"].items()}
+    frequencies = {name: info.get("frequency", {}) for name, info in schema_info["collections"].items()}
+    encoded = encode_schema(tables, frequencies, budget, query)
+    if schema_info.get("relationships"):
+        encoded["text"] += "\nrefs: " + ", ".join(f"{r['from']}->{r['to']}" for r in schema_info["relationships"])
+        encoded["tokens"] = estimate_tokens(encoded["text"])
+    # what format_schema_info would have produced
+    verbose = "".join(f"  Collection: {c}\n" + "".join(f"    - {f}: {t}\n" for f, t in fields.items())
+                      for c, fields in tables.items())
+    _record(encoded, verbose)
+    return encoded
+
+
+def encode_sql_schema(schema_info: dict, query: str = None, budget: int = None) -> dict:
+    """Encode the {table: [(column, type), ...]} mapping from nl2sql_v2.get_schema_text."""
+    tables = {table: {col: typ for col, typ in cols} for table, cols in schema_info.items()}
+    encoded = encode_schema(tables, None, budget, query)
+    verbose = "\n".join(f"{t}: " + ", ".join(f"{c} ({ty})" for c, ty in cols.items()) for t, cols in tables.items())
+    _record(encoded, verbose)
+    return encoded
+
+
+def stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    if stats["encodings"]:
+        stats["tokens_saved_ratio"] = round(1 - stats["tokens_compact"] / max(1, stats["tokens_verbose"]), 3)
+    return stats
@@ -0,0 +1,116 @@
+import re
+
+from mongodb_component.intentHandler import mentions_write
+
+# Deterministic resolver for schema exploration requests.
+#
+# Most schema questions name the table/collection and the sample count literally
+# ("show 3 samples from city", "what fields does country have?"), so they can be answered
+# from the catalog without asking an LLM. resolve_schema_request() returns the same shape as
+# DeepSeekHandler.classify_schema_intent, or None when the request is ambiguous.
+
+LIST_KEYWORDS = ["collections", "collection", "tables", "table"]
+FIELD_KEYWORDS = ["field", "fields", "column", "columns", "attribute", "attributes",
+                  "schema", "schemas", "structure", "key", "keys", "describe"]
+SAMPLE_KEYWORDS = ["sample", "samples", "example", "examples", "record", "records",
+                   "document", "documents", "row", "rows"]
+ALL_KEYWORDS = ["all", "every", "each"]
+QUERY_KEYWORDS = ["where", "filter", "sort", "order", "group", "average", "sum", "count",
+                  "total", "top", "largest", "smallest", "max", "min", "than", "between"]
+# "how many rows are in employees" asks for a count, not for sample rows
+COUNT_PHRASES = ["how many", "number of"]
+
+NUMBER_WORDS = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10
+}
+
+DEFAULT_SAMPLE_LIMIT = 3
+MAX_SAMPLE_LIMIT = 50
+
+
+def _words(text):
+    return re.findall(r"[a-z0-9_]+", text.lower())
+
+
+def _name_variants(name):
+    lower = name.lower()
+    variants = {lower}
+    if lower.endswith("y"):
+        variants.add(lower[:-1] + "ies")
+    variants.add(lower + "s")
+    variants.add(lower + "es")
+    if lower.endswith("s"):
+        variants.add(lower[:-1])
+    return variants
+
+
+def match_names(user_input: str, names) -> list:
+    """Return the catalog names mentioned in the text, matching whole words and simple plurals."""
+    text = user_input.lower()
+    found = []
+    for name in names:
+        for variant in _name_variants(name):
+            if re.search(r"(?<![\w.])" + re.escape(variant) + r"(?![\w])", text):
+                found.append(name)
+                break
+    return found
+
+
+def parse_sample_limit(user_input: str, default: int = DEFAULT_SAMPLE_LIMIT) -> int:
+    words = _words(user_input)
+    for i, word in enumerate(words):
+        if word in SAMPLE_KEYWORDS:
+            # the count sits just before the noun: "show 5 samples", "two example documents"
+            for prev in reversed(words[max(0, i - 3):i]):
+                if prev.isdigit():
+                    return max(1, min(int(prev), MAX_SAMPLE_LIMIT))
+                if prev in NUMBER_WORDS:
+                    return NUMBER_WORDS[prev]
+    for word in words:
+        if word.isdigit():
+            return max(1, min(int(word), MAX_SAMPLE_LIMIT))
+    # "show a sample from city"
+    if any(word in SAMPLE_KEYWORDS and not word.endswith("s") for word in words):
+        return 1
+    return default
+
+
+def resolve_schema_request(user_input: str, names, collection_name: str = None):
+    """
+    Resolve a schema request against the catalog `names`.
+    Returns {"intent", "collection", "limit"} or None when an LLM should decide.
+    """
+    words = set(_words(user_input))
+    if words & set(QUERY_KEYWORDS):
+        return None
+    # "insert a new row into departments ..." / "delete all rows from employees" must reach generation
+    if mentions_write(user_input) or any(phrase in " ".join(_words(user_input)) for phrase in COUNT_PHRASES):
+        return None
+
+    if collection_name:
+        mentioned = [collection_name]
+    else:
+        mentioned = match_names(user_input, names)
+
+    wants_samples = bool(words & set(SAMPLE_KEYWORDS))
+    wants_fields = bool(words & set(FIELD_KEYWORDS))
+    wants_all = bool(words & set(ALL_KEYWORDS))
+    wants_list = bool(words & set(LIST_KEYWORDS))
+
+    if wants_samples and not wants_fields:
+        if len(mentioned) == 1:
+            return {"intent": "get_samples", "collection": mentioned[0], "limit": parse_sample_limit(user_input)}
+        return None
+
+    if wants_fields and not wants_samples:
+        if len(mentioned) == 1 and not wants_all:
+            return {"intent": "get_fields", "collection": mentioned[0]}
+        if not mentioned and (wants_all or wants_list):
+            return {"intent": "get_schema_for_all"}
+        return None
+
+    if wants_list and not mentioned and not wants_samples:
+        return {"intent": "list_collections"}
+
+    return None
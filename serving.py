@@ -0,0 +1,104 @@
+import argparse
+import multiprocessing
+import os
+import threading
+
+import startup
+from query_templates import template_store
+from shared_cache import CACHE_DIR, cache_path
+
+# Production serving mode: a pre-fork gunicorn server running app.py with several worker
+# processes (one per core by default), each with its own thread pool.
+#
+#   python serving.py --workers 4 --threads 8 --port 8080
+#
+# Mongo/MySQL/LLM clients are created lazily inside each worker (see app.get_resources and
+# nl2sql_v2._state), so nothing fork-unsafe is inherited from the master. Send SIGHUP to the
+# master for a graceful reload: new workers are started and old ones finish their requests.
+# Workers share state that is worth keeping across processes (learned query templates)
+# through CHATDB_CACHE_DIR.
+
+CACHE_SYNC_SECONDS = 30
+
+
+def sync_shared_cache():
+    try:
+        template_store.save(cache_path("templates.json"))
+    except OSError as e:
+        print(f"Cache sync failed: {e}")
+
+
+def _sync_loop(stop: threading.Event):
+    while not stop.wait(CACHE_SYNC_SECONDS):
+        sync_shared_cache()
+
+
+_stop_sync = threading.Event()
+
+
+def post_worker_init(worker):
+    template_store.load(cache_path("templates.json"))
+    startup.start_warm_up()
+    threading.Thread(target=_sync_loop, args=(_stop_sync,), daemon=True).start()
+
+
+def worker_exit(server, worker):
+    _stop_sync.set()
+    sync_shared_cache()
+
+
+def default_workers() -> int:
+    return multiprocessing.cpu_count()
+
+
+def build_options(args) -> dict:
+    return {
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": "gthread",
+        "timeout": args.timeout,
+        "graceful_timeout": args.graceful_timeout,
+        "max_requests": args.max_requests,
+        "max_requests_jitter": args.max_requests // 10,
+        # importing the app in the master would only save memory for the code itself;
+        # --preload is safe because every client is created per worker anyway
+        "preload_app": args.preload,
+        "post_worker_init": post_worker_init,
+        "worker_exit": worker_exit,
+    }
+
+
+def run(options: dict):
+    from gunicorn.app.base import BaseApplication
+
+    class ChatDBApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from app import app
+            return app
+
+    ChatDBApplication().run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the ChatDB API with a pre-fork multi-process server.")
+    parser.add_argument("--host", default=os.environ.get("CHATDB_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("CHATDB_PORT", "8080")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("CHATDB_WORKERS", default_workers())))
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("CHATDB_THREADS", "8")))
+    parser.add_argument("--timeout", type=int, default=120, help="seconds before a silent worker is restarted")
+    parser.add_argument("--graceful-timeout", type=int, default=30)
+    parser.add_argument("--max-requests", type=int, default=1000, help="recycle workers after this many requests")
+    parser.add_argument("--preload", action="store_true", help="import the app once in the master before forking")
+    args = parser.parse_args()
+    print(f"Serving on {args.host}:{args.port} with {args.workers} workers x {args.threads} threads, "
+          f"cache dir {CACHE_DIR}")
+    run(build_options(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+import os
+import tempfile
+
+# Directory for state that worker processes share on one host: learned query templates,
+# read-your-writes markers, conversations and the host-wide admission slots.
+# Several hosts need it on shared storage (or sticky sessions) for the per-session state.
+
+CACHE_DIR = os.environ.get("CHATDB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "chatdb-cache"))
+
+
+def cache_path(name: str) -> str:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, name)
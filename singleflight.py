@@ -0,0 +1,135 @@
+import asyncio
+import threading
+
+import deadline
+
+# Single-flight request coalescing.
+#
+# Concurrent callers that ask for the same key while a computation for it is in flight wait for
+# that computation and share its result (or exception) instead of starting their own. Nothing is
+# cached once the leader finishes; pair with a cache where results may be reused later.
+# do_async() is the same for coroutines (async_app.py): waiters await the leader's task, which is
+# cancelled once every caller waiting for it has been cancelled.
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+        self._tasks = {}
+        self._task_waiters = {}  # task -> callers still awaiting it
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "executions": 0, "coalesced": 0, "max_waiters": 0}
+
+    def do(self, key, fn):
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self._stats["coalesced"] += 1
+                self._stats["max_waiters"] = max(self._stats["max_waiters"], call.waiters)
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self._stats["executions"] += 1
+                leader = True
+
+        if not leader:
+            own = deadline.current.get()
+            if not call.done.wait(own.remaining() if own is not None else None):
+                raise own.error()
+            if call.error is not None:
+                # the leader ran out of its own time or was cancelled; ours may still have budget
+                if isinstance(call.error, deadline.DeadlineExceeded) and not (own and own.expired()):
+                    return self.do(key, fn)
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key, fn):
+        with self._lock:
+            self._stats["calls"] += 1
+            task = self._tasks.get(key)
+            leader = task is None
+            if leader:
+                # runs in the leader's context (deadline, priority), like the leader's thread in do()
+                task = self._tasks[key] = asyncio.ensure_future(fn())
+                task.add_done_callback(lambda done: self._forget(key, done))
+                self._stats["executions"] += 1
+            else:
+                self._stats["coalesced"] += 1
+            self._task_waiters[task] = self._task_waiters.get(task, 0) + 1
+        try:
+            # a caller that goes away must not cancel the computation the others wait for
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # ... but the last one to go takes it along (a disconnected client, nobody else waiting)
+            with self._lock:
+                last = self._task_waiters.get(task) == 1
+            if last:
+                task.cancel()
+            raise
+        except deadline.DeadlineExceeded:
+            own = deadline.current.get()
+            if not leader and not (own and own.expired()):
+                return await self.do_async(key, fn)
+            raise
+        finally:
+            with self._lock:
+                self._task_waiters[task] -= 1
+                if not self._task_waiters[task]:
+                    del self._task_waiters[task]
+
+    def _forget(self, key, task):
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # retrieved by the waiters; keeps asyncio from logging it again
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls) + len(self._tasks)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._calls) + len(self._tasks)
+        return stats
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def group(name: str) -> SingleFlight:
+    """Return the process-wide coalescing group with this name."""
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = SingleFlight(name)
+        return _groups[name]
+
+
+def stats() -> dict:
+    with _groups_lock:
+        groups = list(_groups.values())
+    return {g.name: g.stats() for g in groups}
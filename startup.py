@@ -0,0 +1,121 @@
+import importlib
+import os
+import threading
+import time
+
+# Cold start support: deferred imports, a background warm-up phase and readiness reporting.
+#
+# Heavy client libraries (openai, ollama, pymongo, mysql.connector) are wrapped with lazy_import()
+# so importing the app only pays for Flask. Once a process is serving, start_warm_up() runs the
+# registered warm-up steps (connection pools, schema catalogs, loading llama3 into Ollama) in a
+# background thread; /ready reports when they are done.
+
+WARMUP_STEPS = os.environ.get("CHATDB_WARMUP", "all")  # "all", "none" or a comma separated list of step names
+
+
+class LazyModule:
+    """Module proxy that imports the real module on first attribute access."""
+
+    def __init__(self, name: str):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            started = time.perf_counter()
+            module = importlib.import_module(self.__dict__["_name"])
+            self.__dict__["_module"] = module
+            _state["imports"][self.__dict__["_name"]] = round(time.perf_counter() - started, 4)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
+
+
+_steps = []
+_state = {
+    "pid": None,
+    "status": "pending",
+    "steps": {},
+    "imports": {},
+    "import_seconds": None,
+    "first_request": None,
+}
+_lock = threading.Lock()
+
+
+def register_warm_up(name: str, fn):
+    """Register a warm-up step; steps run in registration order."""
+    _steps.append((name, fn))
+
+
+def _enabled(name: str) -> bool:
+    if WARMUP_STEPS == "all":
+        return True
+    if WARMUP_STEPS == "none":
+        return False
+    return name in [s.strip() for s in WARMUP_STEPS.split(",")]
+
+
+def _run_warm_up():
+    started = time.perf_counter()
+    for name, fn in _steps:
+        if not _enabled(name):
+            _state["steps"][name] = {"status": "skipped"}
+            continue
+        step_started = time.perf_counter()
+        try:
+            fn()
+            _state["steps"][name] = {"status": "ok", "seconds": round(time.perf_counter() - step_started, 3)}
+        except Exception as e:
+            # a failed step only means the first real request pays for it
+            _state["steps"][name] = {"status": "failed", "error": str(e),
+                                     "seconds": round(time.perf_counter() - step_started, 3)}
+        print(f"Warm-up {name}: {_state['steps'][name]}")
+    _state["warm_up_seconds"] = round(time.perf_counter() - started, 3)
+    _state["status"] = "ready"
+
+
+def start_warm_up():
+    """Start the warm-up once per process (safe to call from every request or fork hook)."""
+    pid = os.getpid()
+    if _state["pid"] == pid:
+        return
+    with _lock:
+        if _state["pid"] == pid:
+            return
+        _state.update(pid=pid, status="warming", steps={}, first_request=None)
+        threading.Thread(target=_run_warm_up, name="chatdb-warm-up", daemon=True).start()
+
+
+def is_ready() -> bool:
+    return _state["pid"] == os.getpid() and _state["status"] == "ready"
+
+
+def record_import(seconds: float):
+    _state["import_seconds"] = round(seconds, 4)
+
+
+def record_first_request(path: str, seconds: float):
+    if _state["first_request"] is None:
+        _state["first_request"] = {"path": path, "seconds": round(seconds, 4), "after_ready": is_ready()}
+
+
+def report() -> dict:
+    return {
+        "ready": is_ready(),
+        "status": _state["status"] if _state["pid"] == os.getpid() else "pending",
+        "warm_up_seconds": _state.get("warm_up_seconds"),
+        "steps": dict(_state["steps"]),
+        "import_seconds": _state["import_seconds"],
+        "deferred_imports": dict(_state["imports"]),
+        "first_request": _state["first_request"],
+    }
@@ -0,0 +1,223 @@
+import atexit
+import contextvars
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+# Workload capture for replay (see benchmarks/replay_workload.py).
+#
+# A sampled share of /query requests is appended to a rotating JSON-lines log, one compact line per
+# request: the request body and the headers that change its handling, the generated query, every
+# LLM call (prompt hash, reply, latency, tokens), every database call (latency, rows) and the
+# response status, size and total time. Requests hand their serialized line to a background writer
+# through a queue bounded both in lines (QUEUE_SIZE) and in bytes (MAX_QUEUED_BYTES); a line that
+# does not fit is dropped and counted, so capture never buffers without bound or makes a request
+# wait for the disk. Request bodies over MAX_REQUEST_CHARS are cut down before they are recorded.
+#
+# Each process writes its own file (workload-<pid>.jsonl in CHATDB_CAPTURE) and rotates it like
+# logging's RotatingFileHandler: workload-<pid>.jsonl.1 ... .<CHATDB_CAPTURE_BACKUPS>.
+# The log holds user questions and LLM output; store it like any other production data.
+
+CAPTURE_DIR = os.environ.get("CHATDB_CAPTURE", "")  # empty: capture is off
+SAMPLE_RATE = float(os.environ.get("CHATDB_CAPTURE_SAMPLE", "0.1"))
+MAX_BYTES = int(float(os.environ.get("CHATDB_CAPTURE_MAX_MB", "64")) * 1024 * 1024)
+BACKUPS = int(os.environ.get("CHATDB_CAPTURE_BACKUPS", "3"))
+QUEUE_SIZE = 1000
+MAX_EVENTS = 32  # LLM / database calls kept per request
+MAX_REPLY_CHARS = 32768
+MAX_REQUEST_CHARS = 16384
+MAX_QUEUED_BYTES = int(float(os.environ.get("CHATDB_CAPTURE_QUEUE_MB", "16")) * 1024 * 1024)
+REPLAY_HEADERS = ("X-Session-Id", "X-Priority", "X-Queue-Budget", "X-Deadline-Ms")
+
+# the record of the current request, or None when it is not sampled
+current = contextvars.ContextVar("workload_record", default=None)
+
+_stats = {"sampled": 0, "written": 0, "dropped": 0, "over_budget": 0, "truncated_requests": 0, "rotations": 0,
+          "write_errors": 0}
+_stats_lock = threading.Lock()
+
+
+def prompt_key(messages) -> str:
+    """Hash of a chat prompt; the replay stand-in looks recorded replies up by it."""
+    canonical = json.dumps([[m.get("role"), m.get("content")] for m in messages],
+                           ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:24]
+
+
+def _count(name: str, n: int = 1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def _capped_body(body):
+    """The request body, or when it serializes to more than MAX_REQUEST_CHARS a copy with its fields cut."""
+    if len(json.dumps(body, ensure_ascii=False, default=str)) <= MAX_REQUEST_CHARS:
+        return body
+    _count("truncated_requests")
+    if not isinstance(body, dict):
+        return None
+    # plain fields only, each string shortened to its share of the limit
+    share = MAX_REQUEST_CHARS // max(1, len(body))
+    return {key: value[:share] if isinstance(value, str) else value for key, value in body.items()
+            if isinstance(value, (str, int, float, bool, type(None)))}
+
+
+def begin(path: str, body, headers):
+    """Start recording this request if capture is on and it is sampled."""
+    if not CAPTURE_DIR or random.random() >= SAMPLE_RATE:
+        current.set(None)
+        return
+    current.set({
+        "ts": round(time.time(), 3),
+        "path": path,
+        "request": _capped_body(body),
+        "headers": {name: headers[name] for name in REPLAY_HEADERS if name in headers},
+        "llm": [],
+        "db": [],
+        "_started": time.perf_counter(),
+    })
+
+
+def record_query(engine: str, query):
+    record = current.get()
+    if record is not None:
+        record["query"] = {"engine": engine, "text": query}
+
+
+def record_llm(backend: str, messages, reply: str, seconds: float, prompt_tokens=None, completion_tokens=None):
+    record = current.get()
+    if record is None or len(record["llm"]) >= MAX_EVENTS:
+        return
+    record["llm"].append({
+        "backend": backend,
+        "key": prompt_key(messages),
+        # the question alone: lets replay answer when only the schema part of the prompt changed
+        "last_key": prompt_key(messages[-1:]),
+        "ms": round(seconds * 1000, 1),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "reply": (reply or "")[:MAX_REPLY_CHARS],
+    })
+
+
+def record_db(backend: str, seconds: float, rows):
+    record = current.get()
+    if record is None or len(record["db"]) >= MAX_EVENTS:
+        return
+    record["db"].append({"backend": backend, "ms": round(seconds * 1000, 1), "rows": rows})
+
+
+def finish(status: int, response_bytes: int):
+    record = current.get()
+    current.set(None)
+    if record is None:
+        return
+    record["ms"] = round((time.perf_counter() - record.pop("_started")) * 1000, 1)
+    record["status"] = status
+    record["bytes"] = response_bytes
+    _count("sampled")
+    # serialized here so the queue can be bounded by what it actually holds
+    writer.submit((json.dumps(record, ensure_ascii=False, default=str, separators=(",", ":")) + "\n").encode("utf-8"))
+
+
+class _Writer:
+    def __init__(self):
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._queued_bytes = 0
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, line: bytes):
+        self._start()
+        with self._lock:
+            if self._queued_bytes + len(line) > MAX_QUEUED_BYTES:
+                _count("over_budget")
+                return
+            self._queued_bytes += len(line)
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self._release(len(line))
+            _count("dropped")
+
+    def _release(self, size: int):
+        with self._lock:
+            self._queued_bytes -= size
+
+    def _start(self):
+        # one writer thread per process; a pre-fork master's thread does not survive the fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(QUEUE_SIZE)
+                self._queued_bytes = 0
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, args=(self._queue,), daemon=True)
+                self._thread.start()
+
+    def path(self) -> str:
+        return os.path.join(CAPTURE_DIR, f"workload-{os.getpid()}.jsonl")
+
+    def _run(self, pending: queue.Queue):
+        os.makedirs(CAPTURE_DIR, exist_ok=True)
+        path = self.path()
+        out = open(path, "ab")
+        size = out.tell()
+        while True:
+            line = pending.get()
+            if line is None:
+                out.close()
+                return
+            self._release(len(line))
+            try:
+                if size and size + len(line) > MAX_BYTES:
+                    out.close()
+                    self._rotate(path)
+                    out = open(path, "ab")
+                    size = 0
+                out.write(line)
+                size += len(line)
+                if pending.empty():
+                    out.flush()
+                _count("written")
+            except OSError as e:
+                print(f"Workload capture write failed: {e}")
+                _count("write_errors")
+
+    def _rotate(self, path: str):
+        for i in range(BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}"):
+                os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+        if BACKUPS > 0:
+            os.replace(path, f"{path}.1")
+        else:
+            os.remove(path)
+        _count("rotations")
+
+    def close(self, timeout: float = 2.0):
+        """Write what is queued before the process exits."""
+        if self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+writer = _Writer()
+atexit.register(writer.close)
+
+
+def stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    stats.update(enabled=bool(CAPTURE_DIR), sample_rate=SAMPLE_RATE, queued=writer._queue.qsize(),
+                 queued_bytes=writer._queued_bytes)
+    return stats